@@ -1,11 +1,255 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import json
 import os
+import threading
+import time
 
 import boto3
-from botocore.exceptions import ClientError
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
+import constants
+from fetch_cache import file_sha256
+from instrumentation import measure
 
-def upload_file_to_s3(file_name, bucket, object_name=None, extra_args=None):
+
+UploadResult = namedtuple(
+    'UploadResult',
+    ['file_name', 'object_name', 'success', 'bytes', 'seconds', 'attempts', 'error', 'skipped', 'sha256']
+)
+
+s3_clients = {}  # Shared S3 clients by endpoint URL. boto3 clients are thread safe.
+s3_clients_lock = threading.Lock()
+
+
+def get_s3_client(endpoint_url=None, max_pool_connections=None):
+    """Return the S3 client that is shared by every upload in this process, creating it on first use.
+
+    :param endpoint_url: Defaults None. URL of an S3 compatible service to use instead of AWS,
+        e.g. a local stand-in such as `moto_server` or MinIO. Falls back to `constants.s3_endpoint_url`.
+    :param max_pool_connections: Defaults None. Size of the client's HTTP connection pool. Falls back
+        to `constants.s3_max_pool_connections`. Only used when the client is created.
+
+    :return: A boto3 S3 client
+    """
+    endpoint_url = endpoint_url or constants.s3_endpoint_url
+    with s3_clients_lock:
+        if endpoint_url not in s3_clients:
+            s3_clients[endpoint_url] = boto3.client(
+                's3',
+                endpoint_url=endpoint_url,
+                config=Config(max_pool_connections=max_pool_connections or constants.s3_max_pool_connections)
+            )
+        return s3_clients[endpoint_url]
+
+def extra_args_for_file(file_name):
+    """Choose the S3 metadata of a file from its extension. See `./constants.py`"""
+    extension = file_name.split('.')[-1]
+    if extension == 'gz':
+        return constants.gzip_extra_args
+    if extension == 'br':
+        return constants.brotli_extra_args
+    if extension == 'pbf':
+        return constants.mvt_extra_args
+    if extension == 'fgb':
+        return constants.fgb_extra_args
+    return constants.json_extra_args
+
+def read_publish_manifest(manifest_json):
+    """Read the manifest written by the last `publish_files_to_s3` run, or an empty one
+
+    :return: A dictionary with an `objects` dictionary of `object_name: {'sha256': ..., 'bytes': ...}`
+    """
+    if not manifest_json or not os.path.isfile(manifest_json):
+        return {'objects': {}}
+    with open(manifest_json, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def remote_sha256(s3_client, bucket, object_name):
+    """Return the SHA-256 digest stored in the metadata of an S3 object by `publish_files_to_s3`,
+    or None if the object does not exist or has no digest, or the request fails (e.g. on a
+    connection error), so that the file is uploaded rather than the publish aborted.
+    """
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=object_name)
+    except (BotoCoreError, ClientError):
+        return None
+    return response.get('Metadata', {}).get(constants.s3_digest_metadata_key)
+
+def publish_files_to_s3(uploads, bucket, max_workers=None, multipart_chunksize=None, max_concurrency=None,
+                        max_attempts=None, backoff_seconds=None, endpoint_url=None, skip_unchanged=True,
+                        manifest_json=None, sources=None):
+    """Upload a set of files to an S3 bucket concurrently, through one shared client.
+
+    Each file is uploaded by a thread pool worker with boto3's managed transfer, so large files
+    are also split into parts that are uploaded in parallel. Failed uploads are retried with an
+    exponential backoff. A file that cannot be read is reported as a failed upload. The throughput
+    of each file and of the whole set is printed.
+
+    The SHA-256 digest of every file is stored in the metadata of its S3 object. When `skip_unchanged`
+    is True, a file is only uploaded if its digest differs from the one recorded for the object in
+    the local manifest of the last run, or, if the manifest has no match, from the one in the metadata
+    of the remote object. Unchanged files are skipped.
+
+    :param uploads: A list of `(file_name, object_name, extra_args)` tuples. If extra_args is None,
+        it is chosen from the file extension (see `extra_args_for_file`)
+    :param bucket: Bucket to upload to
+    :param max_workers: Defaults None. Number of files uploaded at the same time.
+        Falls back to `constants.s3_max_workers`
+    :param multipart_chunksize: Defaults None. Size in bytes of the parts of a multipart upload. Files larger
+        than this are uploaded in parts. Falls back to `constants.s3_multipart_chunksize`
+    :param max_concurrency: Defaults None. Number of parts of one file uploaded at the same time.
+        Falls back to `constants.s3_max_concurrency`
+    :param max_attempts: Defaults None. Number of times a file is tried before giving up.
+        Falls back to `constants.s3_max_attempts`
+    :param backoff_seconds: Defaults None. Wait before the first retry, doubled for every following retry.
+        Falls back to `constants.s3_backoff_seconds`
+    :param endpoint_url: Defaults None. URL of an S3 compatible service to use instead of AWS (see `get_s3_client`)
+    :param skip_unchanged: Bool, defaults True. If True, files whose content is already published are skipped
+    :param manifest_json: Defaults None. A filepath on disk. If given, the digests of this run are recorded
+        there, and the manifest of the previous run is used to skip unchanged files without a request to S3
+    :param sources: Defaults None. A dictionary of the digest of each source file that the uploads were
+        built from, by URL (see `fetch_cache.FetchResult`). Recorded in the manifest only if every file
+        was published, so that a source is only skipped by the next runs once it is published
+        (see `fetch_cache.published_sha256`)
+
+    :return: A list of `UploadResult`, in the order of `uploads`
+    """
+    max_workers = max_workers or constants.s3_max_workers
+    multipart_chunksize = multipart_chunksize or constants.s3_multipart_chunksize
+    max_concurrency = max_concurrency or constants.s3_max_concurrency
+    max_attempts = max_attempts or constants.s3_max_attempts
+    backoff_seconds = constants.s3_backoff_seconds if backoff_seconds is None else backoff_seconds
+
+    # Every file worker can run max_concurrency part uploads, so size the pool to match
+    s3_client = get_s3_client(endpoint_url, max_pool_connections=max_workers * max_concurrency)
+    transfer_config = TransferConfig(
+        multipart_threshold=multipart_chunksize,
+        multipart_chunksize=multipart_chunksize,
+        max_concurrency=max_concurrency,
+    )
+
+    manifest = read_publish_manifest(manifest_json)
+
+    def upload(file_name, object_name, extra_args):
+        if extra_args is None:
+            extra_args = extra_args_for_file(file_name)
+        error = None
+        start = time.perf_counter()
+
+        try:
+            file_size = os.path.getsize(file_name)
+            sha256 = file_sha256(file_name)
+        except OSError as e:
+            # A missing or unreadable file fails on its own, without aborting the other uploads
+            print(f'  Cannot read {file_name}, not uploaded: {object_name}\n   {e}')
+            return UploadResult(file_name, object_name, False, 0, time.perf_counter() - start, 0, str(e), False, None)
+        if skip_unchanged:
+            published = manifest['objects'].get(object_name, {}).get('sha256')
+            if published != sha256:
+                published = remote_sha256(s3_client, bucket, object_name)
+            if published == sha256:
+                print(f'  Unchanged, skipped {object_name}')
+                return UploadResult(file_name, object_name, True, 0, time.perf_counter() - start, 0, None, True, sha256)
+        extra_args = dict(extra_args)
+        extra_args['Metadata'] = dict(extra_args.get('Metadata', {}), **{constants.s3_digest_metadata_key: sha256})
+
+        for attempt in range(1, max_attempts+1):
+            try:
+                s3_client.upload_file(
+                    file_name,
+                    bucket,
+                    object_name,
+                    ExtraArgs=extra_args,
+                    Config=transfer_config
+                )
+            except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+                error = str(e)
+                print(f'  Upload attempt {attempt} of {max_attempts} failed: {object_name}\n   {error}')
+                if attempt < max_attempts:
+                    time.sleep(backoff_seconds * 2**(attempt - 1))
+                continue
+            seconds = time.perf_counter() - start
+            print(f'  Uploaded {object_name}: {file_size / 1e6:.2f} MB in {seconds:.2f} s '
+                  f'({file_size / 1e6 / max(seconds, 1e-6):.2f} MB/s)')
+            return UploadResult(file_name, object_name, True, file_size, seconds, attempt, None, False, sha256)
+        return UploadResult(
+            file_name, object_name, False, file_size, time.perf_counter() - start, max_attempts, error, False, sha256
+        )
+
+    print(f'\nPublishing {len(uploads)} files to bucket {bucket} with {max_workers} workers')
+    start = time.perf_counter()
+    with measure('upload', rows=len(uploads)) as stage:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(upload, file_name, object_name, extra_args)
+                for file_name, object_name, extra_args in uploads
+            ]
+            results = [future.result() for future in futures]
+        seconds = time.perf_counter() - start
+
+        uploaded = [result for result in results if result.success and not result.skipped]
+        skipped = [result for result in results if result.skipped]
+        total_bytes = sum(result.bytes for result in uploaded)
+        stage['bytes_uploaded'] = total_bytes
+    print(f' Uploaded {len(uploaded)} of {len(results)} files ({len(skipped)} unchanged): '
+          f'{total_bytes / 1e6:.2f} MB in {seconds:.2f} s ({total_bytes / 1e6 / max(seconds, 1e-6):.2f} MB/s)')
+    for result in results:
+        if not result.success:
+            print(f'  FAILED: {result.object_name}')
+
+    if manifest_json:
+        write_publish_manifest(manifest, results, bucket, manifest_json, sources=sources)
+    return results
+
+def write_publish_manifest(manifest, results, bucket, manifest_json, sources=None):
+    """Record what a `publish_files_to_s3` run published. Objects that failed to upload keep
+    the entry of the previous run, so that they are retried next time. The digests of the `sources`
+    are only recorded if every upload succeeded.
+
+    :param manifest: The manifest of the previous run (see `read_publish_manifest`)
+    :param results: The list of `UploadResult` of this run
+    :param bucket: The bucket the files were published to
+    :param manifest_json: Filepath of the manifest on disk
+    :param sources: Defaults None. A dictionary of the digest of each source file by URL
+
+    :return manifest_json: The manifest file location as a string
+    """
+    published_at = datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+    manifest = {
+        'bucket': bucket,
+        'published_at': published_at,
+        'objects': dict(manifest['objects']),
+        'sources': dict(manifest.get('sources', {})),
+        'run': [],
+    }
+    if sources and all(result.success for result in results):
+        manifest['sources'].update(sources)
+    for result in results:
+        if result.success:
+            previous = manifest['objects'].get(result.object_name, {})
+            manifest['objects'][result.object_name] = {
+                'sha256': result.sha256,
+                'bytes': os.path.getsize(result.file_name),
+                'published_at': previous.get('published_at', published_at) if result.skipped else published_at,
+            }
+        manifest['run'].append({
+            'object_name': result.object_name,
+            'status': 'unchanged' if result.skipped else ('uploaded' if result.success else 'failed'),
+            'bytes': result.bytes,
+            'seconds': round(result.seconds, 3),
+        })
+
+    print(f'\nWriting publish manifest:\n {manifest_json}')
+    with open(manifest_json, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest_json
+
+def upload_file_to_s3(file_name, bucket, object_name=None, extra_args=None, endpoint_url=None):
     """Upload a file to an S3 bucket
 
     :param file_name: File to upload
@@ -14,6 +258,7 @@ def upload_file_to_s3(file_name, bucket, object_name=None, extra_args=None):
     :param extra_args: a dictionary specifying extra args to set while uploading the file.
         Often used to set metadata. For more options, see
         https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+    :param endpoint_url: Defaults None. URL of an S3 compatible service to use instead of AWS
     
     :return: True if file was uploaded, else False
     """
@@ -28,10 +273,10 @@ def upload_file_to_s3(file_name, bucket, object_name=None, extra_args=None):
         object_name = file_name
 
     # Upload the file
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client(endpoint_url)
     try:
         response = s3_client.upload_file(file_name, bucket, object_name, ExtraArgs=extra_args)
-    except ClientError as e:
+    except (ClientError, S3UploadFailedError) as e:
         print(e)
         return False
     return True
@@ -1,32 +1,37 @@
-import pandas as pd
+from functools import lru_cache
+
 import numpy as np
-import matplotlib.pyplot as plt
 
+from colormap_luts import colormap_luts
+import constants
+from instrumentation import measure
+from transforms import plain_dtypes
 
-def get_rgbs(values, bins, colormap='viridis', mode='equalcount'):
-    # Colormap currently supports perceptually uniform sequential
-    # colormaps from matplotlib: 'viridis', 'plasma', 'inferno', 'magma', 'cividis'
-    # https://matplotlib.org/3.1.0/tutorials/colors/colormaps.html
-    if mode == 'equalinterval':
-        cuts = pd.cut(values, bins, duplicates='drop')
-    else:
-        # Default to equal count
-        cuts = pd.qcut(values, bins, duplicates='drop')
 
-    cuts_out = [list(cut) for cut in cuts.categories.to_tuples()]
-    cuts_out[0][0] = float(np.min(values) - 0.001)
-    cuts_out[-1][1] = float(np.max(values))
+def get_rgbs(values, bins, colormap='viridis', mode='equalcount', sketch=None):
+    """Classify values into `bins` classes and pick an RGB color for each class from a colormap.
+
+    :param values: A list or NumPy array of numbers. Missing values (NaN) are ignored.
+    :param bins: The number of classes. Fewer classes are returned if there are fewer distinct
+        values (or, for 'equalcount', no other way to make the breaks distinct).
+    :param colormap: Defaults 'viridis'. Supports the perceptually uniform sequential colormaps of
+        matplotlib: 'viridis', 'plasma', 'inferno', 'magma', 'cividis'
+        (https://matplotlib.org/3.1.0/tutorials/colors/colormaps.html)
+    :param mode: Defaults 'equalcount'. The classification scheme (see `class_breaks`)
+    :param sketch: Defaults None. A `quantile_sketch.KLLSketch` of the values. If given, the class
+        breaks are computed from the sketch, and `values` is not used (it can be None)
 
-    cmap = plt.cm.get_cmap(colormap, len(cuts_out))
-    cmap_colors = cmap.colors.tolist()
+    :returns color_stats: A dictionary of the `input_params`, and the `cuts` with the `intervals`
+        (closed on the right), and one `rgb_colors` entry per interval
+    """
+    if sketch is not None:
+        edges = weighted_class_breaks(*sketch.weighted_values(), bins, mode)
+    else:
+        values = np.asarray(values, dtype=float)
+        edges = class_breaks(values[~np.isnan(values)], bins, mode)
 
-    colors_out = []
-    for color in cmap_colors:
-        colors_out.append([
-            round(color[0] * 255),
-            round(color[1] * 255),
-            round(color[2] * 255),
-        ])
+    cuts_out = [[float(low), float(high)] for low, high in zip(edges[:-1], edges[1:])]
+    cuts_out[0][0] = float(edges[0] - 0.001)
 
     color_stats = {
         'input_params': {
@@ -36,9 +41,209 @@ def get_rgbs(values, bins, colormap='viridis', mode='equalcount'):
         },
         'cuts': {
             'intervals': cuts_out,
-            'closed': cuts.categories.closed,
-            'rgb_colors': colors_out,
+            'closed': 'right',
+            'rgb_colors': rgb_colors(colormap, len(cuts_out)),
         },
     }
 
     return color_stats
+
+def class_breaks(values, bins, mode='equalcount'):
+    """Compute the class breaks of a 1D array in one pass over its sorted distinct values.
+
+    Modes:
+        'equalcount' (or 'quantile'): about the same number of values in each class. The breaks are
+            values of the data, chosen so that they are distinct, which gives `bins` classes whenever
+            there are at least `bins` distinct values.
+        'equalinterval': classes of the same width between the min and max.
+        'jenks': Jenks natural breaks, which minimize the variance within the classes (see `jenks_breaks`).
+        'log': classes of the same width on a log scale (of 1 + value), for skewed counts and rates.
+            The values must not be negative.
+
+    :param values: A NumPy array of floats without missing values
+    :param bins: The number of classes
+    :param mode: Defaults 'equalcount'
+
+    :returns edges: A NumPy array of the class edges, from the min to the max of the values,
+        with one more edge than there are classes
+    """
+    return weighted_class_breaks(*np.unique(values, return_counts=True), bins, mode)
+
+def weighted_class_breaks(distinct, counts, bins, mode='equalcount'):
+    """Compute the class breaks (see `class_breaks`) of a set of values that is given as its
+    sorted distinct values and the number of times each occurs, e.g. the weighted values of a
+    `quantile_sketch.KLLSketch`
+
+    :returns edges: A NumPy array of the class edges
+    """
+    if distinct.size == 0:
+        raise ValueError('Cannot classify an empty set of values')
+    bins = max(1, min(int(bins), distinct.size))
+    if bins == 1:
+        return np.array([distinct[0], distinct[-1]])
+
+    if mode in ('equalcount', 'quantile'):
+        # Break at the distinct value where each target count is reached, keeping the breaks
+        # distinct and leaving at least one distinct value for each of the following classes
+        cumulative = np.cumsum(counts)
+        targets = cumulative[-1] * np.arange(1, bins) / bins
+        positions = np.searchsorted(cumulative, targets)
+        for k in range(bins - 1):
+            low = positions[k - 1] + 1 if k else 0
+            positions[k] = min(max(positions[k], low), distinct.size - bins + k)
+        return np.concatenate([[distinct[0]], distinct[positions], [distinct[-1]]])
+    if mode == 'equalinterval':
+        return np.linspace(distinct[0], distinct[-1], bins + 1)
+    if mode == 'jenks':
+        return jenks_breaks(distinct, counts, bins)
+    if mode == 'log':
+        if distinct[0] < 0:
+            raise ValueError('The log classification needs values that are not negative')
+        edges = np.expm1(np.linspace(np.log1p(distinct[0]), np.log1p(distinct[-1]), bins + 1))
+        edges[0], edges[-1] = distinct[0], distinct[-1]
+        return edges
+    raise ValueError(f'Unknown classification mode: {mode}')
+
+def jenks_breaks(distinct, counts, bins, max_groups=None):
+    """Jenks natural breaks by dynamic programming (Fisher's exact optimization), over the
+    distinct values weighted by their counts.
+
+    When there are more than `max_groups` distinct values, consecutive values are first merged
+    into `max_groups` groups of about the same count. The sums of each group are kept, so the
+    variance of the classes is still exact, but the breaks can only fall between groups.
+
+    :param distinct: A sorted NumPy array of distinct values
+    :param counts: A NumPy array of the number of times each distinct value occurs
+    :param bins: The number of classes, at most the number of distinct values
+    :param max_groups: Defaults None. Falls back to `constants.jenks_max_groups`
+
+    :returns edges: A NumPy array of the class edges (see `class_breaks`)
+    """
+    max_groups = max_groups or constants.jenks_max_groups
+    if distinct.size > max_groups:
+        before = np.cumsum(counts) - counts
+        groups = np.unique(before * max_groups // counts.sum(), return_inverse=True)[1]
+    else:
+        groups = np.arange(distinct.size)
+    group_count = groups[-1] + 1
+    bins = min(bins, group_count)
+    weights = np.bincount(groups, counts).astype(float)
+    highs = distinct[np.searchsorted(groups, np.arange(group_count), side='right') - 1]
+
+    # Sum of squared deviations of every run of groups [i, j], from prefix sums of the weighted moments
+    s0 = np.concatenate([[0], np.cumsum(weights)])
+    s1 = np.concatenate([[0], np.cumsum(np.bincount(groups, counts * distinct))])
+    s2 = np.concatenate([[0], np.cumsum(np.bincount(groups, counts * distinct**2))])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssd = (s2[None, 1:] - s2[:-1, None]) - (s1[None, 1:] - s1[:-1, None])**2 / (s0[None, 1:] - s0[:-1, None])
+    ssd[np.tril_indices(group_count, -1)] = np.inf
+
+    # cost[j] is the least variance of the groups up to j in k classes, and starts[k][j] the first group of the last class
+    cost = ssd[0]
+    starts = []
+    for _ in range(1, bins):
+        total = np.full((group_count, group_count), np.inf)
+        total[1:] = cost[:-1, None] + ssd[1:]
+        starts.append(total.argmin(axis=0))
+        cost = total.min(axis=0)
+
+    breaks = []
+    end = group_count - 1
+    for class_starts in reversed(starts):
+        end = class_starts[end] - 1
+        breaks.append(highs[end])
+    return np.concatenate([[distinct[0]], breaks[::-1], [distinct[-1]]])
+
+@lru_cache(maxsize=None)
+def rgb_lut(colormap):
+    """The lookup table of a colormap, as a NumPy array of 0-255 RGB rows. Built once per colormap.
+
+    The tables of the perceptually uniform colormaps are embedded in `./colormap_luts.py`.
+    Other colormaps are read from matplotlib, which is only imported for them.
+    """
+    if colormap in colormap_luts:
+        lut = bytes.fromhex(''.join(colormap_luts[colormap]))
+        return np.frombuffer(lut, dtype=np.uint8).reshape(-1, 3).astype(int)
+
+    from matplotlib import cm
+    cmap = cm.get_cmap(colormap)
+    return np.round(cmap(np.arange(cmap.N))[:, :3] * 255).astype(int)
+
+def rgb_colors(colormap, color_count):
+    """Pick `color_count` evenly spaced colors from the lookup table of a colormap, as matplotlib
+    does when a colormap is resampled (`get_cmap(colormap, color_count)`)
+
+    :returns rgb_colors: A list of `[r, g, b]` lists of ints
+    """
+    lut = rgb_lut(colormap)
+    positions = np.minimum((np.linspace(0, 1, color_count) * len(lut)).astype(int), len(lut) - 1)
+    return lut[positions].tolist()
+
+def make_colormaps(data_frame, metrics, id_field='fips', date_field='date', sketches=None):
+    """Classify several metrics of a long formatted frame (one row per county per day) in one go,
+    e.g. the cases, the deaths, the per 100k rates and the new cases, over the whole history or
+    only the latest day of each county.
+
+    Each metric is a dictionary with the keys:
+        'field': the column to classify
+        'bins': the number of classes
+        'colormap': the name of the colormap (see `get_rgbs`)
+        'mode': the classification scheme (see `class_breaks`)
+        'latest': optional, defaults False. If True, only the latest row of each county is classified
+        'fallback_mode': optional. Used instead of 'mode' if it gives fewer classes than 'bins'
+
+    :param data_frame: A DataFrame in long format
+    :param metrics: A list of metric dictionaries, e.g. `constants.nyt_colormaps`
+    :param id_field: Defaults 'fips'. The field that identifies a county
+    :param date_field: Defaults 'date'. The field holding the date of each row
+    :param sketches: Defaults None. A dictionary of field name to `quantile_sketch.KLLSketch`, e.g. of
+        the whole history of an incremental pipeline. The metrics over all rows (not 'latest') of
+        these fields are classified from their sketch rather than from `data_frame`
+
+    :returns colormaps: A dictionary with the colormaps of all of the metrics under 'metrics',
+        keyed by field name (with a '_latest' suffix for the latest day). The colormap of the first
+        metric is also at the top level, as it was before there were several.
+    """
+    latest_frame = None
+    colormaps = {}
+    for metric in metrics:
+        field = metric['field']
+        name = f'{field}_latest' if metric.get('latest') else field
+        if metric.get('latest'):
+            if latest_frame is None:
+                latest_fields = list(dict.fromkeys(other['field'] for other in metrics if other.get('latest')))
+                latest_frame = data_frame.loc[~data_frame[id_field].isnull(), [id_field, date_field] + latest_fields]
+                latest_frame = latest_frame.sort_values(date_field, kind='mergesort').drop_duplicates(id_field, keep='last')
+            source = latest_frame
+        else:
+            source = data_frame
+
+        with measure(f'classify {name}') as stage:
+            sketch = None if metric.get('latest') else (sketches or {}).get(field)
+            if sketch is not None:
+                values = None
+                print(f'\nClassifying {name} from a sketch of {sketch.count} values (rank error {sketch.rank_error:.2%})')
+                stage['rows'] = sketch.count
+            else:
+                # Classify the values as they are written to the outputs, rather than in their float32 storage dtype
+                values = plain_dtypes(source[[field]])[field].to_numpy(dtype=float, na_value=np.nan)
+                print(f'\nClassifying {name}')
+                stage['rows'] = int(np.count_nonzero(~np.isnan(values)))
+            print(f' {metric["bins"]} {metric["mode"]} classes of {metric["colormap"]}')
+            color_stats = get_rgbs(values, metric['bins'], colormap=metric['colormap'], mode=metric['mode'], sketch=sketch)
+            class_count = len(color_stats['cuts']['rgb_colors'])
+            if class_count < metric['bins'] and metric.get('fallback_mode'):
+                print(f' {class_count} classes, falling back to {metric["fallback_mode"]}')
+                color_stats = get_rgbs(
+                    values,
+                    metric['bins'],
+                    colormap=metric['colormap'],
+                    mode=metric['fallback_mode'],
+                    sketch=sketch
+                )
+            color_stats['input_params'].update(field=field, latest=bool(metric.get('latest')), sketch=sketch is not None)
+            colormaps[name] = color_stats
+            print(f' {len(color_stats["cuts"]["rgb_colors"])} classes')
+
+    primary = colormaps[next(iter(colormaps))] if colormaps else {}
+    return dict(primary, metrics=colormaps)
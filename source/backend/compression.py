@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import struct
+import zlib
+
+import constants
+
+
+def gzip_file(input_filepath, output_filepath, level=None, block_size=None, workers=None):
+    """Compress a file to gzip on several cores, the way pigz does.
+
+    The input is split into blocks that are deflated in parallel by a thread pool (zlib releases
+    the GIL while it compresses). Each block is primed with the last 32 KB of the block before it,
+    so the ratio stays close to a single-threaded compression, and every block but the last ends on
+    a byte boundary with a sync flush. The raw deflate blocks are concatenated behind one gzip header,
+    which makes the output a regular single-member gzip file that any gzip reader can decompress.
+
+    :param input_filepath: The file to be compressed
+    :param output_filepath: The file location to create a compressed copy of the input file
+    :param level: Defaults None. The compression level (1-9). Falls back to `constants.gzip_level`
+    :param block_size: Defaults None. Bytes compressed per task. Falls back to `constants.compression_block_size`
+    :param workers: Defaults None. Number of threads. Falls back to the number of CPUs
+
+    :returns output_filepath: The compressed file location as a string
+    """
+    level = constants.gzip_level if level is None else level
+    block_size = block_size or constants.compression_block_size
+    workers = workers or os.cpu_count() or 1
+    window = 32 * 1024  # the deflate window: the most history a block can refer back to
+
+    def deflate_block(block, dictionary, last):
+        if dictionary:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    print(f'\nGZIP file (level {level}, {workers} threads):\n {input_filepath}\n  as\n {output_filepath}')
+    input_size = os.path.getsize(input_filepath)
+    crc = 0
+    with open(input_filepath, 'rb') as f_in, open(output_filepath, 'wb') as f_out:
+        # gzip header: magic, deflate, no flags, mtime 0 (so unchanged content gives unchanged bytes), OS unknown
+        f_out.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + b'\x00\xff')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            dictionary = b''
+            position = 0
+            while True:
+                block = f_in.read(block_size)
+                position += len(block)
+                last = position >= input_size
+                crc = zlib.crc32(block, crc)
+                pending.append(executor.submit(deflate_block, block, dictionary, last))
+                dictionary = block[-window:]
+                # Write the finished blocks in order, keeping at most 2 blocks per thread in memory
+                while len(pending) > 2 * workers or (last and pending):
+                    f_out.write(pending.pop(0).result())
+                if last:
+                    break
+        f_out.write(struct.pack('<II', crc & 0xffffffff, input_size & 0xffffffff))
+    return output_filepath
+
+def brotli_file(input_filepath, output_filepath, quality=None, block_size=None):
+    """Compress a file with Brotli, which gives smaller JSON transfers than gzip.
+    Requires the `Brotli` package.
+
+    The file is streamed through a `brotli.Compressor` in blocks, so it is never held in memory whole.
+    Quality 11 is several times slower than 9 for a few percent of size, so the files larger than
+    `constants.brotli_large_file_bytes` fall back to `constants.brotli_large_file_quality`.
+
+    :param input_filepath: The file to be compressed
+    :param output_filepath: The file location to create a compressed copy of the input file
+    :param quality: Defaults None. The compression quality (0-11). Falls back to `constants.brotli_quality`,
+        or `constants.brotli_large_file_quality` for large files
+    :param block_size: Defaults None. Bytes read at a time. Falls back to `constants.compression_block_size`
+
+    :returns output_filepath: The compressed file location as a string
+    """
+    import brotli
+
+    if quality is None:
+        large = os.path.getsize(input_filepath) > constants.brotli_large_file_bytes
+        quality = constants.brotli_large_file_quality if large else constants.brotli_quality
+    block_size = block_size or constants.compression_block_size
+    print(f'\nBrotli file (quality {quality}):\n {input_filepath}\n  as\n {output_filepath}')
+    compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=quality)
+    with open(input_filepath, 'rb') as f_in, open(output_filepath, 'wb') as f_out:
+        while True:
+            block = f_in.read(block_size)
+            if not block:
+                break
+            f_out.write(compressor.process(block))
+        f_out.write(compressor.finish())
+    return output_filepath
+
+def compress_files(input_filepaths, gzip=True, brotli=False, workers=None):
+    """Write precompressed variants of a set of files: '<file>.gz' and/or '<file>.br'.
+
+    The levels are taken from `constants.compression_levels` by file name, falling back to
+    `constants.gzip_level` and the Brotli quality of the file size (see `brotli_file`). The Brotli variants are compressed in
+    background threads while the gzip variants are compressed in parallel blocks.
+
+    :param input_filepaths: List of files to compress
+    :param gzip: Bool, defaults True. If True, a gzip variant is written for each file
+    :param brotli: Bool, defaults False. If True, a Brotli variant is written for each file
+    :param workers: Defaults None. Number of threads. Falls back to the number of CPUs
+
+    :returns output_filepaths: A list of the compressed files
+    """
+    workers = workers or os.cpu_count() or 1
+    output_filepaths = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        brotli_jobs = []
+        if brotli:
+            for input_filepath in input_filepaths:
+                levels = constants.compression_levels.get(os.path.basename(input_filepath), {})
+                brotli_jobs.append(executor.submit(
+                    brotli_file,
+                    input_filepath,
+                    input_filepath+'.br',
+                    quality=levels.get('brotli')
+                ))
+        if gzip:
+            for input_filepath in input_filepaths:
+                levels = constants.compression_levels.get(os.path.basename(input_filepath), {})
+                output_filepaths.append(gzip_file(
+                    input_filepath,
+                    input_filepath+'.gz',
+                    level=levels.get('gzip'),
+                    workers=workers
+                ))
+        output_filepaths += [job.result() for job in brotli_jobs]
+    return output_filepaths
@@ -1,3 +1,5 @@
+import os
+
 # PEESE data transformation variables
 peese_csv_url = 'https://raw.githubusercontent.com/PEESEgroup/PEESE-COVID19/master/ny%20cases%20by%20county.csv'
 
@@ -71,6 +73,9 @@ peese_slim_fields = [  # Keep select fields for a "slim" geojson that will resul
     'date',
     'cases',
     'new_cases',
+    'new_cases_avg_7d',
+    'cases_growth_rate',
+    'cases_doubling_days',
     'cases_per_100k',
     'name',
     'state_name',
@@ -79,6 +84,47 @@ peese_slim_fields = [  # Keep select fields for a "slim" geojson that will resul
     'males',
     'females',
     'pop2010',
+    'bbox_west',
+    'bbox_south',
+    'bbox_east',
+    'bbox_north',
+    'label_x',
+    'label_y',
+]
+peese_timeseries_static_fields = [  # Written once per county in the time series geojson
+    'fips',
+    'name',
+    'state_name',
+    'population',
+    'males',
+    'females',
+    'pop2010',
+    'bbox_west',
+    'bbox_south',
+    'bbox_east',
+    'bbox_north',
+    'label_x',
+    'label_y',
+]
+peese_timeseries_series_fields = [  # Written as daily arrays in the time series geojson
+    'cases',
+    'new_cases',
+    'cases_per_100k',
+]
+peese_colormaps = [  # Classified by `colormap.make_colormaps`. The first one is also at the top level of the colormap JSON
+    {'field': 'cases_per_100k', 'bins': 5, 'colormap': 'magma', 'mode': 'equalcount', 'fallback_mode': 'equalinterval'},
+    {'field': 'cases', 'bins': 5, 'colormap': 'magma', 'mode': 'log'},
+    {'field': 'new_cases', 'bins': 5, 'colormap': 'magma', 'mode': 'jenks'},
+    {'field': 'cases_per_100k', 'bins': 5, 'colormap': 'magma', 'mode': 'jenks', 'latest': True},
+]
+peese_by_date_prefix = 'peese/by-date'  # S3 prefix of the per date files, see `date_partitions.write_date_partitions`
+peese_by_date_fields = [  # Written to the per date files, `peese_timeseries_static_fields` are written once with the geometries
+    'cases',
+    'new_cases',
+    'new_cases_avg_7d',
+    'cases_growth_rate',
+    'cases_doubling_days',
+    'cases_per_100k',
 ]
 
 # NYT variables
@@ -94,13 +140,144 @@ nyt_slim_fields = [
     'new_cases',
     'deaths',
     'new_deaths',
+    'new_cases_avg_7d',
+    'new_deaths_avg_7d',
+    'cases_growth_rate',
+    'cases_doubling_days',
+    'deaths_growth_rate',
+    'deaths_doubling_days',
     'state',
     'geometry',
     'cases_per_100k',
     'deaths_per_100k',
+    'bbox_west',
+    'bbox_south',
+    'bbox_east',
+    'bbox_north',
+    'label_x',
+    'label_y',
+]
+nyt_tiles_prefix = 'nyt/tiles'  # S3 prefix of the vector tile pyramid
+nyt_tile_max_zoom = 7
+nyt_tile_fields = [  # Values from the latest day of each county encoded in the vector tiles
+    'fips',
+    'county',
+    'state',
+    'population',
+    'date',
+    'cases',
+    'new_cases',
+    'deaths',
+    'new_deaths',
+    'cases_per_100k',
+    'deaths_per_100k',
+]
+nyt_tile_date_fields = [  # Encoded once per date in the vector tiles as `<field>_<YYYYMMDD>`
+    'cases_per_100k',
+]
+nyt_memory_per_csv_byte = 25  # Estimated bytes in memory per byte of the NYT CSV while it is processed
+nyt_csv_row_bytes = 48  # Average size of a row of the NYT CSV
+nyt_timeseries_static_fields = [
+    'fips',
+    'county',
+    'state',
+    'population',
+    'males',
+    'females',
+    'bbox_west',
+    'bbox_south',
+    'bbox_east',
+    'bbox_north',
+    'label_x',
+    'label_y',
+]
+nyt_timeseries_series_fields = [
+    'cases',
+    'new_cases',
+    'deaths',
+    'new_deaths',
+    'cases_per_100k',
+    'deaths_per_100k',
+]
+nyt_colormaps = [  # Classified by `colormap.make_colormaps`. The first one is also at the top level of the colormap JSON
+    {'field': 'cases_per_100k', 'bins': 10, 'colormap': 'plasma', 'mode': 'equalcount', 'fallback_mode': 'equalinterval'},
+    {'field': 'deaths_per_100k', 'bins': 10, 'colormap': 'plasma', 'mode': 'equalcount', 'fallback_mode': 'equalinterval'},
+    {'field': 'cases', 'bins': 10, 'colormap': 'plasma', 'mode': 'log'},
+    {'field': 'deaths', 'bins': 10, 'colormap': 'plasma', 'mode': 'log'},
+    {'field': 'new_cases', 'bins': 10, 'colormap': 'plasma', 'mode': 'jenks'},
+    {'field': 'cases_per_100k', 'bins': 10, 'colormap': 'plasma', 'mode': 'jenks', 'latest': True},
+    {'field': 'new_cases', 'bins': 10, 'colormap': 'plasma', 'mode': 'jenks', 'latest': True},
+]
+nyt_sketch_fields = list(dict.fromkeys(  # Kept as quantile sketches in the incremental state and by chunked runs, to classify the whole history
+    metric['field'] for metric in nyt_colormaps if not metric.get('latest')
+))
+nyt_chunked_return_fields = list(dict.fromkeys(  # Kept in memory for the latest row of each county when the NYT CSV is processed in chunks
+    ['fips', 'date'] + [metric['field'] for metric in nyt_colormaps if metric.get('latest')]
+))
+nyt_partitions_prefix = 'nyt/partitions'  # S3 prefix of the per state and per county files, see `state_partitions.write_state_partitions`
+nyt_by_date_prefix = 'nyt/by-date'  # S3 prefix of the per date files, see `date_partitions.write_date_partitions`
+nyt_by_date_fields = [  # Written to the per date files, `nyt_timeseries_static_fields` are written once with the geometries
+    'cases',
+    'new_cases',
+    'deaths',
+    'new_deaths',
+    'new_cases_avg_7d',
+    'new_deaths_avg_7d',
+    'cases_growth_rate',
+    'cases_doubling_days',
+    'deaths_growth_rate',
+    'deaths_doubling_days',
+    'cases_per_100k',
+    'deaths_per_100k',
 ]
 
 # Shared variables
+cache_dir = os.path.abspath(os.path.join(  # binary caches of the input data, rebuilt when the inputs change
+    os.path.dirname(__file__),
+    '..',
+    '..',
+    'cache'
+))
+metrics_window = 7  # Days of the rolling metrics. The `_avg_7d` slim fields are named after it
+case_frame_schema = {  # Compact dtypes of the long formatted case frames, see `transforms.apply_schema`
+    'date': 'datetime64[ns]',
+    'fips': 'category',
+    'county': 'category',
+    'state': 'category',
+    'region': 'category',
+    'name': 'category',
+    'state_name': 'category',
+    'cases': 'Int32',
+    'deaths': 'Int32',
+    'new_cases': 'Int32',
+    'new_deaths': 'Int32',
+    'population': 'Int32',
+    'males': 'Int32',
+    'females': 'Int32',
+    'pop2010': 'Int32',
+    'households': 'Int32',
+    'cases_per_100k': 'float32',
+    'deaths_per_100k': 'float32',
+    'new_cases_avg_7d': 'float32',
+    'new_deaths_avg_7d': 'float32',
+    'cases_growth_rate': 'float32',
+    'cases_doubling_days': 'float32',
+    'deaths_growth_rate': 'float32',
+    'deaths_doubling_days': 'float32',
+}
+fetch_timeout = 60  # Seconds to wait for GitHub when fetching the source CSVs
+quantile_sketch_k = 200  # Accuracy of the quantile sketches (~1.3% rank error), see `quantile_sketch.KLLSketch`
+jenks_max_groups = 1000  # Distinct values are merged into at most this many groups before the Jenks breaks are optimized
+geojson_precision = 6  # Decimals of the coordinates written by the 'stream' GeoJSON writer (~0.1 m)
+derived_geometry_fields = [  # Computed once per county geometry and cached, see `counties_cache.load_derived_counties`
+    'bbox_west',
+    'bbox_south',
+    'bbox_east',
+    'bbox_north',
+    'label_x',
+    'label_y',
+]
+
 nyc_counties_fips = [ # FIPS of 5 NYC counties
     '36005',
     '36047',
@@ -111,16 +288,61 @@ nyc_counties_fips = [ # FIPS of 5 NYC counties
 
 nyc_fake_fips = '-9999' # New York City is not a US Census defined place. Set nodata value for FIPS code
 
+# Compression variables
+gzip_level = 9                          # default gzip level (1-9) of the '.gz' outputs
+brotli_quality = 11                     # default Brotli quality (0-11) of the '.br' outputs
+brotli_large_file_quality = 9           # Brotli quality of the outputs larger than `brotli_large_file_bytes`, 11 is too slow for them
+brotli_large_file_bytes = 8 * 1024 * 1024  # size above which `brotli_large_file_quality` is used
+compression_block_size = 4 * 1024 * 1024  # bytes per block when compressing on several cores
+compression_levels = {                  # per artifact overrides of the levels above, by file name
+    'nyt-latest.geojson': {'gzip': 6, 'brotli': 9},  # the largest output, only its compressed copies are published
+}
+
+# Run report variables
+run_report_dir = os.path.abspath(os.path.join(  # JSON reports of the stages of each run, next to the cron logs
+    os.path.dirname(__file__),
+    '..',
+    '..',
+    'logs'
+))
+run_report_tracemalloc = False          # if True, trace Python allocations for the peak of each stage (slows the run)
+run_report_profile = False              # if True, dump a cProfile of each top level stage next to the run report
+
 
 # AWS variables
 s3_bucket = 'covid-19-geojson'          # the bucket to which the geojson will be published
+s3_url = f'https://{s3_bucket}.s3.amazonaws.com'  # public URL of the bucket
+s3_endpoint_url = os.environ.get('S3_ENDPOINT_URL')  # set to use an S3 compatible stand-in instead of AWS
+s3_max_workers = 8                      # files uploaded at the same time
+s3_max_concurrency = 4                  # parts of one file uploaded at the same time
+s3_max_pool_connections = s3_max_workers * s3_max_concurrency
+s3_multipart_chunksize = 16 * 1024 * 1024  # files larger than this are uploaded in parts of this size
+s3_max_attempts = 3                     # tries per file before giving up
+s3_backoff_seconds = 1.0                # wait before the first retry, doubled for every following retry
+s3_digest_metadata_key = 'sha256'       # S3 object metadata (x-amz-meta-sha256) holding the digest of the content
 gzip_extra_args = {                          # these args set the headers and permissions on the s3 object
     'ContentType': 'application/json',  # set content-type: application/json header on GET/HEAD requests
     'ContentEncoding': 'gzip',          # inform clients the content is gzip encoded with content-encoding: gzip header
     'ACL': 'public-read',               # CAUTION!!!!!: allow public read access for object
 }
 
+brotli_extra_args = {
+    'ContentType': 'application/json',
+    'ContentEncoding': 'br',            # inform clients the content is Brotli encoded with content-encoding: br header
+    'ACL': 'public-read',               # CAUTION!!!!!: allow public read access for object
+}
+
 json_extra_args = {
     'ContentType': 'application/json',
     'ACL': 'public-read', # CAUTION!!!! Public file will be created.
+}
+
+mvt_extra_args = {
+    'ContentType': 'application/vnd.mapbox-vector-tile',
+    'ACL': 'public-read', # CAUTION!!!! Public file will be created.
+}
+
+fgb_extra_args = {
+    'ContentType': 'application/flatgeobuf',  # not compressed, so that clients can read byte ranges of the file
+    'ACL': 'public-read', # CAUTION!!!! Public file will be created.
 }
\ No newline at end of file
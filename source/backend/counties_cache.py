@@ -0,0 +1,209 @@
+import os
+import pickle
+import threading
+
+import geopandas
+import pandas as pd
+from shapely import wkb
+
+import constants
+
+
+# The derived counties already loaded by this process, keyed by cache file, so that the pipelines
+# that run in the same process (see `./publish_all.py`) share one copy
+loaded_counties = {}
+loaded_counties_lock = threading.Lock()
+
+def load_counties(counties_geojson, cache_dir=None):
+    """Read the US Census counties GeoJSON, with the column names lower-cased as the pipelines
+    expect, through a binary cache.
+
+    Parsing the national GeoJSON with Fiona is slow, so the first call converts the layer to a
+    pickle of the attribute columns and the geometries as WKB. Later calls load that cache instead,
+    as long as the size and modification time of the source file are unchanged. When the source
+    changes, the cache is rebuilt automatically.
+
+    :param counties_geojson: A GeoJSON formatted GIS file of the US Census Bureau 2018 population estimates.
+    :param cache_dir: Defaults None. Directory of the cache files. Falls back to `constants.cache_dir`
+
+    :returns counties: A GeoDataFrame of the counties
+    """
+    cache_file = cache_filepath(counties_geojson, 'counties', cache_dir)
+    key = source_key(counties_geojson)
+
+    cached = read_cache(cache_file, key)
+    if cached is not None:
+        print(f'\nReading in the counties from the cache:\n {cache_file}')
+        return frame_from_cache(cached['counties'])
+
+    print(f'\nReading in the counties GeoJSON:\n {counties_geojson}')
+    counties = geopandas.read_file(counties_geojson)
+    counties = counties.rename(columns={
+        col: col.lower() for col in counties.columns
+    })
+    counties['fips'] = counties.fips.astype(str)
+
+    print(f'Writing the counties cache:\n {cache_file}')
+    write_cache(cache_file, key, {'counties': frame_to_cache(counties)})
+
+    return counties
+
+def load_derived_counties(counties_geojson, cache_dir=None):
+    """Load the geometries that the pipelines derive from the US Census counties, computing them
+    only when the counties layer changes:
+
+        - 'counties': every county, with the bounding box and label point fields
+        - 'nyt_counties': the counties with the five NYC counties dissolved to one feature that
+          carries the fake FIPS code `constants.nyc_fake_fips`, as the NYT reports NYC as one region
+        - 'states': a dictionary of state name to the FIPS codes of its counties
+
+    The bounding box and label point fields are listed in `constants.derived_geometry_fields`.
+    The label point is a point that is guaranteed to be inside the polygon
+    (`representative_point`), which is where a client should place the county's label or marker.
+
+    The result is also kept in memory, and returned as is by the next calls in the same process,
+    until the counties layer changes. It is shared, so it must not be modified in place.
+
+    :param counties_geojson: A GeoJSON formatted GIS file of the US Census Bureau 2018 population estimates.
+    :param cache_dir: Defaults None. Directory of the cache files. Falls back to `constants.cache_dir`
+
+    :returns derived: A dictionary with the 'counties', 'nyt_counties' and 'states' keys described above
+    """
+    cache_file = cache_filepath(counties_geojson, 'derived', cache_dir)
+    key = source_key(counties_geojson)
+
+    # One thread loads the counties while the others wait for it, rather than each loading its own copy
+    with loaded_counties_lock:
+        loaded = loaded_counties.get(cache_file)
+        if loaded is None or loaded['key'] != key:
+            loaded = loaded_counties[cache_file] = {
+                'key': key,
+                'derived': read_derived_counties(counties_geojson, cache_file, key, cache_dir),
+            }
+    return loaded['derived']
+
+def read_derived_counties(counties_geojson, cache_file, key, cache_dir=None):
+    """Read the derived counties from the binary cache, or compute and cache them (see `load_derived_counties`)"""
+    cached = read_cache(cache_file, key)
+    if cached is not None:
+        print(f'\nReading in the derived county geometries from the cache:\n {cache_file}')
+        return {
+            'counties': frame_from_cache(cached['counties']),
+            'nyt_counties': frame_from_cache(cached['nyt_counties']),
+            'states': cached['states'],
+        }
+
+    counties = load_counties(counties_geojson, cache_dir=cache_dir)
+
+    # Merge the NYC counties into one polygon
+    print(f'\nMerging NYC counties to one polygon for join with NYT data')
+    nyt_counties = counties.copy()
+    nyt_counties['nyc'] = nyt_counties.fips.isin(constants.nyc_counties_fips)
+    nyt_counties.loc[nyt_counties.nyc == True, 'name'] = 'New York City'
+    nyc = nyt_counties.dissolve(by='nyc', aggfunc='sum').reset_index()
+    # Add the same fake fips code to the NYC features to join on using pd.concat
+    nyc['fips'] = constants.nyc_fake_fips
+    nyt_counties = pd.concat(
+        [
+            nyt_counties.loc[~nyt_counties.fips.isin(constants.nyc_counties_fips)],
+            nyc.loc[nyc['nyc'] == True]
+        ]
+    )
+
+    print(f'Computing county bounding boxes and label points')
+    counties = add_geometry_fields(counties)
+    nyt_counties = add_geometry_fields(nyt_counties)
+    states = {
+        state_name: fips.tolist()
+        for state_name, fips in counties.groupby('state_name').fips
+    }
+
+    print(f'Writing the derived county geometries cache:\n {cache_file}')
+    write_cache(cache_file, key, {
+        'counties': frame_to_cache(counties),
+        'nyt_counties': frame_to_cache(nyt_counties),
+        'states': states,
+    })
+
+    return {
+        'counties': counties,
+        'nyt_counties': nyt_counties,
+        'states': states,
+    }
+
+def state_counties(derived, state_name):
+    """Return the counties of one state from the output of `load_derived_counties`"""
+    counties = derived['counties']
+    return counties.loc[counties.fips.isin(derived['states'].get(state_name, []))]
+
+def add_geometry_fields(counties):
+    """Add the bounding box and label point of each geometry as the fields in
+    `constants.derived_geometry_fields`, rounded to `constants.geojson_precision` decimals.
+    """
+    bounds = counties.geometry.bounds
+    label_points = counties.geometry.representative_point()
+    return counties.assign(
+        bbox_west=bounds.minx.values,
+        bbox_south=bounds.miny.values,
+        bbox_east=bounds.maxx.values,
+        bbox_north=bounds.maxy.values,
+        label_x=label_points.x.values,
+        label_y=label_points.y.values,
+    ).round({field: constants.geojson_precision for field in constants.derived_geometry_fields})
+
+def source_key(filepath):
+    """Identify the version of a source file by its location, size and modification time"""
+    source_stat = os.stat(filepath)
+    return {
+        'source': os.path.abspath(filepath),
+        'size': source_stat.st_size,
+        'mtime_ns': source_stat.st_mtime_ns,
+    }
+
+def cache_filepath(source_filepath, kind, cache_dir=None):
+    cache_dir = cache_dir or constants.cache_dir
+    return os.path.join(
+        cache_dir,
+        os.path.splitext(os.path.basename(source_filepath))[0] + f'.{kind}.pickle'
+    )
+
+def read_cache(cache_file, key):
+    """Return the cached dictionary, or None if there is no cache or it was built from another version of the source.
+    A cache that cannot be loaded (truncated, corrupt, or pickled by incompatible library versions) is deleted,
+    so that it is rebuilt.
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as cache:
+            cached = pickle.load(cache)
+        cached_key = cached.get('key')
+    except Exception as e:
+        print(f'\nCache cannot be loaded, deleting it to rebuild it:\n {cache_file}\n {e!r}')
+        os.remove(cache_file)
+        return None
+    if cached_key != key:
+        print(f'\nCache is out of date:\n {cache_file}')
+        return None
+    return cached
+
+def write_cache(cache_file, key, cached):
+    if not os.path.isdir(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    cached = dict(cached, key=key)
+    # Write to a temporary file first, so an interrupted run never leaves a broken cache behind
+    with open(cache_file+'.tmp', 'wb') as cache:
+        pickle.dump(cached, cache, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file+'.tmp', cache_file)
+
+def frame_to_cache(geo_data_frame):
+    """Split a GeoDataFrame into picklable parts: the attributes, the geometries as WKB and the CRS"""
+    return {
+        'crs': geo_data_frame.crs,
+        'attributes': pd.DataFrame(geo_data_frame.drop(columns='geometry')),
+        'wkb': [geom.wkb if geom is not None else None for geom in geo_data_frame.geometry],
+    }
+
+def frame_from_cache(cached):
+    geometry = [wkb.loads(geom) if geom is not None else None for geom in cached['wkb']]
+    return geopandas.GeoDataFrame(cached['attributes'], geometry=geometry, crs=cached['crs'])
@@ -0,0 +1,139 @@
+from fnmatch import fnmatch
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+import constants
+from topojson_writer import write_topojson
+from transforms import make_output_dir, plain_dtypes
+
+
+def write_date_partitions(county_cases, output_dir, fields, url_prefix, static_fields=None, id_field='fips',
+                          date_field='date', shapes=None, write_geometry=True, merge_manifest=False):
+    """Write the long formatted (one row per county per day) cases data as one small JSON file
+    per date, for clients that only show one day at a time (e.g. a time slider), along with a
+    `manifest.json` that lists the dates, their URLs and sizes.
+
+    The county geometries are not repeated in the date files. They are written once, with the
+    `static_fields`, to `counties.topojson`, and each date file holds the `fields` as columns
+    that line up with its `id_field` column, which is the key to join them to the geometries:
+
+        {"date": 1585742400000, "fips": ["36001", ...], "cases": [12, ...], ...}
+
+    :param county_cases: A GeoDataFrame in long format, with the dates in epoch milliseconds.
+        Or an iterable of GeoDataFrames (batches of rows).
+    :param output_dir: Directory on disk where the files are written, e.g. `dist/nyt/by-date`
+    :param fields: List of the fields that change from day to day, written to the date files
+    :param url_prefix: The public URL of `output_dir`, used for the URLs in the manifest
+    :param static_fields: Defaults None. List of the fields that are written once per county,
+        with the geometries
+    :param id_field: Defaults 'fips'. The field that identifies a county
+    :param date_field: Defaults 'date'. The field holding the date of each row (epoch milliseconds)
+    :param shapes: Defaults None. A GeoDataFrame with one row per county, holding the geometry and
+        the `static_fields`. Taken from `county_cases` if None, which is required when
+        `county_cases` is an iterable of batches and `write_geometry` is True.
+    :param write_geometry: Bool, defaults True. If False, the existing geometry file is kept
+        (e.g. when appending new dates)
+    :param merge_manifest: Bool, defaults False. If True, the dates of an existing manifest that
+        are not written by this call are kept in the new manifest (e.g. when appending new dates)
+
+    :returns output_files: A list of the files that were written, with the manifest last
+    """
+    print(f'\nWriting one file per date:\n {output_dir}\n Fields:\n  {fields}')
+    geometry_fields = list(dict.fromkeys([id_field] + list(static_fields or [])))
+    if isinstance(county_cases, pd.DataFrame):
+        if shapes is None:
+            shapes = county_cases.drop_duplicates(id_field)
+        batches = [county_cases]
+    else:
+        batches = county_cases
+    manifest_json = os.path.join(output_dir, 'manifest.json')
+    geometry_file = os.path.join(output_dir, 'counties.topojson')
+    make_output_dir(manifest_json)
+
+    output_files = []
+    if write_geometry:
+        output_files.append(write_topojson(
+            shapes,
+            geometry_file,
+            [field for field in geometry_fields if field != 'geometry'],
+            id_field=id_field
+        ))
+
+    # Rows of a date can come in several batches, so they are collected in a part file per date first. The part
+    # files are in a temporary directory, so that the parts of a crashed run are neither read again nor published
+    if not os.path.isdir(constants.cache_dir):
+        os.makedirs(constants.cache_dir)
+    with tempfile.TemporaryDirectory(prefix='date-parts-', dir=constants.cache_dir) as parts_dir:
+        part_files = {}
+        for batch in batches:
+            batch = plain_dtypes(batch.loc[~batch[id_field].isnull(), [date_field, id_field] + list(fields)], json_values=True)
+            for date, rows in batch.groupby(date_field, sort=True):
+                columns = rows[[id_field] + list(fields)].astype(object)
+                columns = columns.where(~columns.isnull(), None)
+                part_file = part_files.setdefault(int(date), os.path.join(parts_dir, f'{int(date)}.part'))
+                with open(part_file, 'a') as part:
+                    part.write(json.dumps({field: columns[field].tolist() for field in columns.columns}) + '\n')
+
+        dates = {}
+        for date, part_file in sorted(part_files.items()):
+            day = pd.to_datetime(date, unit='ms').strftime('%Y-%m-%d')
+            date_columns = {}
+            with open(part_file, 'r') as part:
+                for line in part:
+                    for field, values in json.loads(line).items():
+                        date_columns.setdefault(field, []).extend(values)
+            # Sort the counties, so that a date file is the same whichever run (full, chunked or incremental) wrote it
+            order = sorted(range(len(date_columns[id_field])), key=date_columns[id_field].__getitem__)
+            date_columns = {field: [values[i] for i in order] for field, values in date_columns.items()}
+
+            date_file = os.path.join(output_dir, f'{day}.json')
+            with open(date_file, 'w') as date_out:
+                json.dump(dict({'date': date}, **date_columns), date_out, separators=(',', ':'))
+            output_files.append(date_file)
+            dates[day] = {
+                'date': date,
+                'day': day,
+                'url': f'{url_prefix}/{day}.json',
+                'bytes': os.path.getsize(date_file),
+                'counties': len(date_columns.get(id_field, [])),
+            }
+
+    if merge_manifest and os.path.isfile(manifest_json):
+        with open(manifest_json, 'r') as manifest_file:
+            previous = json.load(manifest_file)
+        for entry in previous.get('dates', []):
+            if entry['day'] not in dates and os.path.isfile(os.path.join(output_dir, f'{entry["day"]}.json')):
+                dates[entry['day']] = entry
+
+    manifest = {
+        'id_field': id_field,
+        'fields': list(fields),
+        'geometry': {
+            'url': f'{url_prefix}/{os.path.basename(geometry_file)}',
+            'bytes': os.path.getsize(geometry_file) if os.path.isfile(geometry_file) else None,
+            'fields': geometry_fields,
+        },
+        'dates': [dates[day] for day in sorted(dates)],
+    }
+    with open(manifest_json, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    output_files.append(manifest_json)
+    print(f' {len(part_files)} dates written, {len(manifest["dates"])} dates in the manifest')
+
+    return output_files
+
+def date_partition_files(output_dir):
+    """The files of `output_dir` that `write_date_partitions` publishes: the date files, the manifest and
+    the geometry file, with their compressed copies. Anything else in the directory is left out.
+
+    :param output_dir: Directory on disk where the date files were written
+
+    :returns files: A sorted list of the file names
+    """
+    return sorted(
+        file for file in os.listdir(output_dir)
+        if fnmatch(file, '*.json') or fnmatch(file, '*.json.*') or fnmatch(file, 'counties.topojson*')
+    )
@@ -0,0 +1,131 @@
+from collections import namedtuple
+import gzip
+import hashlib
+import json
+import os
+import urllib.error
+import urllib.request
+
+import constants
+
+
+FetchResult = namedtuple(
+    'FetchResult',
+    ['url', 'filepath', 'changed', 'status', 'bytes', 'etag', 'last_modified', 'sha256']
+)
+
+
+def fetch_source(url, cache_dir=None, timeout=None):
+    """Download a source file (e.g. the NYT or PEESE CSV on GitHub) to a local cache, with a
+    conditional request when a copy is already cached.
+
+    The ETag and Last-Modified headers of the last download are kept in a JSON file next to the
+    cached copy and sent back as If-None-Match and If-Modified-Since. When the server answers
+    304 Not Modified, nothing is downloaded and the cached copy is used. The body is requested
+    gzip encoded, and decompressed as it is written to the cache.
+
+    A filepath on disk is returned as is, and is always reported as changed.
+
+    `changed` only compares with the last fetch, which may not have been published (e.g. the run
+    that fetched it failed). To decide whether there is anything to publish, compare `sha256` with
+    the digest of the last published source instead (see `published_sha256`).
+
+    :param url: A URL of the source file (or filepath on disk)
+    :param cache_dir: Defaults None. Directory of the cached copies. Falls back to `constants.cache_dir`
+    :param timeout: Defaults None. Seconds to wait for the server. Falls back to `constants.fetch_timeout`
+
+    :returns result: A `FetchResult`. `filepath` is the local copy to read, `changed` is False when
+        the content is the same as the last fetch, `bytes` is the number of bytes transferred and
+        `sha256` is the digest of the content
+    """
+    if not url.startswith(('http://', 'https://')):
+        return FetchResult(url, url, True, None, 0, None, None, file_sha256(url))
+
+    cache_dir = os.path.join(cache_dir or constants.cache_dir, 'sources')
+    timeout = timeout or constants.fetch_timeout
+    url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    cache_file = os.path.join(cache_dir, f'{url_hash}-{os.path.basename(url.split("?")[0])}')
+    meta_json = cache_file + '.json'
+
+    meta = {}
+    if os.path.isfile(cache_file) and os.path.isfile(meta_json):
+        with open(meta_json, 'r') as meta_file:
+            meta = json.load(meta_file)
+
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+
+    print(f'\nFetching:\n {url}')
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        print(f' 304 Not Modified, using the cached copy:\n {cache_file}')
+        return FetchResult(url, cache_file, False, 304, 0, meta.get('etag'), meta.get('last_modified'), meta.get('sha256'))
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with response:
+        counted = CountingReader(response)
+        body = counted
+        if response.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=counted)
+        digest = hashlib.sha256()
+        # Write to a temporary file first, so a failed download never replaces a good copy
+        with open(cache_file+'.tmp', 'wb') as f_out:
+            for block in iter(lambda: body.read(1024*1024), b''):
+                digest.update(block)
+                f_out.write(block)
+        status = response.status
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+    os.replace(cache_file+'.tmp', cache_file)
+
+    sha256 = digest.hexdigest()
+    changed = sha256 != meta.get('sha256')
+    with open(meta_json, 'w') as meta_file:
+        json.dump({
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'sha256': sha256,
+        }, meta_file, indent=2)
+    print(f' {status}: {counted.bytes} bytes transferred, content {"changed" if changed else "unchanged"}')
+
+    return FetchResult(url, cache_file, changed, status, counted.bytes, etag, last_modified, sha256)
+
+def published_sha256(url, manifest_json):
+    """The digest of the source at `url` that was last published, as recorded in the `sources` of a
+    publish manifest (see `cloud_functions.publish_files_to_s3`) once every file of a publish has been
+    uploaded, or None if it was never published
+
+    :param url: The URL of the source file (or filepath on disk), as given to `fetch_source`
+    :param manifest_json: Filepath of the publish manifest on disk
+    """
+    if not os.path.isfile(manifest_json):
+        return None
+    with open(manifest_json, 'r') as manifest_file:
+        return json.load(manifest_file).get('sources', {}).get(url)
+
+def file_sha256(file_name, block_size=1024*1024):
+    """Return the hex SHA-256 digest of a file, reading it in blocks"""
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f_in:
+        for block in iter(lambda: f_in.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class CountingReader:
+    """Wrap a file-like object and count the bytes read from it"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes += len(data)
+        return data
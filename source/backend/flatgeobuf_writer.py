@@ -0,0 +1,56 @@
+import os
+
+from transforms import make_output_dir, plain_dtypes
+
+
+def write_flatgeobuf(geo_data_frame, output_fgb, fields, id_field='fips', date_field='date'):
+    """Write the latest row of each county to FlatGeobuf (https://flatgeobuf.org), with its spatial index.
+
+    GDAL sorts the features along a Hilbert curve and writes a packed Hilbert R-tree of their
+    bounding boxes in front of them, so that a client can read the index and then only the features
+    in its viewport from S3 with HTTP range requests, rather than the whole file. For the same
+    reason the file must not be compressed. Only the latest day of each county is written, as one
+    feature per county is what a map of the current numbers needs; the history is in the other outputs.
+
+    Requires GDAL 3.1 or newer and Fiona 1.8.18 or newer (see `flatgeobuf_supported`), as pinned in
+    `requirements.txt`. A RuntimeError is raised otherwise, rather than publishing without the file.
+
+    :param geo_data_frame: The GeoDataFrame to write, in long format (one row per county per day),
+        or with one row per county already
+    :param output_fgb: A filepath on disk where the FlatGeobuf will be saved
+    :param fields: List of fields to write, including the 'geometry'
+    :param id_field: Defaults 'fips'. Field that identifies the rows of the same county
+    :param date_field: Defaults 'date'. Field whose largest value is the latest day of a county
+
+    :returns output_fgb: Returns the output FlatGeobuf file location as a string
+    """
+    if not flatgeobuf_supported():
+        import fiona
+        raise RuntimeError(
+            f'Cannot write {output_fgb}: the FlatGeobuf driver needs Fiona 1.8.18+ and GDAL 3.1+ '
+            f'(installed: Fiona {fiona.__version__}, GDAL {fiona.__gdal_version__}). '
+            f'Install the versions of requirements.txt, or turn the `flatgeobuf` option off.'
+        )
+
+    latest = latest_rows(geo_data_frame, id_field, date_field)
+    print(f'\nWriting FlatGeobuf with a spatial index:\n {output_fgb}\n Fields:\n  {fields}\n {latest.shape[0]} features')
+    make_output_dir(output_fgb)
+    # The driver will not overwrite a file
+    if os.path.isfile(output_fgb):
+        os.remove(output_fgb)
+    plain_dtypes(latest[fields]).to_file(output_fgb, driver='FlatGeobuf', SPATIAL_INDEX='YES')
+    return output_fgb
+
+def latest_rows(geo_data_frame, id_field='fips', date_field='date'):
+    """The row of the latest day of each county that has a geometry, ordered by `id_field`"""
+    geo_data_frame = geo_data_frame.loc[~geo_data_frame.geometry.isnull()]
+    return geo_data_frame.sort_values(date_field, kind='mergesort', na_position='first') \
+        .drop_duplicates(id_field, keep='last') \
+        .sort_values(id_field, kind='mergesort')
+
+def flatgeobuf_supported():
+    """True if the GDAL of Fiona can write FlatGeobuf, which was added in GDAL 3.1 (and to Fiona's list of drivers in 1.8.18)"""
+    import fiona
+    with fiona.Env() as env:
+        registered = env.drivers()
+    return 'FlatGeobuf' in registered and 'w' in fiona.supported_drivers.get('FlatGeobuf', '')
@@ -0,0 +1,266 @@
+import gzip
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import mapping
+
+import constants
+from transforms import make_output_dir, plain_dtypes
+
+
+crs84 = {'type': 'name', 'properties': {'name': 'urn:ogc:def:crs:OGC:1.3:CRS84'}}
+
+json_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+
+def write_geojson_file(geo_data_frame, output_geojson, fields=None, writer='fiona', precision=None, id_field='fips'):
+    """Write a GeoDataFrame to GeoJSON with the chosen backend. This is what the pipelines call,
+    so that the backend can be switched without touching the transformation code.
+
+    :param geo_data_frame: The GeoDataFrame to write
+    :param output_geojson: A filepath on disk where the GeoJSON will be saved
+    :param fields: Defaults None. List of fields to write. All fields are written if None.
+    :param writer: Defaults 'fiona'. Either 'fiona' to use `GeoDataFrame.to_file`, or 'stream'
+        to use `write_geojson`
+    :param precision: Defaults None. Number of decimals of the coordinates. Only used by the 'stream' writer.
+    :param id_field: Defaults 'fips'. Field used to cache the geometry. Only used by the 'stream' writer.
+
+    :returns output_geojson: Returns the output geojson file location as a string
+    """
+    if writer == 'fiona':
+        if fields:
+            geo_data_frame = geo_data_frame[fields]
+        plain_dtypes(geo_data_frame).to_file(output_geojson, driver='GeoJSON')
+    elif writer == 'stream':
+        write_geojson(geo_data_frame, output_geojson, fields=fields, precision=precision, id_field=id_field)
+    else:
+        raise ValueError(f'Unknown GeoJSON writer: {writer}')
+    return output_geojson
+
+def write_geojson(batches, output_geojson, fields=None, precision=None, id_field='fips', name=None):
+    """Stream a GeoDataFrame, or an iterable of GeoDataFrames (batches of rows), to a GeoJSON
+    FeatureCollection without going through Fiona/OGR.
+
+    The rows are written as they come, so only the current batch has to be held in memory.
+    The geometry of each `id_field` value is serialized once and reused for the following rows
+    with the same value, which is most of the work for the long formatted cases data (one row
+    per county per day). The layout of the file matches the one written by
+    `GeoDataFrame.to_file(..., driver='GeoJSON')`, with one feature per line.
+
+    :param batches: A GeoDataFrame, or an iterable of GeoDataFrames with the same columns
+    :param output_geojson: A filepath on disk where the GeoJSON will be saved
+    :param fields: Defaults None. List of fields to write as properties (a 'geometry' entry is ignored).
+        All fields except the geometry are written if None.
+    :param precision: Defaults None. Number of decimals to round the coordinates to. Full precision if None.
+    :param id_field: Defaults 'fips'. Rows with the same value in this field are expected to have the
+        same geometry. If None, the geometry of every row is serialized.
+    :param name: Defaults None. Name of the collection. The output file name (without extension) if None.
+
+    :returns output_geojson: Returns the output geojson file location as a string
+    """
+    print(f'\nStreaming GeoJSON:\n {output_geojson}')
+    if isinstance(batches, pd.DataFrame):
+        batches = [batches]
+    if name is None:
+        name = os.path.splitext(os.path.basename(output_geojson))[0]
+
+    make_output_dir(output_geojson)
+
+    geometry_cache = {}
+    feature_count = 0
+    with open(output_geojson, 'w', encoding='utf-8', buffering=1024*1024) as geojson_file:
+        geojson_file.write(collection_header(name))
+        for batch in batches:
+            features = serialize_features(batch, fields, precision, id_field, geometry_cache)
+            if not features:
+                continue
+            if feature_count:
+                geojson_file.write(',\n')
+            geojson_file.write(',\n'.join(features))
+            feature_count += len(features)
+        geojson_file.write(collection_footer())
+    print(f' {feature_count} features written')
+
+    return output_geojson
+
+def write_geojson_artifacts(batches, artifacts, precision=None, id_field='fips', gzip_output=False):
+    """Write several GeoJSON artifacts of the same rows in a single pass, e.g. the full and the
+    slim outputs of a pipeline together with their g-zipped copies.
+
+    Each row is converted and its geometry serialized once, then the feature is fanned out to
+    every artifact with that artifact's subset of the properties. When `gzip_output` is True,
+    every artifact is compressed inline as it is written (a tee to the plain file and to the
+    '.gz' file), so nothing is read back from disk.
+
+    :param batches: A GeoDataFrame, or an iterable of GeoDataFrames with the same columns
+    :param artifacts: A dictionary of output filepath to the list of fields of that output.
+        A value of None writes all fields.
+    :param precision: Defaults None. Number of decimals to round the coordinates to. Full precision if None.
+    :param id_field: Defaults 'fips'. Rows with the same value in this field share the serialized geometry.
+    :param gzip_output: Bool, defaults False. If True, each output is also written as '<output>.gz'
+
+    :returns output_files: A list of the files that were written
+    """
+    if isinstance(batches, pd.DataFrame):
+        batches = [batches]
+
+    sinks = [
+        GeoJSONSink(output_geojson, fields=fields, gzip_output=gzip_output)
+        for output_geojson, fields in artifacts.items()
+    ]
+    geometry_cache = {}
+    try:
+        for batch in batches:
+            if batch.shape[0] == 0:
+                continue
+            all_fields = [field for field in batch.columns if field != 'geometry']
+            records = property_records(batch, all_fields)
+            geometries = serialize_geometries(batch, precision, id_field, geometry_cache)
+            for sink in sinks:
+                sink.write_features(records, geometries)
+    finally:
+        for sink in sinks:
+            sink.close()
+
+    output_files = []
+    for sink in sinks:
+        output_files += sink.output_files
+    return output_files
+
+class GeoJSONSink:
+    """One GeoJSON output of `write_geojson_artifacts`. Features are written to the plain file,
+    and to a g-zipped copy at the same time if requested.
+    """
+    def __init__(self, output_geojson, fields=None, gzip_output=False, name=None):
+        print(f'\nStreaming GeoJSON:\n {output_geojson}')
+        if fields is not None:
+            fields = [field for field in fields if field != 'geometry']
+            print(f' Fields:\n  {fields}')
+        if name is None:
+            name = os.path.splitext(os.path.basename(output_geojson))[0]
+        make_output_dir(output_geojson)
+
+        self.fields = fields
+        self.feature_count = 0
+        self.output_files = [output_geojson]
+        self.streams = [open(output_geojson, 'wb', buffering=1024*1024)]
+        if gzip_output:
+            print(f' and g-zipped as:\n {output_geojson}.gz')
+            self.output_files.append(output_geojson+'.gz')
+            # A fixed mtime keeps the bytes identical when the content is, so unchanged files can be skipped
+            level = constants.compression_levels.get(os.path.basename(output_geojson), {}).get('gzip', constants.gzip_level)
+            self.streams.append(gzip.GzipFile(output_geojson+'.gz', 'wb', compresslevel=level, mtime=0))
+        self.write(collection_header(name))
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        for stream in self.streams:
+            stream.write(data)
+
+    def write_features(self, records, geometries):
+        if self.fields is None:
+            properties = [json_encoder.encode(record) for record in records]
+        else:
+            properties = [
+                json_encoder.encode({field: record[field] for field in self.fields}) for record in records
+            ]
+        features = ',\n'.join(
+            f'{{"type":"Feature","properties":{row_properties},"geometry":{geometry}}}'
+            for row_properties, geometry in zip(properties, geometries)
+        )
+        if self.feature_count:
+            features = ',\n' + features
+        self.write(features)
+        self.feature_count += len(properties)
+
+    def close(self):
+        if self.streams[0].closed:
+            return
+        self.write(collection_footer())
+        for stream in self.streams:
+            stream.close()
+        print(f' {self.feature_count} features written to {os.path.basename(self.output_files[0])}')
+
+def collection_header(name):
+    return (
+        '{\n"type": "FeatureCollection",\n'
+        f'"name": {json_encoder.encode(name)},\n'
+        f'"crs": {json_encoder.encode(crs84)},\n'
+        '"features": [\n'
+    )
+
+def collection_footer():
+    return '\n]\n}\n'
+
+def serialize_features(batch, fields, precision, id_field, geometry_cache):
+    """Serialize the rows of a GeoDataFrame to GeoJSON Feature strings
+
+    :param geometry_cache: A dictionary of `id_field` value to serialized geometry that is
+        updated in place, so that it can be shared by the batches of one file
+
+    :returns features: A list of strings, one per row
+    """
+    if fields is None:
+        fields = [field for field in batch.columns if field != 'geometry']
+    else:
+        fields = [field for field in fields if field != 'geometry']
+
+    properties = [json_encoder.encode(row) for row in property_records(batch, fields)]
+    geometries = serialize_geometries(batch, precision, id_field, geometry_cache)
+
+    return [
+        f'{{"type":"Feature","properties":{row_properties},"geometry":{geometry}}}'
+        for row_properties, geometry in zip(properties, geometries)
+    ]
+
+def serialize_geometries(batch, precision, id_field, geometry_cache):
+    """Serialize the geometries of a GeoDataFrame to GeoJSON strings (see `serialize_geometry`).
+    The rows of a time series repeat the geometry of their county, so each geometry is serialized
+    once per `id_field` value and looked up in `geometry_cache` for the other rows.
+
+    :param id_field: The column that identifies the geometry of a row. If None, every geometry is serialized.
+    :param geometry_cache: A dictionary of `id_field` value to serialized geometry, updated in place
+
+    :returns geometries: A list of strings, one per row
+    """
+    if id_field is None:
+        return [serialize_geometry(geometry, precision) for geometry in batch.geometry]
+
+    geometries = []
+    for key, geometry in zip(batch[id_field], batch.geometry):
+        serialized = geometry_cache.get(key)
+        if serialized is None:
+            serialized = geometry_cache[key] = serialize_geometry(geometry, precision)
+        geometries.append(serialized)
+    return geometries
+
+def property_records(batch, fields):
+    """Convert the `fields` of a DataFrame to a list of dictionaries of Python scalars, with None
+    in place of missing values, in one pass per column rather than per value. Compact dtypes are
+    converted first (see `transforms.plain_dtypes`).
+    """
+    properties = plain_dtypes(batch[fields], json_values=True).astype(object)
+    properties = properties.where(~properties.isnull(), None)
+    return properties.to_dict('records')
+
+def serialize_geometry(geometry, precision=None):
+    """Serialize a shapely geometry to a GeoJSON string, optionally rounding the coordinates"""
+    if geometry is None or geometry.is_empty:
+        return 'null'
+    geojson = mapping(geometry)
+    if precision is not None:
+        geojson = {
+            'type': geojson['type'],
+            'coordinates': round_coordinates(geojson['coordinates'], precision),
+        }
+    return json_encoder.encode(geojson)
+
+def round_coordinates(coordinates, precision):
+    """Round nested coordinate sequences. Rings are rounded as one NumPy array each."""
+    if len(coordinates) and isinstance(coordinates[0], (int, float)):
+        return [round(value, precision) for value in coordinates]
+    if len(coordinates) and isinstance(coordinates[0][0], (int, float)):
+        return np.round(np.asarray(coordinates, dtype=float), precision).tolist()
+    return [round_coordinates(part, precision) for part in coordinates]
@@ -0,0 +1,185 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import json
+import os
+import platform
+import threading
+import time
+import tracemalloc
+
+import constants
+
+
+run_records = []  # The measurements of the stages of this run, in the order that they finished
+run_records_lock = threading.Lock()
+stage_stack = threading.local()  # The stages that are being measured in each thread, outermost first
+can_reset_traced_peak = hasattr(tracemalloc, 'reset_peak')  # tracemalloc.reset_peak was added in Python 3.9
+
+
+def start_run():
+    """Clear the measurements of a previous run in this process, and start tracing the Python
+    allocations if `constants.run_report_tracemalloc` is True"""
+    with run_records_lock:
+        del run_records[:]
+    if constants.run_report_tracemalloc and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+@contextmanager
+def measure(name, rows=None):
+    """Measure a stage of a pipeline, as a `with` block:
+
+        with measure('write geojson') as stage:
+            ...
+            stage['rows'] = county_cases.shape[0]
+            add_bytes_written(stage, [output_geojson])
+
+    The wall time, the CPU time of the process, the peak RSS of the process at the end of the
+    stage, and the peak of the traced Python allocations (if tracemalloc is tracing, see `start_run`)
+    are recorded, along with the counts that the block sets on the yielded record: 'rows',
+    'bytes_written' and 'bytes_uploaded'. A stage that is measured within another is named after
+    both, e.g. 'nyt:build/write geojson', and its bytes are added to the outer stage too. If
+    `constants.run_report_profile` is True, each top level stage is also profiled with cProfile
+    (see `dump_profile`).
+
+    On Python 3.8, which cannot reset the peak of the traced allocations, the traced peak of a stage is
+    the peak since tracing started (an upper bound of the peak of the stage) unless tracing is started
+    with the stage, as `bench_pipeline` does.
+
+    The CPU time and the peaks are those of the process, so they include the stages that run at the
+    same time in other threads. Run one source per process (see `pipeline.run_stages_by_source`)
+    to keep them apart.
+
+    :param name: The name of the stage
+    :param rows: Defaults None. The number of rows that the stage processes, if known up front
+
+    :yields record: The dictionary of the measurements, appended to `run_records` when the block exits
+    """
+    frames = stage_stack.__dict__.setdefault('frames', [])
+    record = {
+        'stage': '/'.join([frame['name'] for frame in frames] + [name]),
+        'pid': os.getpid(),
+        'thread': threading.current_thread().name,
+        'start': datetime.now().isoformat(),
+        'wall_seconds': None,
+        'cpu_seconds': None,
+        'peak_rss_mb': None,
+        'tracemalloc_peak_mb': None,
+        'rows': rows,
+        'bytes_written': 0,
+        'bytes_uploaded': 0,
+        'error': None,
+    }
+    frame = {'name': name, 'record': record, 'traced_peak': 0}
+    if tracemalloc.is_tracing() and can_reset_traced_peak:
+        # The peak can only be reset for everyone, so the peak before this stage is handed to the outer stage
+        if frames:
+            frames[-1]['traced_peak'] = max(frames[-1]['traced_peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile() if constants.run_report_profile and not frames else None
+    frames.append(frame)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+        frames.pop()
+        record['wall_seconds'] = round(time.perf_counter() - start_wall, 3)
+        record['cpu_seconds'] = round(time.process_time() - start_cpu, 3)
+        record['peak_rss_mb'] = peak_rss_mb()
+        if tracemalloc.is_tracing():
+            traced_peak = max(frame['traced_peak'], tracemalloc.get_traced_memory()[1])
+            record['tracemalloc_peak_mb'] = round(traced_peak / 1024**2, 1)
+            if frames:
+                frames[-1]['traced_peak'] = max(frames[-1]['traced_peak'], traced_peak)
+        if frames:
+            frames[-1]['record']['bytes_written'] += record['bytes_written']
+            frames[-1]['record']['bytes_uploaded'] += record['bytes_uploaded']
+        if profiler:
+            record['profile'] = dump_profile(profiler, record['stage'])
+        with run_records_lock:
+            run_records.append(record)
+
+def add_run_records(records):
+    """Add the measurements of stages that ran in another process (see `pipeline.run_stages_by_source`)"""
+    with run_records_lock:
+        run_records.extend(records)
+
+def add_bytes_written(record, files):
+    """Add the sizes of the files that a stage wrote to its record. Missing files (None, or outputs
+    that were not requested) are skipped.
+
+    :returns bytes_written: The bytes written by the stage so far
+    """
+    record['bytes_written'] += sum(os.path.getsize(file) for file in files if file and os.path.isfile(file))
+    return record['bytes_written']
+
+def peak_rss_mb():
+    """The peak resident memory of the process so far, in MB, or None where `resource` is not available"""
+    try:
+        import resource
+        # ru_maxrss is in kilobytes on Linux
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    except ImportError:
+        return None
+
+def dump_profile(profiler, stage_name, report_dir=None):
+    """Write the cProfile stats of a stage to `<report_dir>/profiles/<stage>-<pid>.prof`, which can be
+    read with `pstats` or a viewer such as snakeviz
+
+    :returns profile_file: The profile file location as a string
+    """
+    profile_dir = os.path.join(report_dir or constants.run_report_dir, 'profiles')
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    safe_name = ''.join(char if char.isalnum() or char in '-_' else '-' for char in stage_name)
+    profile_file = os.path.join(profile_dir, f'{safe_name}-{os.getpid()}.prof')
+    profiler.dump_stats(profile_file)
+    return profile_file
+
+def write_run_report(script, start_time, records=None, report_dir=None):
+    """Write the measurements of a run to `<report_dir>/<script>_<start time>.json`, named like the cron logs:
+
+        {"script": "publish_all", "start": "...", "end": "...", "stages": [{"stage": "nyt:build", ...}, ...]}
+
+    :param script: The name of the script that ran, e.g. 'publish_nyt_geojson'
+    :param start_time: The datetime at which the run started
+    :param records: Defaults None. The stage records. Falls back to `run_records`
+    :param report_dir: Defaults None. Directory of the reports. Falls back to `constants.run_report_dir`
+
+    :returns report_json: The report file location as a string
+    """
+    report_dir = report_dir or constants.run_report_dir
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    report_json = os.path.join(report_dir, f'{script}_{start_time.strftime("%Y-%m-%d_%H%M%S")}.json')
+    with run_records_lock:
+        records = list(run_records if records is None else records)
+
+    print(f'\n{"Stage":<48}{"Wall s":>9}{"CPU s":>9}{"Peak MB":>9}{"Rows":>10}{"Written MB":>12}{"Uploaded MB":>13}')
+    for record in records:
+        print(
+            f'{record["stage"][:46]:<48}{record["wall_seconds"]:>9.2f}{record["cpu_seconds"]:>9.2f}'
+            f'{record["peak_rss_mb"] or 0:>9.1f}{record["rows"] if record["rows"] is not None else "":>10}'
+            f'{record["bytes_written"] / 1e6:>12.2f}{record["bytes_uploaded"] / 1e6:>13.2f}'
+        )
+
+    print(f'\nWriting the run report:\n {report_json}')
+    with open(report_json, 'w') as report_file:
+        json.dump({
+            'script': script,
+            'start': start_time.isoformat(),
+            'end': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'tracemalloc': tracemalloc.is_tracing(),
+            'stages': records,
+        }, report_file, indent=2)
+    return report_json
@@ -1,51 +1,258 @@
-from datetime import datetime, timedelta
-import gzip
+from datetime import timedelta
+import json
 import os
-import shutil
+import tempfile
 
 import geopandas
+import numpy as np
 import pandas as pd
-from shapely.geometry import mapping
 
 import constants
-from make_peese_geojson import gzip_geojson
+from counties_cache import load_derived_counties
+from date_partitions import write_date_partitions
+from flatgeobuf_writer import latest_rows, write_flatgeobuf
+from geojson_writer import serialize_features, write_geojson_artifacts, write_geojson_file
+from instrumentation import add_bytes_written, measure
+from metrics import add_time_series_metrics
+from partitions import batch_partitions, partition_csv
+from quantile_sketch import KLLSketch, update_sketches
+from state_partitions import write_state_partitions
+from timeseries_geojson import write_timeseries_geojson
+from topojson_writer import write_topojson
+from transforms import (add_per_100k, apply_schema, compress_outputs, epoch_milliseconds, make_output_dir, parse_dates,
+                        report_memory)
+from vector_tiles import make_vector_tiles
 
 
-def merge_nyt_with_census(csv_url, counties_geojson, output_geojson, slim_output=None, gzip=False):
-    print(f'\nReading in the NYT cases data:\n {csv_url}')
-    cases_df = pd.read_csv(csv_url, dtype={'fips': str})
-    cases_df.loc[cases_df.county == 'New York City', 'fips'] = constants.nyc_fake_fips
-    cases_df.date = pd.to_datetime(cases_df.date)
-    cases_df = cases_df.assign(date=lambda x: cases_df.date + timedelta(hours=12))
-
-    cases_df = cases_df.sort_values(['fips', 'date'])
-    cases_df = cases_df.set_index(['date', 'county', 'state', 'fips'])
-    cases_df = cases_df.assign(new_cases=cases_df.cases.diff().fillna(0).astype(int))
-    cases_df = cases_df.assign(new_deaths=cases_df.deaths.diff().fillna(0).astype(int))
-    cases_df = cases_df.reset_index()
-    cases_df.loc[cases_df.new_cases <  0, 'new_cases'] = 0
-    cases_df.loc[cases_df.new_cases <  0, 'new_deaths'] = 0
-
-    print(f'\nReading in the counties GeoJSON:\n {counties_geojson}')
-    counties = geopandas.read_file(counties_geojson)
-    counties = counties.rename(columns={
-        col: col.lower() for col in counties.columns
-    })
-
-    # Merge the NYC counties into one polygon
-    print(f'\nMerging NYC counties to one polygon for join with NYT data')
-    counties['nyc'] = counties.fips.isin(constants.nyc_counties_fips)
-    counties.loc[counties.nyc == True, 'name'] = 'New York City'
-    nyc = counties.dissolve(by='nyc', aggfunc='sum').reset_index()
-    # Add the same fake fips code to the NYC features to join on using pd.concat
-    nyc['fips'] = constants.nyc_fake_fips
-    counties_nyc = pd.concat(
-        [
-            counties.loc[~counties.fips.isin(constants.nyc_counties_fips)],
-            nyc.loc[nyc['nyc'] == True]
-        ]
-    )
+def prep_nyt_counties(counties_geojson):
+    """Read the US Census counties with the five NYC counties merged into a single
+    feature, since the NYT reports New York City as one region. The dissolve, and the
+    bounding box and label point fields, are cached between runs (see `load_derived_counties`).
+
+    :param counties_geojson: A GeoJSON formatted GIS file of the US Census Bureau 2018 population estimates.
+
+    :return counties_nyc: A GeoDataFrame of the counties with NYC dissolved to one polygon
+        that carries the fake FIPS code `constants.nyc_fake_fips`
+    """
+    return load_derived_counties(counties_geojson)['nyt_counties']
+
+def merge_nyt_with_census(csv_url, counties_geojson, output_geojson, slim_output=None, gzip=False, state_json=None,
+                          timeseries_output=None, topojson_output=None, geojson_writer='fiona', brotli=False,
+                          max_memory_mb=None, by_date_dir=None, partitions_dir=None, flatgeobuf_output=None,
+                          tiles_dir=None):
+    """Merge the NYT COVID data with the US Census Bureau 2018 County Data (including population)
+
+    :param csv_url: A URL pointing to the raw NYT `us-counties.csv` on GitHub (or filepath on disk)
+    :param counties_geojson: A GeoJSON formatted GIS file of the US Census Bureau 2018 population estimates.
+    :param output_geojson: A filepath on disk where the merged GeoJSON will be saved
+    :param slim_output: Defaults None. If value is given, a GeoJSON with only the fields in
+        `constants.nyt_slim_fields` is saved to this filepath
+    :param gzip: Bool, defaults False. If True, g-zipped versions of the outputs will also be produced.
+    :param state_json: Defaults None. If value is given, it should be a filepath to disk where the last
+        processed date and cumulative counts of every county are kept between runs. When the state file
+        and the outputs already exist, only the dates newer than the state are processed and appended to
+        the existing outputs (see `append_nyt_with_census`). Otherwise the full history is processed and
+        the state file is (re)created, with the quantile sketches that the appends need to classify the whole history.
+    :param timeseries_output: Defaults None. If value is given, a GeoJSON with one feature per county and
+        the daily values stored as arrays (see `write_timeseries_geojson`) is saved to this filepath.
+        The time series is only written when the full history is processed.
+    :param topojson_output: Defaults None. If value is given, the fields in `constants.nyt_slim_fields` are
+        saved to this filepath as TopoJSON (see `write_topojson`). Only written when the full history is processed.
+    :param geojson_writer: Defaults 'fiona'. The backend that writes the GeoJSON outputs, either 'fiona'
+        (`GeoDataFrame.to_file`) or 'stream', which writes the full and slim outputs and their
+        g-zipped copies in a single pass (see `geojson_writer.write_geojson_artifacts`)
+    :param brotli: Bool, defaults False. If True, Brotli compressed versions ('.br') of the outputs will also
+        be produced. Requires the `Brotli` package.
+    :param max_memory_mb: Defaults None. If value is given, the CSV is processed in partitions that fit in
+        about this much memory, instead of all at once (see `chunked_nyt_with_census`). The outputs are
+        the same, always written with the 'stream' writer.
+    :param by_date_dir: Defaults None. If value is given, the `constants.nyt_by_date_fields` of each date are
+        saved to a small JSON file in this directory, along with the county geometries and a manifest of the
+        dates (see `write_date_partitions`). New dates are added to it by the incremental runs.
+    :param partitions_dir: Defaults None. If value is given, a time series GeoJSON per state and a compact
+        time series JSON per county are saved in this directory, with an index of the files
+        (see `write_state_partitions`). Only written when the full history is processed.
+    :param flatgeobuf_output: Defaults None. If value is given, the `constants.nyt_slim_fields` of the latest
+        day of each county are saved to this filepath as FlatGeobuf, with a spatial index for bounding box
+        range requests (see `write_flatgeobuf`). Only written when the full history is processed.
+    :param tiles_dir: Defaults None. Only used with `max_memory_mb`. If value is given, the vector tiles are
+        built from the batches while they are on disk (see `make_nyt_tiles`), as the returned frame
+        then only holds the latest day of each county. Their files are in its `attrs['tile_files']`.
+
+    :returns county_cases: A GeoDataFrame of the rows that were written by this run, sorted by county and date.
+        When the history is processed in chunks, only the latest row of each county (see `chunked_nyt_with_census`).
+        The quantile sketches of the whole history are in its `attrs['sketches']` when it does not hold all of the rows.
+    """
+    if state_json and os.path.isfile(state_json) and os.path.isfile(output_geojson):
+        if (not slim_output or os.path.isfile(slim_output)) and \
+                (not by_date_dir or os.path.isfile(os.path.join(by_date_dir, 'manifest.json'))):
+            return append_nyt_with_census(
+                csv_url,
+                counties_geojson,
+                output_geojson,
+                state_json,
+                slim_output=slim_output,
+                gzip=gzip,
+                brotli=brotli,
+                by_date_dir=by_date_dir,
+                geojson_writer=geojson_writer
+            )
+
+    if max_memory_mb:
+        return chunked_nyt_with_census(
+            csv_url,
+            counties_geojson,
+            output_geojson,
+            max_memory_mb,
+            slim_output=slim_output,
+            gzip=gzip,
+            state_json=state_json,
+            timeseries_output=timeseries_output,
+            topojson_output=topojson_output,
+            brotli=brotli,
+            by_date_dir=by_date_dir,
+            partitions_dir=partitions_dir,
+            flatgeobuf_output=flatgeobuf_output,
+            tiles_dir=tiles_dir
+        )
+
+    with measure('read csv') as stage:
+        print(f'\nReading in the NYT cases data:\n {csv_url}')
+        cases_df = pd.read_csv(csv_url, dtype={'fips': str})
+        cases_df = prep_nyt_cases(cases_df)
+        stage['rows'] = cases_df.shape[0]
+
+    with measure('merge') as stage:
+        counties_nyc = prep_nyt_counties(counties_geojson)
+        county_cases = merge_nyt_cases(cases_df, counties_nyc)
+        stage['rows'] = county_cases.shape[0]
+
+    if state_json:
+        with measure('state') as stage:
+            sketches = update_sketches({}, county_cases, constants.nyt_sketch_fields)
+            write_nyt_state(cases_df, state_json, sketches=sketches)
+            add_bytes_written(stage, [state_json])
+
+    with measure('geojson', rows=county_cases.shape[0]) as stage:
+        print(f'\nWriting NYT GIS data to GeoJSON:\n {output_geojson}')
+        make_output_dir(output_geojson)
+        if geojson_writer == 'stream':
+            # Serialize each feature once for all of the outputs, and gzip them as they are written
+            artifacts = {output_geojson: None}
+            if slim_output:
+                artifacts[slim_output] = constants.nyt_slim_fields
+            write_geojson_artifacts(
+                county_cases,
+                artifacts,
+                precision=constants.geojson_precision,
+                gzip_output=gzip
+            )
+        else:
+            write_geojson_file(
+                county_cases,
+                output_geojson,
+                writer=geojson_writer
+            )
+
+        if slim_output and geojson_writer != 'stream':
+            print(f'\nWriting NYT GIS data to GeoJSON with slim fields')
+            print(f' {slim_output}\n Slim Fields:\n  {constants.nyt_slim_fields}')
+            write_geojson_file(
+                county_cases,
+                slim_output,
+                fields=constants.nyt_slim_fields,
+                writer=geojson_writer
+            )
+        geojson_files = [output_geojson, slim_output]
+        add_bytes_written(stage, geojson_files + [f'{file}.gz' for file in geojson_files if file and gzip])
+
+    if timeseries_output:
+        with measure('time series') as stage:
+            write_timeseries_geojson(
+                county_cases,
+                timeseries_output,
+                constants.nyt_timeseries_static_fields,
+                constants.nyt_timeseries_series_fields
+            )
+            add_bytes_written(stage, [timeseries_output])
+
+    if topojson_output:
+        with measure('topojson') as stage:
+            write_topojson(
+                county_cases,
+                topojson_output,
+                [field for field in constants.nyt_slim_fields if field != 'geometry']
+            )
+            add_bytes_written(stage, [topojson_output])
+
+    if flatgeobuf_output:
+        with measure('flatgeobuf') as stage:
+            write_flatgeobuf(county_cases, flatgeobuf_output, constants.nyt_slim_fields)
+            add_bytes_written(stage, [flatgeobuf_output])
+
+    by_date_files = []
+    if by_date_dir:
+        with measure('by date') as stage:
+            by_date_files = write_date_partitions(
+                county_cases,
+                by_date_dir,
+                constants.nyt_by_date_fields,
+                f'{constants.s3_url}/{constants.nyt_by_date_prefix}',
+                static_fields=constants.nyt_timeseries_static_fields
+            )
+            add_bytes_written(stage, by_date_files)
 
+    partition_files = []
+    if partitions_dir:
+        with measure('partitions') as stage:
+            partition_files = write_state_partitions(
+                county_cases,
+                partitions_dir,
+                f'{constants.s3_url}/{constants.nyt_partitions_prefix}',
+                constants.nyt_timeseries_static_fields,
+                constants.nyt_by_date_fields
+            )
+            add_bytes_written(stage, partition_files)
+
+    # The 'stream' writer g-zips the GeoJSON outputs as it writes them
+    with measure('compress') as stage:
+        compressed_files = compress_outputs(
+            [output_geojson, slim_output, timeseries_output, topojson_output] + by_date_files + partition_files,
+            gzip=gzip,
+            brotli=brotli,
+            gzipped=[output_geojson, slim_output] if geojson_writer == 'stream' else []
+        )
+        add_bytes_written(stage, compressed_files)
+
+    return county_cases
+
+def prep_nyt_cases(cases_df):
+    """Prepare rows of the NYT `us-counties.csv`: set the fake FIPS code of NYC, parse the dates,
+    apply the compact dtypes, and calculate the new cases and the metrics of each county.
+
+    :param cases_df: A DataFrame of rows of the NYT CSV, read with the `fips` column as strings.
+        All of the rows of a county are expected to be in the frame.
+
+    :returns cases_df: The prepared DataFrame, sorted by county and date
+    """
+    cases_df = set_nyc_fips(cases_df)
+    cases_df = cases_df.assign(date=parse_dates(cases_df.date))
+    report_memory('the NYT cases', cases_df)
+    cases_df = apply_schema(cases_df)
+    report_memory('the NYT cases with compact dtypes', cases_df)
+
+    print(f'\nCalculating new cases and the {constants.metrics_window} day metrics of each county')
+    return apply_schema(add_time_series_metrics(cases_df, ['cases', 'deaths']))
+
+def merge_nyt_cases(cases_df, counties_nyc):
+    """Join the prepared NYT cases to the county shapes and census data, add the per 100k rates,
+    and convert the dates to epoch milliseconds.
+
+    :param cases_df: A DataFrame returned by `prep_nyt_cases`
+    :param counties_nyc: A GeoDataFrame returned by `prep_nyt_counties`
+
+    :returns county_cases: A GeoDataFrame of the rows with a geometry and a date, sorted by county and date
+    """
     # join cases to shapes using FIPS fields
     print(f'\nMerging NYT data with census data')
     county_cases = counties_nyc.merge(cases_df, how='outer', on='fips')
@@ -54,35 +261,489 @@ def merge_nyt_with_census(csv_url, counties_geojson, output_geojson, slim_output
     # TODO: for now, throw out rows with no geometry or date
     county_cases = county_cases.loc[~county_cases.geometry.isnull()]
     county_cases = county_cases.loc[~county_cases.date.isnull()]
+    # The order of the outer merge depends on the pandas version, so sort the rows explicitly. A chunked
+    # run processes the partitions in the same FIPS order, and writes the features in the same order.
+    county_cases = county_cases.sort_values(['fips', 'date'], kind='mergesort')
 
     print(f'\nCreating fields for # Cases normalized by population')
     # Calculate cases per 100k people
-    county_cases['cases_per_100k'] = ((county_cases.cases/county_cases.population) * 100000).apply(lambda x: round(x, 3))
-    county_cases['deaths_per_100k'] = ((county_cases.deaths/county_cases.population) * 100000).apply(lambda x: round(x, 3))
+    county_cases = add_per_100k(county_cases, ['cases', 'deaths'])
+    report_memory('the merged NYT data', county_cases)
+    county_cases = apply_schema(county_cases)
+    report_memory('the merged NYT data with compact dtypes', county_cases)
 
-    print(f'\nWriting NYT GIS data to GeoJSON:\n {output_geojson}')
-    county_cases = county_cases.assign(date=(
-        (county_cases.date - datetime(1970, 1, 1)).dt.total_seconds() * 1000).apply(int)
-    )
-    if not os.path.isdir(os.path.dirname(output_geojson)):
-        os.makedirs(os.path.dirname(output_geojson))
-        print(f'  Created output dir: {os.path.dirname(output_geojson)}')
-    county_cases.to_file(output_geojson, driver='GeoJSON')
-
-    if slim_output:
-        print(f'\nWriting NYT GIS data to GeoJSON with slim fields')
-        print(f' {slim_output}\n Slim Fields:\n  {constants.nyt_slim_fields}')
-        county_cases[constants.nyt_slim_fields].to_file(slim_output, driver='GeoJSON')
-
-    if gzip:
-        gzip_geojson(
-            output_geojson,
-            output_geojson+'.gz'
+    return county_cases.assign(date=epoch_milliseconds(county_cases.date))
+
+def chunked_nyt_with_census(csv_url, counties_geojson, output_geojson, max_memory_mb, slim_output=None, gzip=False,
+                            state_json=None, timeseries_output=None, topojson_output=None, brotli=False,
+                            return_fields=None, by_date_dir=None, partitions_dir=None, flatgeobuf_output=None,
+                            tiles_dir=None):
+    """Produce the outputs of `merge_nyt_with_census` with bounded memory, however long the NYT history gets.
+
+    The CSV is read in chunks and its rows are partitioned on disk by the state part of their
+    FIPS code (the first two characters), so all of the rows of a county end up in the same
+    partition. Consecutive partitions are then grouped into batches that fit in `max_memory_mb`,
+    and each batch is processed like the full history would be (`prep_nyt_cases`, `merge_nyt_cases`)
+    and spilled to disk. Finally the outputs are streamed from the spilled batches. The partitions are
+    processed in the order of their keys and the rows of a batch are sorted by FIPS code and date, so the
+    features are written in the order of a full run (see `merge_nyt_cases`), and the outputs are the same.
+
+    Only the latest row of each county and the quantile sketches of the metrics are kept in memory
+    between batches, which is what the colormaps need (see `colormap.make_colormaps`). Their class breaks
+    are then estimated from the sketches, within the rank error of `constants.quantile_sketch_k`.
+
+    The memory that a batch takes is estimated from the size of its partition files on disk with
+    `constants.nyt_memory_per_csv_byte`. A single partition (state) that is larger than the budget
+    is processed on its own.
+
+    :param csv_url: A URL pointing to the raw NYT `us-counties.csv` on GitHub (or filepath on disk)
+    :param counties_geojson: A GeoJSON formatted GIS file of the US Census Bureau 2018 population estimates.
+    :param output_geojson: A filepath on disk where the merged GeoJSON will be saved
+    :param max_memory_mb: The memory budget of a batch, in MB
+    :param slim_output: Defaults None. See `merge_nyt_with_census`
+    :param gzip: Bool, defaults False. See `merge_nyt_with_census`
+    :param state_json: Defaults None. If value is given, the state of every county is saved to this filepath
+        (see `write_nyt_state`), so that the next runs can be incremental
+    :param timeseries_output: Defaults None. See `merge_nyt_with_census`
+    :param topojson_output: Defaults None. See `merge_nyt_with_census`
+    :param brotli: Bool, defaults False. See `merge_nyt_with_census`
+    :param by_date_dir: Defaults None. See `merge_nyt_with_census`
+    :param partitions_dir: Defaults None. See `merge_nyt_with_census`
+    :param flatgeobuf_output: Defaults None. See `merge_nyt_with_census`
+    :param return_fields: Defaults None. The fields of the latest row of each county that are kept in memory
+        and returned. Falls back to `constants.nyt_chunked_return_fields`
+    :param tiles_dir: Defaults None. If value is given, the vector tiles are built from the spilled batches
+        (see `make_nyt_tiles`)
+
+    :returns county_cases: A DataFrame of the latest row of each county with only the `return_fields`,
+        in the compact dtypes (see `transforms.apply_schema`). The quantile sketches of the
+        `constants.nyt_sketch_fields` of all of the rows are in its `attrs['sketches']`, and
+        the files of the vector tiles in its `attrs['tile_files']` if `tiles_dir` is given.
+    """
+    max_bytes = max_memory_mb * 1024**2
+    return_fields = return_fields or constants.nyt_chunked_return_fields
+    counties_nyc = prep_nyt_counties(counties_geojson)
+    make_output_dir(output_geojson)
+    if not os.path.isdir(constants.cache_dir):
+        os.makedirs(constants.cache_dir)
+
+    # The partitions and the processed batches are kept next to the caches rather than in the
+    # system temp dir, which is often in memory
+    with tempfile.TemporaryDirectory(prefix='nyt-chunks-', dir=constants.cache_dir) as work_dir:
+        with measure('partition csv'):
+            partitions = partition_csv(
+                csv_url,
+                os.path.join(work_dir, 'partitions'),
+                lambda chunk: chunk.fips.str[:2],
+                max(1000, int(max_bytes / constants.nyt_memory_per_csv_byte / constants.nyt_csv_row_bytes)),
+                dtype={'fips': str},
+                prepare=set_nyc_fips
+            )
+
+        state = {'last_date': None, 'counties': {}}
+        sketches = {}
+        batch_files = []
+        dates = set()
+        shapes = []
+        latest = []
+        # The FlatGeobuf needs the slim fields of the latest rows too
+        latest_fields = list(dict.fromkeys(return_fields + (constants.nyt_slim_fields if flatgeobuf_output else [])))
+        for i, keys in enumerate(batch_partitions(partitions, max_bytes / constants.nyt_memory_per_csv_byte)):
+            print(f'\nProcessing NYT partitions {", ".join(keys)}')
+            with measure(f'batch {i}') as stage:
+                cases_df = pd.concat([pd.read_csv(partitions[key], dtype={'fips': str}) for key in keys])
+                cases_df = prep_nyt_cases(cases_df)
+                county_cases = merge_nyt_cases(
+                    cases_df,
+                    counties_nyc.loc[counties_nyc.fips.str[:2].isin(keys)]
+                )
+                update_sketches(sketches, county_cases, constants.nyt_sketch_fields)
+                if state_json:
+                    write_nyt_state(cases_df, state_json, state=state, sketches=sketches)
+
+                batch_files.append(os.path.join(work_dir, f'batch-{i}.pickle'))
+                county_cases.to_pickle(batch_files[-1])
+                dates.update(county_cases.date.unique())
+                shapes.append(county_cases.drop_duplicates('fips')[constants.nyt_timeseries_static_fields + ['geometry']])
+                # All of the rows of a county are in the same batch
+                latest.append(latest_rows(county_cases)[latest_fields])
+                stage['rows'] = county_cases.shape[0]
+            del cases_df, county_cases
+
+        latest = pd.concat(latest) if latest else counties_nyc.iloc[:0].reindex(columns=latest_fields)
+
+        def spilled_batches():
+            for batch_file in batch_files:
+                yield pd.read_pickle(batch_file)
+
+        with measure('write') as stage:
+            print(f'\nWriting NYT GIS data to GeoJSON:\n {output_geojson}')
+            artifacts = {output_geojson: None}
+            if slim_output:
+                artifacts[slim_output] = constants.nyt_slim_fields
+            write_geojson_artifacts(
+                spilled_batches(),
+                artifacts,
+                precision=constants.geojson_precision,
+                gzip_output=gzip
+            )
+
+            if timeseries_output:
+                write_timeseries_geojson(
+                    spilled_batches(),
+                    timeseries_output,
+                    constants.nyt_timeseries_static_fields,
+                    constants.nyt_timeseries_series_fields,
+                    dates=np.sort(np.array(list(dates), dtype=np.int64))
+                )
+
+            if topojson_output:
+                write_topojson(
+                    spilled_batches(),
+                    topojson_output,
+                    [field for field in constants.nyt_slim_fields if field != 'geometry'],
+                    shapes=pd.concat(shapes) if shapes else counties_nyc.iloc[:0]
+                )
+
+            if flatgeobuf_output and not latest.empty:
+                write_flatgeobuf(latest, flatgeobuf_output, constants.nyt_slim_fields)
+
+            by_date_files = []
+            if by_date_dir:
+                by_date_files = write_date_partitions(
+                    spilled_batches(),
+                    by_date_dir,
+                    constants.nyt_by_date_fields,
+                    f'{constants.s3_url}/{constants.nyt_by_date_prefix}',
+                    static_fields=constants.nyt_timeseries_static_fields,
+                    shapes=pd.concat(shapes) if shapes else counties_nyc.iloc[:0]
+                )
+
+            partition_files = []
+            if partitions_dir:
+                partition_files = write_state_partitions(
+                    spilled_batches(),
+                    partitions_dir,
+                    f'{constants.s3_url}/{constants.nyt_partitions_prefix}',
+                    constants.nyt_timeseries_static_fields,
+                    constants.nyt_by_date_fields,
+                    dates=np.sort(np.array(list(dates), dtype=np.int64))
+                )
+            add_bytes_written(
+                stage,
+                [output_geojson, slim_output, timeseries_output, topojson_output, flatgeobuf_output]
+                + by_date_files + partition_files + [f'{file}.gz' for file in [output_geojson, slim_output] if file and gzip]
+            )
+
+        tile_files = []
+        if tiles_dir:
+            with measure('tiles') as stage:
+                tile_files = make_nyt_tiles(spilled_batches(), tiles_dir)
+                add_bytes_written(stage, tile_files)
+
+    with measure('compress') as stage:
+        compressed_files = compress_outputs(
+            [output_geojson, slim_output, timeseries_output, topojson_output] + by_date_files + partition_files,
+            gzip=gzip,
+            brotli=brotli,
+            gzipped=[output_geojson, slim_output]
         )
+        add_bytes_written(stage, compressed_files)
+
+    county_cases = apply_schema(latest[return_fields])
+    county_cases.attrs['sketches'] = sketches
+    if tiles_dir:
+        county_cases.attrs['tile_files'] = tile_files
+    return county_cases
+
+def make_nyt_tiles(county_cases, tiles_dir):
+    """Build the vector tile pyramid of the NYT data (see `vector_tiles.make_vector_tiles`), with the
+    `constants.nyt_tile_fields` of the latest day and the `constants.nyt_tile_date_fields` of every day
+
+    :param county_cases: A GeoDataFrame returned by `merge_nyt_cases`, or an iterable of them
+    :param tiles_dir: Directory on disk where the tiles are written
+
+    :returns tile_files: A list of the files that were written, with the TileJSON manifest last
+    """
+    return make_vector_tiles(
+        county_cases,
+        tiles_dir,
+        f'{constants.s3_url}/{constants.nyt_tiles_prefix}/{{z}}/{{x}}/{{y}}.pbf',
+        constants.nyt_tile_fields,
+        date_fields=constants.nyt_tile_date_fields,
+        max_zoom=constants.nyt_tile_max_zoom
+    )
+
+def set_nyc_fips(cases_df):
+    """Set the fake FIPS code of New York City (`constants.nyc_fake_fips`) on rows of the NYT CSV"""
+    cases_df.loc[cases_df.county == 'New York City', 'fips'] = constants.nyc_fake_fips
+    return cases_df
+
+def append_nyt_with_census(csv_url, counties_geojson, output_geojson, state_json, slim_output=None, gzip=False,
+                           brotli=False, by_date_dir=None, geojson_writer='fiona'):
+    """Incrementally update the NYT outputs written by `merge_nyt_with_census`. Only the rows
+    of the NYT CSV that are newer than the last processed date in `state_json` are diffed,
+    merged with the census data and appended to the existing GeoJSON outputs. The work done
+    is proportional to the number of new days rather than the length of the history.
+
+    Before the GeoJSON outputs are appended to, the offsets at which their new features start are saved
+    in the state. They are removed once the new state is saved, so if a run dies in between, the next run
+    truncates the outputs back to these offsets before it appends the same dates again.
+
+    :param csv_url: A URL pointing to the raw NYT `us-counties.csv` on GitHub (or filepath on disk)
+    :param counties_geojson: A GeoJSON formatted GIS file of the US Census Bureau 2018 population estimates.
+    :param output_geojson: An existing GeoJSON file on disk to which the new rows are appended
+    :param state_json: The state file written by the previous run (see `write_nyt_state`)
+    :param slim_output: Defaults None. An existing slim GeoJSON file on disk to which the new rows are appended
+    :param gzip: Bool, defaults False. If True, the g-zipped versions of the outputs are refreshed.
+    :param brotli: Bool, defaults False. If True, the Brotli compressed versions of the outputs are refreshed.
+    :param by_date_dir: Defaults None. An existing directory of per date files (see `write_date_partitions`)
+        to which the new dates are added
+    :param geojson_writer: Defaults 'fiona'. The writer of the existing outputs (see `merge_nyt_with_census`).
+        With 'stream', the coordinates of the new features are rounded to `constants.geojson_precision` too.
+
+    :returns county_cases: A GeoDataFrame of the new rows. Empty if the source has not been updated.
+    """
+    state = read_nyt_state(state_json)
+    if state.get('appending'):
+        # A previous run died after it appended to the outputs and before it saved its state
+        for appended_file, features_end in state.pop('appending').items():
+            print(f' Removing the features appended by an interrupted run:\n  {appended_file}')
+            truncate_geojson_features(appended_file, features_end)
+        save_nyt_state(state, state_json)
+    last_date = state['last_date']
+
+    print(f'\nReading in the NYT cases data:\n {csv_url}')
+    cases_df = pd.read_csv(csv_url, dtype={'fips': str, 'date': str})
+    # ISO formatted date strings sort lexicographically, so filter before parsing any dates
+    cases_df = cases_df.loc[cases_df.date > last_date]
+    print(f' {cases_df.shape[0]} new rows published after {last_date}')
+    if cases_df.empty:
+        print(' NYT data has not been updated. Nothing to append.')
+        return geopandas.GeoDataFrame(cases_df)
+
+    cases_df.loc[cases_df.county == 'New York City', 'fips'] = constants.nyc_fake_fips
+    cases_df = cases_df.assign(date=parse_dates(cases_df.date))
+    cases_df = cases_df.loc[~cases_df.fips.isnull()]
+
+    # Seed each county with the last days of cumulative counts from the state file, so that the
+    # new cases and the rolling metrics of the first new days continue from the previous run
+    print(f'\nCalculating new cases and the {constants.metrics_window} day metrics from the previous state:\n {state_json}')
+    previous = pd.DataFrame(
+        [
+            [fips, date, cases, deaths]
+            for fips, county in state['counties'].items()
+            for date, cases, deaths in county.get('history', [[county['date'], county['cases'], county['deaths']]])
+        ],
+        columns=['fips', 'date', 'cases', 'deaths']
+    )
+    previous = previous.loc[previous.fips.isin(cases_df.fips)]
+    previous = previous.assign(date=parse_dates(previous.date), seed=True)
+    cases_df = pd.concat([previous, cases_df.assign(seed=False)], sort=False)
+    cases_df = add_time_series_metrics(cases_df, ['cases', 'deaths'])
+    seeded_df = cases_df
+    cases_df = cases_df.loc[~cases_df.seed.astype(bool)].drop(columns='seed')
+
+    counties_nyc = prep_nyt_counties(counties_geojson)
+
+    print(f'\nMerging new NYT data with census data')
+    county_cases = counties_nyc.merge(cases_df, how='inner', on='fips')
+
+    print(f'\nCreating fields for # Cases normalized by population')
+    county_cases = apply_schema(add_per_100k(county_cases, ['cases', 'deaths']))
+    county_cases = county_cases.assign(date=epoch_milliseconds(county_cases.date))
+
+    with measure('append', rows=county_cases.shape[0]) as stage:
+        # The sizes of the outputs before the append, so that only the bytes appended are counted
+        appended_files = [output_geojson, slim_output]
+        sizes_before = sum(os.path.getsize(file) for file in appended_files if file)
+        state['appending'] = {file: geojson_features_end(file) for file in appended_files if file}
+        save_nyt_state(state, state_json)
+
+        precision = constants.geojson_precision if geojson_writer == 'stream' else None
+        geometry_cache = {}
+        print(f'\nAppending {county_cases.shape[0]} rows to NYT GeoJSON:\n {output_geojson}')
+        append_geojson_features(county_cases, output_geojson, precision=precision, geometry_cache=geometry_cache)
         if slim_output:
-            gzip_geojson(
+            print(f'\nAppending {county_cases.shape[0]} rows to NYT GeoJSON with slim fields:\n {slim_output}')
+            append_geojson_features(
+                county_cases[constants.nyt_slim_fields],
                 slim_output,
-                slim_output+'.gz'
+                precision=precision,
+                geometry_cache=geometry_cache
             )
+        stage['bytes_written'] = add_bytes_written(stage, appended_files) - sizes_before
+
+    by_date_files = []
+    if by_date_dir:
+        with measure('by date') as stage:
+            by_date_files = write_date_partitions(
+                county_cases,
+                by_date_dir,
+                constants.nyt_by_date_fields,
+                f'{constants.s3_url}/{constants.nyt_by_date_prefix}',
+                static_fields=constants.nyt_timeseries_static_fields,
+                write_geometry=False,
+                merge_manifest=True
+            )
+            add_bytes_written(stage, by_date_files)
+
+    # Continue the quantile sketches of the whole history, for the class breaks of the colormaps
+    sketches = read_nyt_sketches(state)
+    if sketches:
+        update_sketches(sketches, county_cases, list(sketches))
+    else:
+        print(' The state has no quantile sketches. The colormaps will only classify the new rows.'
+              ' Delete the state file to rebuild it, with the sketches, from the full history.')
+    # Saving the new last date completes the append
+    del state['appending']
+    write_nyt_state(seeded_df, state_json, state=state, sketches=sketches)
+    county_cases.attrs['sketches'] = sketches
+
+    with measure('compress') as stage:
+        compressed_files = compress_outputs(
+            [output_geojson, slim_output] + by_date_files,
+            gzip=gzip,
+            brotli=brotli
+        )
+        add_bytes_written(stage, compressed_files)
 
     return county_cases
+
+def read_nyt_state(state_json):
+    """Read the incremental state written by `write_nyt_state`
+
+    :param state_json: Filepath of the state JSON on disk
+
+    :returns state: A dictionary with the `last_date` processed (ISO formatted string) and
+        the `counties` dictionary of `'fips': {'date': ..., 'cases': ..., 'deaths': ..., 'history': ...}`,
+        where `history` is a list of `[date, cases, deaths]` of the last days of the county,
+        and the quantile `sketches` of the whole history (see `read_nyt_sketches`)
+    """
+    print(f'\nReading NYT incremental state:\n {state_json}')
+    with open(state_json, 'r') as state_file:
+        state = json.load(state_file)
+    print(f' Last processed date: {state["last_date"]}')
+    return state
+
+def read_nyt_sketches(state):
+    """Load the quantile sketches of the whole history that are kept in the incremental state
+
+    :param state: A state dictionary (see `read_nyt_state`), or the filepath of the state JSON on disk
+
+    :returns sketches: A dictionary of field name to `KLLSketch`. Empty if the state has none.
+    """
+    if not isinstance(state, dict):
+        state = read_nyt_state(state)
+    return {
+        field: KLLSketch.from_dict(sketch_dict) for field, sketch_dict in state.get('sketches', {}).items()
+    }
+
+def write_nyt_state(cases_df, state_json, state=None, sketches=None):
+    """Persist the last date and cumulative cases/deaths of every county in `cases_df`, so that
+    the next run only has to process the rows that were published afterwards. The last
+    `constants.metrics_window` + 1 days are kept, from which the rolling metrics are continued.
+
+    :param cases_df: A DataFrame of NYT cases data in long format with `date`, `fips`, `cases`
+        and `deaths` columns. The dates are expected to be shifted by 12 hours, as done by
+        `merge_nyt_with_census`
+    :param state_json: Filepath of the state JSON on disk
+    :param state: Defaults None. A state dictionary from a previous run that will be updated
+        with the rows in `cases_df`
+    :param sketches: Defaults None. A dictionary of field name to `KLLSketch` of the whole history,
+        saved under `sketches` (see `read_nyt_sketches`)
+
+    :returns state_json: The state file location as a string
+    """
+    if state is None:
+        state = {'last_date': None, 'counties': {}}
+
+    # Keep enough days of every county to continue the rolling metrics (see `add_time_series_metrics`)
+    recent = cases_df.loc[~cases_df.fips.isnull(), ['fips', 'date', 'cases', 'deaths']]
+    recent = recent.sort_values(['fips', 'date']).groupby('fips').tail(constants.metrics_window + 1)
+    recent = recent.assign(
+        date=(recent.date - timedelta(hours=12)).dt.strftime('%Y-%m-%d'),
+        cases=recent.cases.astype(int),
+        deaths=recent.deaths.fillna(0).astype(int),
+    )
+    for fips, county_rows in recent.groupby('fips', observed=True):
+        history = county_rows[['date', 'cases', 'deaths']].values.tolist()
+        state['counties'][fips] = {
+            'date': history[-1][0],
+            'cases': history[-1][1],
+            'deaths': history[-1][2],
+            'history': history,
+        }
+    if sketches:
+        state['sketches'] = {field: sketch.to_dict() for field, sketch in sketches.items()}
+    last_date = (cases_df.date.max() - timedelta(hours=12)).strftime('%Y-%m-%d')
+    if state['last_date'] is None or last_date > state['last_date']:
+        state['last_date'] = last_date
+
+    return save_nyt_state(state, state_json)
+
+def save_nyt_state(state, state_json):
+    """Write a state dictionary (see `read_nyt_state`) to a temporary file that replaces `state_json`,
+    so that a run that dies while writing it leaves the previous state in place
+
+    :returns state_json: The state file location as a string
+    """
+    print(f'\nWriting NYT incremental state:\n {state_json}')
+    if not os.path.isdir(os.path.dirname(state_json)):
+        os.makedirs(os.path.dirname(state_json))
+    with open(f'{state_json}.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(f'{state_json}.tmp', state_json)
+    return state_json
+
+def append_geojson_features(geo_data_frame, geojson_filepath, precision=None, geometry_cache=None):
+    """Append the rows of a GeoDataFrame as features to an existing GeoJSON FeatureCollection
+    on disk, without reading or rewriting the features that are already in the file.
+
+    :param geo_data_frame: The GeoDataFrame to append. Columns should match the existing file.
+    :param geojson_filepath: A GeoJSON FeatureCollection on disk, such as one written by
+        `GeoDataFrame.to_file(..., driver='GeoJSON')`
+    :param precision: Defaults None. Number of decimals to round the coordinates to, which should match
+        the writer of the existing file (see `geojson_writer.write_geojson_artifacts`). Full precision if None.
+    :param geometry_cache: Defaults None. A dictionary of 'fips' to serialized geometry, which can be
+        shared by the appends of the same rows to several files
+
+    :returns bool: True on success.
+    """
+    features_end = geojson_features_end(geojson_filepath)
+    with open(geojson_filepath, 'rb+') as geojson_file:
+        head_size = min(features_end, 4096)
+        geojson_file.seek(features_end - head_size)
+        has_features = geojson_file.read(head_size).rstrip()[-1:] != b'['
+        geojson_file.seek(features_end)
+        geojson_file.truncate()
+        if geometry_cache is None:
+            geometry_cache = {}
+        features = serialize_features(geo_data_frame, None, precision, 'fips', geometry_cache)
+        if features:
+            if has_features:
+                geojson_file.write(b',\n')
+            geojson_file.write(',\n'.join(features).encode('utf-8'))
+        geojson_file.write(b'\n]\n}\n')
+    return True
+
+def geojson_features_end(geojson_filepath):
+    """The byte offset of the closing bracket of the features array of a GeoJSON FeatureCollection on disk,
+    where `append_geojson_features` appends. The collection ends with that bracket followed by the
+    closing brace of the collection, so it is found by scanning back from the end of the file.
+    """
+    with open(geojson_filepath, 'rb') as geojson_file:
+        geojson_file.seek(0, os.SEEK_END)
+        file_size = geojson_file.tell()
+        tail_size = min(file_size, 4096)
+        geojson_file.seek(file_size - tail_size)
+        tail = geojson_file.read(tail_size)
+    return file_size - tail_size + tail.rindex(b']')
+
+def truncate_geojson_features(geojson_filepath, features_end):
+    """Remove the features appended to a GeoJSON FeatureCollection on disk after `features_end`
+    (see `geojson_features_end`), and close the collection again"""
+    with open(geojson_filepath, 'rb+') as geojson_file:
+        geojson_file.seek(features_end)
+        geojson_file.truncate()
+        geojson_file.write(b']\n}\n')
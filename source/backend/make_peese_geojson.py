@@ -1,13 +1,19 @@
-from datetime import datetime, timedelta
-import gzip
+from datetime import datetime
 import os
-import shutil
 
-import geopandas
 import pandas as pd
-from shapely.geometry import mapping
 
 import constants
+from counties_cache import load_derived_counties, state_counties
+from date_partitions import write_date_partitions
+from flatgeobuf_writer import write_flatgeobuf
+from geojson_writer import write_geojson_artifacts, write_geojson_file
+from instrumentation import add_bytes_written, measure
+from metrics import add_time_series_metrics
+from timeseries_geojson import write_timeseries_geojson
+from topojson_writer import write_topojson
+from transforms import (add_per_100k, apply_schema, compress_outputs, epoch_milliseconds, make_output_dir, parse_dates,
+                        report_memory)
 
 
 def prep_peese_csv(csv_url, county_fips):
@@ -23,31 +29,31 @@ def prep_peese_csv(csv_url, county_fips):
 
     :return df: A Pandas DataFrame of the PEESE COVID-19 data in long format
     """
-    print(f'\nReading PEESE CSV from GitHub as Data Frame:\n {csv_url}')
-    df = pd.read_csv(csv_url)
+    with measure('read csv') as stage:
+        print(f'\nReading PEESE CSV from GitHub as Data Frame:\n {csv_url}')
+        df = pd.read_csv(csv_url)
 
-    # Make long formatted table and add FIPS column
-    print(f'\nCreating NYC region and melting CSV to long format')
-    df['fips'] = df['region'].map(constants.county_fips).astype(str)
+        # Make long formatted table and add FIPS column
+        print(f'\nCreating NYC region and melting CSV to long format')
+        df['fips'] = df['region'].map(constants.county_fips).astype(str)
 
-    # Long format the data frame
-    df = pd.melt(df, id_vars=['region', 'fips'], var_name='date', value_name='cases')
+        # Long format the data frame
+        df = pd.melt(df, id_vars=['region', 'fips'], var_name='date', value_name='cases')
 
-    # Coerce to Pandas datetime and add 12 hours to account for local time adjustments in JS (esri in particular)
-    df = df.assign(date=lambda x: pd.to_datetime(x['date']))
-    df = df.assign(date=lambda x: df.date + timedelta(hours=12))
+        # Coerce to Pandas datetime and add 12 hours to account for local time adjustments in JS (esri in particular)
+        df = df.assign(date=parse_dates(df.date))
 
-    # Calculate new daily cases
-    df = df.sort_values(['region', 'date'])
-    df = df.set_index(['date', 'region', 'fips'])
-    df = df.assign(new_cases=df.cases.diff().fillna(0).astype(int))
-    df = df.reset_index()
-    df.loc[df.new_cases <0, 'new_cases'] = 0
+        # Calculate new daily cases, and the rolling average, growth rate and doubling time of each region
+        df = apply_schema(add_time_series_metrics(df, ['cases'], id_field='region'))
+        report_memory('the PEESE cases with compact dtypes', df)
+        stage['rows'] = df.shape[0]
 
     print(' success')
     return df
 
-def merge_peese_with_census(cases_df, counties_geojson, output_geojson, slim_output=None, gzip=False):
+def merge_peese_with_census(cases_df, counties_geojson, output_geojson, slim_output=None, gzip=False,
+                            timeseries_output=None, topojson_output=None, geojson_writer='fiona', brotli=False,
+                            by_date_dir=None, flatgeobuf_output=None):
     """Merge the PEESE COVID data with the US Census Bureau 2018 County Data (including population)
     
     :param cases_df: A Pandas DataFrame in long format of the PEESE covid data
@@ -61,65 +67,123 @@ def merge_peese_with_census(cases_df, counties_geojson, output_geojson, slim_out
         file that is more friendly to the web. Fields can be added and removed as needed in `./constants.py`
     :param gzip: Bool, defaults False. If True, a g-zipped version of the geojson will also be produced.
         The file will be in the same location as output_geojson param, appended with '.gz' extension.
+    :param timeseries_output: Defaults None. If value is given, it should be a filepath to disk. This file
+        will contain one feature per county, with the daily values stored as arrays that are indexed
+        against a shared `dates` array, so that each county geometry is only written once.
+        Fields can be added and removed as needed in `./constants.py`
+    :param topojson_output: Defaults None. If value is given, it should be a filepath to disk. The slim
+        fields will be saved there as TopoJSON, which stores the borders shared by neighboring counties
+        once, with quantized and delta-encoded coordinates.
+    :param geojson_writer: Defaults 'fiona'. The backend that writes the GeoJSON outputs. Either 'fiona',
+        which writes through `GeoDataFrame.to_file`, or 'stream', which serializes each feature once
+        and writes the full and slim outputs, and their g-zipped copies, in a single pass
+        (see `./geojson_writer.py`)
+    :param brotli: Bool, defaults False. If True, a Brotli compressed version of each output will also be
+        produced, appended with '.br' extension. Requires the `Brotli` package.
+    :param by_date_dir: Defaults None. If value is given, it should be a directory on disk. The daily values
+        of each date are saved there to a small JSON file, with the county geometries written once next
+        to them and a manifest of the dates, for clients that load one day at a time (see `./date_partitions.py`)
+    :param flatgeobuf_output: Defaults None. If value is given, it should be a filepath to disk. The slim
+        fields of the latest day of each county will be saved there as FlatGeobuf, with a spatial index,
+        so that clients can read only the counties in their viewport with range requests (see `./flatgeobuf_writer.py`)
     
     :returns output_geojson: Returns the output geojson file location as a string
     """
-    print(f'\nReading in the counties GeoJSON:\n {counties_geojson}')
-    counties = geopandas.read_file(counties_geojson, dtype={'fips': str})
-    counties = counties.rename(columns={
-        col: col.lower() for col in counties.columns
-    })
-    counties = counties.loc[counties.state_name == 'New York']
-
-    print(f'Merge Census data and PEESE data')
-    county_cases = counties.merge(cases_df, how='outer', on='fips')
-    print(' success')
-
-    print(f'\nCreating field for # Cases normalized by population')
-    # Calculate cases per 100k people
-    county_cases['cases_per_100k'] = ((county_cases.cases/county_cases.population) * 100000).apply(lambda x: round(x, 3))
+    with measure('merge') as stage:
+        counties = state_counties(load_derived_counties(counties_geojson), 'New York')
+
+        print(f'Merge Census data and PEESE data')
+        county_cases = counties.merge(cases_df, how='outer', on='fips')
+        print(' success')
+
+        print(f'\nCreating field for # Cases normalized by population')
+        # Calculate cases per 100k people
+        county_cases = apply_schema(add_per_100k(county_cases, ['cases']))
+        report_memory('the merged PEESE data with compact dtypes', county_cases)
+        stage['rows'] = county_cases.shape[0]
+
+    with measure('geojson', rows=county_cases.shape[0]) as stage:
+        print(f'\nWriting PEESE GIS data to GeoJSON:\n {output_geojson}')
+        county_cases = county_cases.assign(date=epoch_milliseconds(county_cases.date))
+        make_output_dir(output_geojson)
+        if geojson_writer == 'stream':
+            # Serialize each feature once for all of the outputs, and gzip them as they are written
+            artifacts = {output_geojson: None}
+            if slim_output:
+                artifacts[slim_output] = constants.peese_slim_fields
+            write_geojson_artifacts(
+                county_cases,
+                artifacts,
+                precision=constants.geojson_precision,
+                gzip_output=gzip
+            )
+        else:
+            write_geojson_file(
+                county_cases,
+                output_geojson,
+                writer=geojson_writer
+            )
 
-    print(f'\nWriting PEESE GIS data to GeoJSON:\n {output_geojson}')
-    county_cases = county_cases.assign(date=(
-        (county_cases.date - datetime(1970, 1, 1)).dt.total_seconds() * 1000).apply(int)
-    )
-    if not os.path.isdir(os.path.dirname(output_geojson)):
-        os.makedirs(os.path.dirname(output_geojson))
-        print(f'  Created output dir: {os.path.dirname(output_geojson)}')
-    county_cases.to_file(output_geojson, driver='GeoJSON')
-
-    if slim_output:
-        print(f'\nWriting PEESE GIS data to GeoJSON with slim fields')
-        print(f' {slim_output}\n Slim Fields:\n  {constants.peese_slim_fields}')
-        county_cases[constants.peese_slim_fields].to_file(slim_output, driver='GeoJSON')
-
-    if gzip:
-        gzip_geojson(
-            output_geojson,
-            output_geojson+'.gz'
-        )
-        if slim_output:
-            gzip_geojson(
+        if slim_output and geojson_writer != 'stream':
+            print(f'\nWriting PEESE GIS data to GeoJSON with slim fields')
+            print(f' {slim_output}\n Slim Fields:\n  {constants.peese_slim_fields}')
+            write_geojson_file(
+                county_cases,
                 slim_output,
-                slim_output+'.gz'
+                fields=constants.peese_slim_fields,
+                writer=geojson_writer
+            )
+        geojson_files = [output_geojson, slim_output]
+        add_bytes_written(stage, geojson_files + [f'{file}.gz' for file in geojson_files if file and gzip])
+
+    if timeseries_output:
+        with measure('time series') as stage:
+            write_timeseries_geojson(
+                county_cases,
+                timeseries_output,
+                constants.peese_timeseries_static_fields,
+                constants.peese_timeseries_series_fields
             )
+            add_bytes_written(stage, [timeseries_output])
+
+    if topojson_output:
+        with measure('topojson') as stage:
+            write_topojson(
+                county_cases,
+                topojson_output,
+                [field for field in constants.peese_slim_fields if field != 'geometry']
+            )
+            add_bytes_written(stage, [topojson_output])
+
+    if flatgeobuf_output:
+        with measure('flatgeobuf') as stage:
+            write_flatgeobuf(county_cases, flatgeobuf_output, constants.peese_slim_fields)
+            add_bytes_written(stage, [flatgeobuf_output])
+
+    by_date_files = []
+    if by_date_dir:
+        with measure('by date') as stage:
+            by_date_files = write_date_partitions(
+                county_cases,
+                by_date_dir,
+                constants.peese_by_date_fields,
+                f'{constants.s3_url}/{constants.peese_by_date_prefix}',
+                static_fields=constants.peese_timeseries_static_fields
+            )
+            add_bytes_written(stage, by_date_files)
+
+    # The 'stream' writer g-zips the GeoJSON outputs as it writes them
+    with measure('compress') as stage:
+        compressed_files = compress_outputs(
+            [output_geojson, slim_output, timeseries_output, topojson_output] + by_date_files,
+            gzip=gzip,
+            brotli=brotli,
+            gzipped=[output_geojson, slim_output] if geojson_writer == 'stream' else []
+        )
+        add_bytes_written(stage, compressed_files)
 
     return county_cases
 
-def gzip_geojson(input_filepath, output_filepath):
-    """Compress a file using gzip algorithm
-    
-    :param input_filepath: The file to be compressed
-    :param output_filepath: The file location to create a compressed copy of the input file
-
-    :returns bool: True on success.
-    """
-    print(f'\nGZIP file:\n {input_filepath}\n  as\n {output_filepath}')
-    with open(input_filepath, 'rb') as f_in:
-        with gzip.open(output_filepath, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    return True
-
 def main():
     start_time = datetime.now()
     print(f'\nRunning script : {os.path.abspath(__file__)}')
@@ -148,6 +212,22 @@ def main():
         'peese',
         'peese-latest-slim.geojson'
     ))
+    timeseries_output_geojson = os.path.abspath(os.path.join(
+        os.path.dirname(__file__),
+        '..',
+        '..',
+        'dist',
+        'peese',
+        'peese-latest-timeseries.geojson'
+    ))
+    topojson_output = os.path.abspath(os.path.join(
+        os.path.dirname(__file__),
+        '..',
+        '..',
+        'dist',
+        'peese',
+        'peese-latest-slim.topojson'
+    ))
 
     peese_data_frame = prep_peese_csv(
         constants.peese_csv_url,
@@ -159,7 +239,9 @@ def main():
         counties_geojson,
         output_geojson,
         slim_output=slim_output_geojson,
-        gzip=True
+        gzip=True,
+        timeseries_output=timeseries_output_geojson,
+        topojson_output=topojson_output
     )
 
     end_time = datetime.now()
@@ -8,6 +8,9 @@ import geopandas
 import pandas as pd
 from shapely.geometry import mapping
 
+from counties_cache import load_counties
+from transforms import gzip_geojson
+
 
 nyt_cases_url = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv'
 
@@ -23,13 +26,6 @@ print(f'\nRunning script : {os.path.abspath(__file__)}')
 print(f'Start time     : {start_time}')
 print(f'Dist dir       : {DIST_DIR}')
 
-def gzip_geojson(input_filepath, output_filepath):
-    print(f'\nGZIP file:\n {input_filepath}\n  as\n {output_filepath}')
-    with open(input_filepath, 'rb') as f_in:
-        with gzip.open(output_filepath, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    return True
-
 fabricated_fips = {
     'New York City': '-9999',
 }
@@ -50,11 +46,7 @@ counties_geojson = os.path.abspath(os.path.join(
     'usa_counties.geojson'
 ))
 
-print(f'\nReading in the counties GeoJSON:\n {counties_geojson}')
-counties = geopandas.read_file(counties_geojson)
-counties = counties.rename(columns={
-    col: col.lower() for col in counties.columns
-})
+counties = load_counties(counties_geojson)
 
 print(f'\nReading in the NYT cases data:\n {nyt_cases_url}')
 cases = pd.read_csv(nyt_cases_url, dtype={'fips': str})
@@ -0,0 +1,97 @@
+import numpy as np
+
+import constants
+
+
+def add_time_series_metrics(cases_df, value_fields, id_field='fips', date_field='date', window=None):
+    """Add the daily change, rolling average, growth rate and doubling time of cumulative counts
+    to a long formatted DataFrame (one row per county per day), such as the frames of
+    `prep_peese_csv` and `merge_nyt_with_census`.
+
+    For each field in `value_fields` (e.g. 'cases'), these columns are added:
+
+        - `new_<field>`: The change from the previous day of the same county. It is 0 on the first
+          day of each county, and negative changes (corrections in the source data) are set to 0.
+        - `new_<field>_avg_<window>d`: The mean of `new_<field>` over the last `window` days,
+          or over all of the days of the county if it has fewer.
+        - `<field>_growth_rate`: The average daily growth rate of the cumulative count over
+          the last `window` days, e.g. 0.1 for 10 % per day.
+        - `<field>_doubling_days`: The number of days the cumulative count takes to double at that
+          growth rate. Missing when the count did not grow.
+
+    The rate and doubling time are missing until a county has `window` days of history, and
+    when the count `window` days earlier is 0.
+
+    The frame is sorted by county and date, and every metric is computed for all of the
+    counties at once with NumPy: the county boundaries are found from the sorted ids, and the
+    rolling sums come from a cumulative sum that is offset at each boundary.
+    The window is counted in rows, so the data is expected to have one row per county per day.
+
+    :param cases_df: A DataFrame in long format
+    :param value_fields: List of the cumulative count fields, e.g. `['cases', 'deaths']`
+    :param id_field: Defaults 'fips'. Field that identifies the county of a row
+    :param date_field: Defaults 'date'. Field with the date of a row
+    :param window: Defaults None. Number of days of the rolling metrics. Falls back to `constants.metrics_window`
+
+    :returns cases_df: The sorted DataFrame with the new columns
+    """
+    window = window or constants.metrics_window
+    cases_df = cases_df.sort_values([id_field, date_field], kind='mergesort')
+    row_count = cases_df.shape[0]
+    if row_count == 0:
+        return cases_df.assign(**{
+            column: np.array([], dtype=float) for field in value_fields for column in metric_fields(field, window)
+        })
+
+    ids = cases_df[id_field].to_numpy()
+    starts = np.ones(row_count, dtype=bool)
+    starts[1:] = ids[1:] != ids[:-1]
+    rows = np.arange(row_count)
+    group_start = np.maximum.accumulate(np.where(starts, rows, 0))
+    position = rows - group_start
+    has_window = position >= window
+    window_back = np.where(has_window, rows - window, group_start)
+
+    metrics = {}
+    for field in value_fields:
+        new_field, avg_field, growth_field, doubling_field = metric_fields(field, window)
+        # Blank counts (e.g. NYT rows without deaths) are NaN in the nullable integer dtypes of the schema
+        values = cases_df[field].to_numpy(dtype=float, na_value=np.nan)
+
+        new_values = np.zeros(row_count, dtype=float)
+        new_values[1:] = values[1:] - values[:-1]
+        new_values[starts | np.isnan(new_values)] = 0
+        new_values = np.clip(new_values, 0, None).astype(np.int64)
+
+        # The rolling sum is the cumulative sum minus the cumulative sum `window` rows back, or
+        # minus the cumulative sum before the first day of the county, which resets it per county
+        cumulative = np.cumsum(new_values)
+        before = np.where(
+            has_window,
+            cumulative[window_back],
+            cumulative[group_start] - new_values[group_start]
+        )
+        rolling_mean = (cumulative - before) / np.minimum(position + 1, window)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            previous = np.where(has_window, values[window_back], np.nan)
+            ratio = np.where(previous > 0, values / previous, np.nan)
+            growth_rate = ratio ** (1 / window) - 1
+            doubling_days = np.where(ratio > 1, window * np.log(2) / np.log(ratio), np.nan)
+
+        metrics[new_field] = new_values
+        metrics[avg_field] = np.round(rolling_mean, 3)
+        metrics[growth_field] = np.round(growth_rate, 4)
+        metrics[doubling_field] = np.round(doubling_days, 1)
+
+    return cases_df.assign(**metrics)
+
+def metric_fields(field, window=None):
+    """Return the names of the columns that `add_time_series_metrics` adds for `field`"""
+    window = window or constants.metrics_window
+    return [
+        f'new_{field}',
+        f'new_{field}_avg_{window}d',
+        f'{field}_growth_rate',
+        f'{field}_doubling_days',
+    ]
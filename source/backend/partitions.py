@@ -0,0 +1,69 @@
+import os
+
+import pandas as pd
+
+
+def partition_csv(csv_url, partition_dir, partition_key, chunk_rows, dtype=None, prepare=None):
+    """Split a CSV into one CSV per partition on disk, reading it `chunk_rows` rows at a time,
+    so that the whole file is never held in memory.
+
+    :param csv_url: A URL pointing to a CSV (or filepath on disk)
+    :param partition_dir: Directory on disk where the partition files are written as `<key>.csv`
+    :param partition_key: A function that takes a chunk (DataFrame) and returns a Series with
+        the partition key of each row. Rows with a missing key are dropped.
+    :param chunk_rows: Number of rows read at a time
+    :param dtype: Defaults None. The `dtype` argument of `pd.read_csv`
+    :param prepare: Defaults None. A function that takes a chunk and returns it prepared to
+        be partitioned, e.g. with corrected keys
+
+    :returns partitions: A dictionary of partition key to the partition file, sorted by key
+    """
+    print(f'\nPartitioning CSV in chunks of {chunk_rows} rows:\n {csv_url}\n  to\n {partition_dir}')
+    if not os.path.isdir(partition_dir):
+        os.makedirs(partition_dir)
+
+    partitions = {}
+    row_count = 0
+    for chunk in pd.read_csv(csv_url, dtype=dtype, chunksize=chunk_rows):
+        if prepare:
+            chunk = prepare(chunk)
+        keys = partition_key(chunk)
+        chunk = chunk.loc[~keys.isnull()]
+        keys = keys.loc[chunk.index]
+        for key, rows in chunk.groupby(keys, sort=False):
+            partition_file = partitions.get(key)
+            if partition_file is None:
+                partition_file = partitions[key] = os.path.join(partition_dir, f'{key}.csv')
+                rows.to_csv(partition_file, index=False)
+            else:
+                rows.to_csv(partition_file, mode='a', header=False, index=False)
+        row_count += chunk.shape[0]
+    print(f' {row_count} rows in {len(partitions)} partitions')
+
+    return {key: partitions[key] for key in sorted(partitions)}
+
+def batch_partitions(partitions, max_bytes):
+    """Group consecutive partitions into batches whose files add up to at most `max_bytes`.
+    A partition that is larger than `max_bytes` is a batch of its own.
+
+    :param partitions: A dictionary of partition key to partition file, in processing order
+    :param max_bytes: The largest size on disk of the files of a batch
+
+    :returns batches: A list of lists of partition keys
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for key, partition_file in partitions.items():
+        partition_bytes = os.path.getsize(partition_file)
+        if batch and batch_bytes + partition_bytes > max_bytes:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        if partition_bytes > max_bytes:
+            print(f'  Partition {key} ({partition_bytes / 1024**2:.1f} MB) is larger than a batch, processing it alone')
+        batch.append(key)
+        batch_bytes += partition_bytes
+    if batch:
+        batches.append(batch)
+    return batches
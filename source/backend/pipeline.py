@@ -0,0 +1,136 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import os
+
+from instrumentation import add_run_records, measure, run_records
+
+
+# A stage of a pipeline: `function` is called with the results of the stages in `depends_on` (a list of
+# stage keys, see `stage_key`), in that order. The stages that are shared by all of the sources
+# (e.g. loading the counties) have a `source` of None.
+Stage = namedtuple(
+    'Stage',
+    ['name', 'source', 'function', 'depends_on']
+)
+
+
+def stage_key(stage):
+    """The key of a stage in the `depends_on` lists and the results, e.g. 'nyt:build' or 'counties'"""
+    return f'{stage.source}:{stage.name}' if stage.source else stage.name
+
+def select_stages(stages, stage_names=None, sources=None):
+    """Select the stages to run: the stages with one of `stage_names` of one of the `sources`,
+    along with the stages that they depend on, as `make` runs the prerequisites of a target.
+
+    :param stages: A list of `Stage`
+    :param stage_names: Defaults None. A list of stage names, e.g. ['classify']. All of the stages if None
+    :param sources: Defaults None. A list of sources, e.g. ['peese']. All of the sources if None.
+        The shared stages are selected for every source.
+
+    :returns stages: The selected stages, in the order of `stages`
+    """
+    by_key = {stage_key(stage): stage for stage in stages}
+    selected = set()
+    pending = [
+        stage_key(stage) for stage in stages
+        if (not stage_names or stage.name in stage_names) and (not sources or stage.source in sources)
+    ]
+    while pending:
+        key = pending.pop()
+        if key not in selected:
+            selected.add(key)
+            pending += by_key[key].depends_on
+    return [stage for stage in stages if stage_key(stage) in selected]
+
+def run_stages(stages, workers=None, results=None):
+    """Run the stages of a pipeline on a thread pool, each as soon as the stages it depends on are done,
+    so that independent stages (e.g. of different sources) run concurrently. Each stage is measured
+    under its key (see `instrumentation.measure`).
+
+    A stage that returns None has nothing to pass on (e.g. its source did not change), and the stages
+    that depend on it are skipped. A stage that fails skips the stages that depend on it too, and the
+    other stages carry on.
+
+    :param stages: A list of `Stage`, in which every stage that is depended on is either listed or in `results`
+    :param workers: Defaults None. Number of threads. Falls back to the number of stages
+    :param results: Defaults None. A dictionary of the results of stages that already ran, by stage key
+
+    :returns results, errors: A dictionary of the result of each stage by stage key (None if skipped),
+        and a dictionary of the exception of each stage that failed
+    """
+    results = dict(results or {})
+    errors = {}
+    waiting = {stage_key(stage): stage for stage in stages}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers or max(1, len(stages))) as executor:
+        while waiting or running:
+            for key, stage in list(waiting.items()):
+                if not all(dependency in results for dependency in stage.depends_on):
+                    continue
+                del waiting[key]
+                inputs = [results[dependency] for dependency in stage.depends_on]
+                if any(value is None for value in inputs):
+                    print(f'\nSkipping stage {key}: nothing to do')
+                    results[key] = None
+                    continue
+                print(f'\nStarting stage {key}')
+                running[executor.submit(run_stage, key, stage.function, inputs)] = key
+            if not running:
+                if waiting:
+                    raise ValueError(f'Stages depend on stages that are not run: {sorted(waiting)}')
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                try:
+                    results[key], seconds = future.result()
+                    print(f'\nFinished stage {key} in {seconds:.1f} s')
+                except Exception as e:
+                    print(f'\nStage {key} failed: {e!r}')
+                    errors[key] = e
+                    results[key] = None
+    return results, errors
+
+def run_stages_by_source(stages, workers=None):
+    """Run the shared stages of a pipeline (see `Stage`) in this process, then the stages of each
+    source in a process of its own, so that the CPU bound work of the sources runs in parallel
+    rather than taking turns on the GIL. The stages of a source run as in `run_stages` within
+    their process. The stage functions and the results of the shared stages must be picklable.
+
+    The results of the stages that run in another process stay there: they are reported as True,
+    or None if the stage was skipped or failed. Their measurements are added to the ones of this process.
+
+    :returns results, errors: See `run_stages`
+    """
+    shared = [stage for stage in stages if not stage.source]
+    results, errors = run_stages(shared, workers)
+    sources = list(dict.fromkeys(stage.source for stage in stages if stage.source))
+    with ProcessPoolExecutor(max_workers=max(1, len(sources))) as executor:
+        futures = [
+            executor.submit(run_source_stages, [stage for stage in stages if stage.source == source], workers, results)
+            for source in sources
+        ]
+        for future in futures:
+            source_results, source_errors, source_records = future.result()
+            results.update(source_results)
+            errors.update(source_errors)
+            add_run_records(source_records)
+    return results, errors
+
+def run_source_stages(stages, workers, results):
+    """Run the stages of one source (in a process of the pool of `run_stages_by_source`)"""
+    print(f'\nRunning the stages of {stages[0].source} in process {os.getpid()}')
+    # A forked process starts with a copy of the measurements of its parent
+    first_record = len(run_records)
+    source_results, errors = run_stages(stages, workers, results)
+    return (
+        {key: True if result is not None else None for key, result in source_results.items() if key not in results},
+        {key: RuntimeError(f'{type(e).__name__}: {e}') for key, e in errors.items()},
+        run_records[first_record:]
+    )
+
+def run_stage(key, function, inputs):
+    with measure(key) as record:
+        result = function(*inputs)
+    return result, record['wall_seconds']
@@ -0,0 +1,110 @@
+import argparse
+from datetime import datetime
+from functools import partial
+import os
+import sys
+
+from instrumentation import start_run, write_run_report
+from pipeline import Stage, run_stages, run_stages_by_source, select_stages, stage_key
+from publish_nyt_geojson import build_nyt, classify_nyt, fetch_nyt, nyt_options, nyt_paths, publish_nyt, tile_nyt
+from publish_peese_geojson import (build_peese, classify_peese, fetch_peese, peese_options, peese_paths,
+                                   publish_peese)
+
+
+def main():
+    """Run the NYT and PEESE pipelines of `./publish_nyt_geojson.py` and `./publish_peese_geojson.py`
+    as one pipeline of stages (see `nightly_stages`), in which the counties are loaded once for both
+    sources and the stages of the two sources run concurrently, so that the whole run takes about
+    as long as the slowest source.
+
+        python source/backend/publish_all.py                      # every stage of every source
+        python source/backend/publish_all.py --source peese       # only the PEESE stages
+        python source/backend/publish_all.py --stage fetch        # only fetch the sources
+        python source/backend/publish_all.py --stage classify     # and the stages that classify needs
+
+    The options of each source are the ones of its script (`nyt_options` and `peese_options`).
+    The timings of the stages are written to a JSON run report (see `instrumentation.write_run_report`).
+    Exits with status 1 if a stage fails.
+    """
+    parser = argparse.ArgumentParser(description='Run the NYT and PEESE pipelines concurrently')
+    parser.add_argument('--stage', action='append', help='Run this stage, and the stages it depends on. Repeatable.')
+    parser.add_argument('--source', action='append', help='Run the stages of this source only. Repeatable.')
+    parser.add_argument('--threads', action='store_true', help='Run every stage in this process, on threads')
+    parser.add_argument('--workers', type=int, default=None, help='Number of threads per process')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    print(f'\nRunning script : {os.path.abspath(__file__)}')
+    print(f'Start time     : {start_time}')
+
+    start_run()
+    stages = select_stages(nightly_stages(), stage_names=args.stage, sources=args.source)
+    print(f'\nRunning the stages: {", ".join(stage_key(stage) for stage in stages)}')
+    if args.threads or len({stage.source for stage in stages if stage.source}) < 2:
+        results, errors = run_stages(stages, workers=args.workers)
+    else:
+        results, errors = run_stages_by_source(stages, workers=args.workers)
+
+    print('\nStages:')
+    for stage in stages:
+        key = stage_key(stage)
+        status = 'failed' if key in errors else 'skipped' if results.get(key) is None else 'done'
+        print(f' {key:<16}{status}')
+    write_run_report('publish_all', start_time)
+
+    end_time = datetime.now()
+    print(f'\nScript completed : {end_time}')
+    print(f'Run time         : {end_time-start_time}\n')
+    if errors:
+        sys.exit(1)
+
+def nightly_stages():
+    """The stages of the nightly publish of the NYT and PEESE data:
+
+        counties ──┬──────────────────────┐
+        nyt:fetch ─┴─ nyt:build ─┬─ nyt:classify ─┬─ nyt:publish
+                                 └─ nyt:tiles ────┘
+        peese:fetch ─ peese:build ─ peese:classify ─ peese:publish
+
+    (peese:build depends on the counties as well, and the publish stages on the fetch stages, for the
+    digest of the source that they record as published.) The build stages transform the source, write the
+    outputs and compress them, as the 'stream' writer compresses the GeoJSON outputs as it writes them.
+
+    :returns stages: A list of `pipeline.Stage`
+    """
+    nyt = nyt_paths()
+    peese = peese_paths()
+    return [
+        Stage('counties', None, partial(load_counties_stage, nyt['counties_geojson']), []),
+
+        Stage('fetch', 'nyt', partial(fetch_nyt, nyt, nyt_options), []),
+        Stage('build', 'nyt', partial(build_stage, build_nyt, nyt, nyt_options), ['nyt:fetch', 'counties']),
+        Stage('classify', 'nyt', partial(classify_nyt, paths=nyt, options=nyt_options), ['nyt:build']),
+        Stage('tiles', 'nyt', partial(tile_nyt, paths=nyt, options=nyt_options), ['nyt:build']),
+        Stage('publish', 'nyt', partial(publish_nyt, paths=nyt, options=nyt_options),
+              ['nyt:fetch', 'nyt:classify', 'nyt:tiles']),
+
+        Stage('fetch', 'peese', partial(fetch_peese, peese, peese_options), []),
+        Stage('build', 'peese', partial(build_stage, build_peese, peese, peese_options), ['peese:fetch', 'counties']),
+        Stage('classify', 'peese', partial(classify_peese, paths=peese, options=peese_options), ['peese:build']),
+        Stage('publish', 'peese', partial(publish_peese, paths=peese, options=peese_options),
+              ['peese:fetch', 'peese:classify']),
+    ]
+
+def load_counties_stage(counties_geojson):
+    """Load the derived counties once for all of the sources (see `load_derived_counties`). The stages
+    that run in this process, or in a process forked from it, share the copy in memory. The others
+    read the binary cache that this stage brings up to date.
+
+    :returns county_count: The number of counties
+    """
+    from counties_cache import load_derived_counties
+    return len(load_derived_counties(counties_geojson)['counties'])
+
+def build_stage(build, paths, options, source, county_count):
+    """Run the build function of a source once the source is fetched and the counties are loaded"""
+    return build(source, paths, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,26 @@ from datetime import datetime
 import json
 import os
 
-from cloud_functions import upload_file_to_s3
-from colormap import get_rgbs
 import constants
-from make_nyt_geojson import merge_nyt_with_census
+from fetch_cache import fetch_source, published_sha256
+from instrumentation import measure, start_run, write_run_report
+# The pipeline, colormap, tile and S3 stages are imported by the stage functions as they are reached,
+# so that runs that stop early (e.g. when the source has not changed) do not pay for importing
+# geopandas, shapely and boto3
+
+
+nyt_options = {
+    'gzip_output': True,
+    'brotli_output': True,
+    'geojson_writer': 'stream',  # 'stream' writes every GeoJSON artifact in one pass; 'fiona' uses GeoDataFrame.to_file
+    'skip_unchanged_source': True,  # If True, stop early when the source CSV has not changed since the last publish
+    'incremental': False,  # If True, only append the dates published since the last run to the outputs (see `publish_nyt`)
+    'max_memory_mb': None,  # If set, the CSV is processed in partitions that fit in about this many MB of memory
+    'vector_tiles': True,  # If True, build a vector tile pyramid from the full history (not in incremental mode)
+    'flatgeobuf': True,  # If True, also write the latest day of each county as FlatGeobuf, for bounding box range requests
+    'by_date': True,  # If True, also write one small file per date, with a manifest, for time slider clients
+    'partitions': True,  # If True, also write one file per state and per county, with an index (not in incremental mode)
+}
 
 
 def main():
@@ -17,132 +33,218 @@ def main():
 
     The URL for the source data and information regarding the S3 bucket can
     be viewed and edited in the `./constants.py` folder also contained in this
-    `./source/backend` directory.
+    `./source/backend` directory. The options are set in `nyt_options` above.
+    The timings of the stages are written to a JSON run report (see `instrumentation.write_run_report`).
+
+    Each step is a stage function, which `./publish_all.py` also runs as a stage of the
+    nightly pipeline, alongside the PEESE stages.
     """
     start_time = datetime.now()
     print(f'\nRunning script : {os.path.abspath(__file__)}')
     print(f'Start time     : {start_time}')
 
-    gzip_output = True
-    colormap = 'plasma'
-    color_bins = 10
-    counties_geojson = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        'data',
-        'usa_counties.geojson'
-    ))
-    output_geojson = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        'dist',
-        'nyt',
-        'nyt-latest.geojson'
-    ))
-    slim_output_geojson = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        'dist',
-        'nyt',
-        'nyt-latest-slim.geojson'
-    ))
-    colormap_json = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        'dist',
-        'nyt',
-        'nyt-latest-colormap.json'
-    ))
-    # List of files to be uploaded to S3
+    start_run()
+    paths = nyt_paths()
+    with measure('nyt:fetch'):
+        nyt_source = fetch_nyt(paths, nyt_options)
+    nyt_data_frame = None
+    if nyt_source is not None:
+        with measure('nyt:build'):
+            nyt_data_frame = build_nyt(nyt_source, paths, nyt_options)
+    if nyt_data_frame is not None:
+        with measure('nyt:classify'):
+            colormap_json = classify_nyt(nyt_data_frame, paths, nyt_options)
+        with measure('nyt:tiles'):
+            tile_uploads = tile_nyt(nyt_data_frame, paths, nyt_options)
+        with measure('nyt:publish'):
+            publish_nyt(nyt_source, colormap_json, tile_uploads, paths, nyt_options)
+    write_run_report('publish_nyt_geojson', start_time)
+
+    end_time = datetime.now()
+    print(f'\nScript completed : {end_time}')
+    print(f'Run time         : {end_time-start_time}\n')
+
+def nyt_paths():
+    """The input and output locations of the NYT pipeline, in the `data` and `dist/nyt` directories
+    at the root of this repo
+
+    :returns paths: A dictionary of the locations by name
+    """
+    root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    nyt_dir = os.path.join(root_dir, 'dist', 'nyt')
+    return {
+        'counties_geojson': os.path.join(root_dir, 'data', 'usa_counties.geojson'),
+        'output_geojson': os.path.join(nyt_dir, 'nyt-latest.geojson'),
+        'slim_output_geojson': os.path.join(nyt_dir, 'nyt-latest-slim.geojson'),
+        'timeseries_output_geojson': os.path.join(nyt_dir, 'nyt-latest-timeseries.geojson'),
+        'topojson_output': os.path.join(nyt_dir, 'nyt-latest-slim.topojson'),
+        'flatgeobuf_output': os.path.join(nyt_dir, 'nyt-latest-day.fgb'),
+        'colormap_json': os.path.join(nyt_dir, 'nyt-latest-colormap.json'),
+        'publish_manifest_json': os.path.join(nyt_dir, 'nyt-publish-manifest.json'),
+        'state_json': os.path.join(nyt_dir, 'nyt-latest-state.json'),
+        'by_date_dir': os.path.join(nyt_dir, 'by-date'),
+        'partitions_dir': os.path.join(nyt_dir, 'partitions'),
+        'tiles_dir': os.path.join(nyt_dir, 'tiles'),
+    }
+
+def fetch_nyt(paths, options):
+    """Fetch the NYT CSV. The CSV is only downloaded when GitHub has a different version than the cached copy.
+    There is nothing to publish if its content is the one that was last published in full (see `published_sha256`).
+
+    :returns nyt_source: A `fetch_cache.FetchResult`, or None if there is nothing to publish
+    """
+    nyt_source = fetch_source(constants.nyt_csv_url)
+    if options['skip_unchanged_source'] and \
+            nyt_source.sha256 == published_sha256(nyt_source.url, paths['publish_manifest_json']):
+        print('\nThe NYT CSV has not changed since the last publish. Nothing to publish.')
+        return None
+    return nyt_source
+
+def build_nyt(nyt_source, paths, options):
+    """Merge the NYT CSV with the census counties, and write and compress the outputs (see `merge_nyt_with_census`)
+
+    :returns nyt_data_frame: The GeoDataFrame of the rows written by this run, or None if there are none
+    """
+    from make_nyt_geojson import merge_nyt_with_census
+    nyt_data_frame = merge_nyt_with_census(
+        nyt_source.filepath,
+        paths['counties_geojson'],
+        paths['output_geojson'],
+        slim_output=paths['slim_output_geojson'],
+        gzip=options['gzip_output'],
+        geojson_writer=options['geojson_writer'],
+        brotli=options['brotli_output'],
+        timeseries_output=paths['timeseries_output_geojson'],
+        topojson_output=paths['topojson_output'],
+        state_json=paths['state_json'] if options['incremental'] else None,
+        max_memory_mb=options['max_memory_mb'],
+        by_date_dir=paths['by_date_dir'] if options['by_date'] else None,
+        partitions_dir=paths['partitions_dir'] if options['partitions'] and not options['incremental'] else None,
+        flatgeobuf_output=paths['flatgeobuf_output'] if options['flatgeobuf'] else None,
+        tiles_dir=paths['tiles_dir'] if options['vector_tiles'] and not options['incremental'] else None
+    )
+    if nyt_data_frame.empty:
+        print('\nNo new NYT data to publish.')
+        return None
+    return nyt_data_frame
+
+def classify_nyt(nyt_data_frame, paths, options):
+    """Classify every metric in one pass over its values (see `constants.nyt_colormaps`) and write the colormap JSON.
+    In incremental mode and when the history is processed in chunks, not all of the rows are in memory, so the
+    whole history is classified from the quantile sketches of `nyt_data_frame.attrs` (see `merge_nyt_with_census`).
+
+    :returns colormap_json: The colormap JSON file location as a string
+    """
+    from colormap import make_colormaps
+    colormaps = make_colormaps(
+        nyt_data_frame,
+        constants.nyt_colormaps,
+        sketches=nyt_data_frame.attrs.get('sketches')
+    )
+
+    print(f'\nWriting NYT colormap JSON:\n {paths["colormap_json"]}')
+    with open(paths['colormap_json'], 'w') as colormap_file:
+        json.dump(colormaps, colormap_file)
+    return paths['colormap_json']
+
+def tile_nyt(nyt_data_frame, paths, options):
+    """Build the vector tile pyramid of the full history (see `make_nyt_tiles`), unless it is turned off
+    or in incremental mode. When the history is processed in chunks, the tiles were already built from the batches.
+
+    :returns tile_uploads: A list of the `(file, object_name, extra_args)` uploads of the tiles
+    """
+    if not options['vector_tiles'] or options['incremental']:
+        return []
+    if 'tile_files' in nyt_data_frame.attrs:
+        tile_files = nyt_data_frame.attrs['tile_files']
+    else:
+        from make_nyt_geojson import make_nyt_tiles
+        tile_files = make_nyt_tiles(nyt_data_frame, paths['tiles_dir'])
+    # Keep the z/x/y layout of the tiles dir in the S3 object names
+    return [
+        (
+            tile_file,
+            '/'.join([constants.nyt_tiles_prefix] + os.path.relpath(tile_file, paths['tiles_dir']).split(os.sep)),
+            None
+        ) for tile_file in tile_files
+    ]
+
+def publish_nyt(nyt_source, colormap_json, tile_uploads, paths, options):
+    """Upload the outputs to S3. Only files whose content changed since they were last published are uploaded.
+    The digest of the NYT CSV is recorded in the publish manifest once every file is published.
+
+    In incremental mode, the time series, TopoJSON, FlatGeobuf, vector tiles and state partitions are not
+    uploaded, as the appends do not refresh them. Run with `'incremental': False` to rebuild and publish them.
+    Incremental runs also need a state written with the quantile sketches of the whole history (by a full run
+    of this version, see `write_nyt_state`); otherwise the colormaps only classify the new rows.
+
+    :returns upload_results: A list of `cloud_functions.UploadResult` (see `publish_files_to_s3`)
+    """
+    # List of files to be uploaded to S3. An incremental run only refreshes the GeoJSON, the per date files and
+    # the colormap, so the outputs that only a full run writes are left as they were last published
     s3_upload_files = [
-        output_geojson,
-        slim_output_geojson,
-        colormap_json,
+        paths['output_geojson'],
+        paths['slim_output_geojson'],
     ]
-    if gzip_output:
-        # Add the gzip version if appropriate
+    if not options['incremental']:
         s3_upload_files += [
+            paths['timeseries_output_geojson'],
+            paths['topojson_output'],
+        ]
+    s3_upload_files.append(colormap_json)
+    compressed_files = []
+    if options['gzip_output']:
+        # Add the gzip version if appropriate
+        compressed_files += [
             geojson+'.gz' for geojson in s3_upload_files if 'colormap' not in geojson
         ]
+    if options['brotli_output']:
+        # Add the Brotli version if appropriate
+        compressed_files += [
+            geojson+'.br' for geojson in s3_upload_files if 'colormap' not in geojson
+        ]
+    s3_upload_files += compressed_files
+    if options['flatgeobuf'] and not options['incremental']:
+        # Not compressed, as clients read it with range requests
+        s3_upload_files.append(paths['flatgeobuf_output'])
 
-    nyt_data_frame = merge_nyt_with_census(
-        constants.nyt_csv_url,
-        counties_geojson,
-        output_geojson,
-        slim_output=slim_output_geojson,
-        gzip=gzip_output
-    )
+    # S3 Metadata is chosen based on the upload file extension. The full NYT GeoJSON is not uploaded.
+    s3_uploads = [
+        (upload_file, os.path.basename(upload_file), None) for upload_file in s3_upload_files
+        if os.path.basename(upload_file) != os.path.basename(paths['output_geojson'])
+    ]
+    s3_uploads += tile_uploads
 
-    print(f'\nAttempting to calculate {color_bins} equal count color bin of {colormap}')
-    cases_rgbs = get_rgbs(
-        nyt_data_frame.cases_per_100k.values.tolist(),
-        color_bins,
-        mode='equalcount',
-        colormap=colormap
-    )
+    if options['by_date']:
+        from date_partitions import date_partition_files
+        s3_uploads += [
+            (os.path.join(paths['by_date_dir'], by_date_file), f'{constants.nyt_by_date_prefix}/{by_date_file}', None)
+            for by_date_file in date_partition_files(paths['by_date_dir'])
+        ]
 
-    if len(cases_rgbs['cuts']['rgb_colors']) != color_bins:
-        try_color_bins = [
-            bin_count+i for i, bin_count in enumerate(range(1, color_bins+1))
+    if options['partitions'] and not options['incremental']:
+        # Keep the states/ and counties/ layout of the partitions dir in the S3 object names
+        s3_uploads += [
+            (
+                os.path.join(root, partition_file),
+                '/'.join(
+                    [constants.nyt_partitions_prefix]
+                    + os.path.relpath(os.path.join(root, partition_file), paths['partitions_dir']).split(os.sep)
+                ),
+                None
+            ) for root, _, partition_files in sorted(os.walk(paths['partitions_dir']))
+            for partition_file in sorted(partition_files)
         ]
-        for equal_count_bins in try_color_bins:
-            current_bin_count = len(cases_rgbs['cuts']['rgb_colors'])
-            print(f' Desired bins: {color_bins} | Current bins: {current_bin_count}')
-            cases_rgbs = get_rgbs(
-                nyt_data_frame.cases_per_100k.values.tolist(),
-                equal_count_bins,
-                mode='equalcount',
-                colormap=colormap
-            )
-            if len(cases_rgbs['cuts']['rgb_colors']) == color_bins:
-                current_bin_count = len(cases_rgbs['cuts']['rgb_colors']) 
-                print(f' Desired bins: {color_bins} | Current bins: {current_bin_count}')
-                print('  Equal Count Success!')
-                need_equal_interval = False
-                break
-            else:
-                need_equal_interval = True
-    else:
-        print(' success')
-        need_equal_interval = False
-
-    if need_equal_interval:
-        print('Falling back to equal interval color bin')
-        cases_rgbs = get_rgbs(
-            nyt_data_frame.cases_per_100k.values.tolist(),
-            color_bins,
-            mode='equalinterval',
-            colormap=colormap
-        )
-
-    print(f'\nWriting NYT colormap JSON:\n {colormap_json}')
-    with open(colormap_json, 'w') as colormap_file:
-        json.dump(cases_rgbs, colormap_file)
-
-    for upload_geojson_file in s3_upload_files:
-        # Choose S3 Metadata based on the upload file extension
-        if os.path.basename(upload_geojson_file) == os.path.basename(output_geojson):
-            print('  SKIPPING!')
-            continue
-        if upload_geojson_file.split('.')[-1] == 'gz':
-            extra_args = constants.gzip_extra_args
-        else:
-            extra_args = constants.json_extra_args
-        success = upload_file_to_s3(
-            upload_geojson_file,
-            constants.s3_bucket,
-            object_name=os.path.basename(upload_geojson_file),
-            extra_args=extra_args
-        )
-        print(f'S3 Upload success? {success}')
 
-    end_time = datetime.now()
-    print(f'\nScript completed : {end_time}')
-    print(f'Run time         : {end_time-start_time}\n')
+    from cloud_functions import publish_files_to_s3
+    upload_results = publish_files_to_s3(
+        s3_uploads,
+        constants.s3_bucket,
+        manifest_json=paths['publish_manifest_json'],
+        sources={nyt_source.url: nyt_source.sha256}
+    )
+    print(f'S3 Upload success? {all(result.success for result in upload_results)}')
+    return upload_results
 
 if __name__ == '__main__':
     main()
@@ -2,10 +2,22 @@ from datetime import datetime
 import json
 import os
 
-from cloud_functions import upload_file_to_s3
-from colormap import get_rgbs
 import constants
-from make_peese_geojson import merge_peese_with_census, prep_peese_csv
+from fetch_cache import fetch_source, published_sha256
+from instrumentation import measure, start_run, write_run_report
+# The pipeline, colormap and S3 stages are imported by the stage functions as they are reached,
+# so that runs that stop early (e.g. when the source has not changed) do not pay for importing
+# geopandas, shapely and boto3
+
+
+peese_options = {
+    'gzip_output': True,
+    'brotli_output': True,
+    'geojson_writer': 'stream',  # 'stream' writes every GeoJSON artifact in one pass; 'fiona' uses GeoDataFrame.to_file
+    'skip_unchanged_source': True,  # If True, stop early when the source CSV has not changed since the last publish
+    'flatgeobuf': True,  # If True, also write the latest day of each county as FlatGeobuf, for bounding box range requests
+    'by_date': True,  # If True, also write one small file per date, with a manifest, for time slider clients
+}
 
 
 def main():
@@ -17,134 +29,154 @@ def main():
 
     The URL for the source data and information regarding the S3 bucket can
     be viewed and edited in the `./constants.py` folder also contained in this
-    `./source/backend` directory.
+    `./source/backend` directory. The options are set in `peese_options` above.
+    The timings of the stages are written to a JSON run report (see `instrumentation.write_run_report`).
+
+    Each step is a stage function, which `./publish_all.py` also runs as a stage of the
+    nightly pipeline, alongside the NYT stages.
     """
     start_time = datetime.now()
     print(f'\nRunning script : {os.path.abspath(__file__)}')
     print(f'Start time     : {start_time}')
 
-    gzip_output = True
-    colormap = 'magma'
-    color_bins = 5
-    counties_geojson = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        'data',
-        'usa_counties.geojson'
-    ))
-    output_geojson = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        'dist',
-        'peese',
-        'peese-latest.geojson'
-    ))
-    slim_output_geojson = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        'dist',
-        'peese',
-        'peese-latest-slim.geojson'
-    ))
-    colormap_json = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        'dist',
-        'peese',
-        'peese-latest-colormap.json'
-    ))
-    # List of files to be uploaded to S3
-    s3_upload_files = [
-        output_geojson,
-        slim_output_geojson,
-        colormap_json,
-    ]
-    if gzip_output:
-        # Add the gzip version if appropriate
-        s3_upload_files += [
-            geojson+'.gz' for geojson in s3_upload_files if 'colormap' not in geojson
-        ]
+    start_run()
+    paths = peese_paths()
+    with measure('peese:fetch'):
+        peese_source = fetch_peese(paths, peese_options)
+    if peese_source is not None:
+        with measure('peese:build'):
+            peese_merged_df = build_peese(peese_source, paths, peese_options)
+        with measure('peese:classify'):
+            colormap_json = classify_peese(peese_merged_df, paths, peese_options)
+        with measure('peese:publish'):
+            publish_peese(peese_source, colormap_json, paths, peese_options)
+    write_run_report('publish_peese_geojson', start_time)
+
+    end_time = datetime.now()
+    print(f'\nScript completed : {end_time}')
+    print(f'Run time         : {end_time-start_time}\n')
+
+def peese_paths():
+    """The input and output locations of the PEESE pipeline, in the `data` and `dist/peese` directories
+    at the root of this repo
+
+    :returns paths: A dictionary of the locations by name
+    """
+    root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    peese_dir = os.path.join(root_dir, 'dist', 'peese')
+    return {
+        'counties_geojson': os.path.join(root_dir, 'data', 'usa_counties.geojson'),
+        'output_geojson': os.path.join(peese_dir, 'peese-latest.geojson'),
+        'slim_output_geojson': os.path.join(peese_dir, 'peese-latest-slim.geojson'),
+        'timeseries_output_geojson': os.path.join(peese_dir, 'peese-latest-timeseries.geojson'),
+        'topojson_output': os.path.join(peese_dir, 'peese-latest-slim.topojson'),
+        'flatgeobuf_output': os.path.join(peese_dir, 'peese-latest-day.fgb'),
+        'colormap_json': os.path.join(peese_dir, 'peese-latest-colormap.json'),
+        'by_date_dir': os.path.join(peese_dir, 'by-date'),
+        'publish_manifest_json': os.path.join(peese_dir, 'peese-publish-manifest.json'),
+    }
+
+def fetch_peese(paths, options):
+    """Fetch the PEESE CSV. The CSV is only downloaded when GitHub has a different version than the cached copy.
+    There is nothing to publish if its content is the one that was last published in full (see `published_sha256`).
+
+    :returns peese_source: A `fetch_cache.FetchResult`, or None if there is nothing to publish
+    """
+    peese_source = fetch_source(constants.peese_csv_url)
+    if options['skip_unchanged_source'] and \
+            peese_source.sha256 == published_sha256(peese_source.url, paths['publish_manifest_json']):
+        print('\nThe PEESE CSV has not changed since the last publish. Nothing to publish.')
+        return None
+    return peese_source
+
+def build_peese(peese_source, paths, options):
+    """Reformat the PEESE CSV, merge it with the census counties, and write and compress the outputs
+    (see `merge_peese_with_census`)
 
+    :returns peese_merged_df: The merged GeoDataFrame
+    """
+    from make_peese_geojson import merge_peese_with_census, prep_peese_csv
     peese_data_frame = prep_peese_csv(
-        constants.peese_csv_url,
+        peese_source.filepath,
         constants.county_fips
     )
 
-    peese_merged_df = merge_peese_with_census(
+    return merge_peese_with_census(
         peese_data_frame,
-        counties_geojson,
-        output_geojson,
-        slim_output=slim_output_geojson,
-        gzip=gzip_output
+        paths['counties_geojson'],
+        paths['output_geojson'],
+        slim_output=paths['slim_output_geojson'],
+        gzip=options['gzip_output'],
+        geojson_writer=options['geojson_writer'],
+        brotli=options['brotli_output'],
+        timeseries_output=paths['timeseries_output_geojson'],
+        topojson_output=paths['topojson_output'],
+        by_date_dir=paths['by_date_dir'] if options['by_date'] else None,
+        flatgeobuf_output=paths['flatgeobuf_output'] if options['flatgeobuf'] else None
     )
 
-    print(f'\nAttempting to calculate {color_bins} equal count color bin')
-    cases_rgbs = get_rgbs(
-        peese_merged_df.cases_per_100k.values.tolist(),
-        color_bins,
-        mode='equalcount',
-        colormap=colormap
-    )
+def classify_peese(peese_merged_df, paths, options):
+    """Classify every metric in one pass over its values (see `constants.peese_colormaps`) and write the colormap JSON
+
+    :returns colormap_json: The colormap JSON file location as a string
+    """
+    from colormap import make_colormaps
+    colormaps = make_colormaps(peese_merged_df, constants.peese_colormaps)
+
+    print(f'\nWriting colormap PEESE JSON:\n {paths["colormap_json"]}')
+    with open(paths['colormap_json'], 'w') as colormap_file:
+        json.dump(colormaps, colormap_file)
+    return paths['colormap_json']
 
-    if len(cases_rgbs['cuts']['rgb_colors']) != color_bins:
-        try_color_bins = [
-            bin_count+i for i, bin_count in enumerate(range(1, color_bins+1))
+def publish_peese(peese_source, colormap_json, paths, options):
+    """Upload the outputs to S3. Only files whose content changed since they were last published are uploaded.
+    The digest of the PEESE CSV is recorded in the publish manifest once every file is published.
+
+    :returns upload_results: A list of `cloud_functions.UploadResult` (see `publish_files_to_s3`)
+    """
+    # List of files to be uploaded to S3
+    s3_upload_files = [
+        paths['output_geojson'],
+        paths['slim_output_geojson'],
+        paths['timeseries_output_geojson'],
+        paths['topojson_output'],
+        colormap_json,
+    ]
+    compressed_files = []
+    if options['gzip_output']:
+        # Add the gzip version if appropriate
+        compressed_files += [
+            geojson+'.gz' for geojson in s3_upload_files if 'colormap' not in geojson
         ]
-        for equal_count_bins in try_color_bins:
-            current_bin_count = len(cases_rgbs['cuts']['rgb_colors'])
-            print(f' Desired bins: {color_bins} | Current bins: {current_bin_count}')
-            cases_rgbs = get_rgbs(
-                peese_merged_df.cases_per_100k.values.tolist(),
-                equal_count_bins,
-                mode='equalcount',
-                colormap=colormap
-            )
-            if len(cases_rgbs['cuts']['rgb_colors']) == color_bins:
-                current_bin_count = len(cases_rgbs['cuts']['rgb_colors']) 
-                print(f' Desired bins: {color_bins} | Current bins: {current_bin_count}')
-                print('  Equal Count Success!')
-                need_equal_interval = False
-                break
-            else:
-                need_equal_interval = True
-    else:
-        print(' success')
-        need_equal_interval = False
-
-    if need_equal_interval:
-        print('Falling back to equal interval color bin')
-        cases_rgbs = get_rgbs(
-            peese_merged_df.cases_per_100k.values.tolist(),
-            color_bins,
-            mode='equalinterval',
-            colormap=colormap
-        )
-
-    print(f'\nWriting colormap PEESE JSON:\n {colormap_json}')
-    with open(colormap_json, 'w') as colormap_file:
-        json.dump(cases_rgbs, colormap_file)
-
-    for upload_geojson_file in s3_upload_files:
-        # Choose S3 Metadata based on the upload file extension
-        if upload_geojson_file.split('.')[-1] == 'gz':
-            extra_args = constants.gzip_extra_args
-        else:
-            extra_args = constants.json_extra_args
-        success = upload_file_to_s3(
-            upload_geojson_file,
-            constants.s3_bucket,
-            object_name=os.path.basename(upload_geojson_file),
-            extra_args=extra_args
-        )
-        print(f'S3 Upload success? {success}')
+    if options['brotli_output']:
+        # Add the Brotli version if appropriate
+        compressed_files += [
+            geojson+'.br' for geojson in s3_upload_files if 'colormap' not in geojson
+        ]
+    s3_upload_files += compressed_files
+    if options['flatgeobuf'] and os.path.isfile(paths['flatgeobuf_output']):
+        # Not compressed, as clients read it with range requests. Not written if GDAL cannot write FlatGeobuf.
+        s3_upload_files.append(paths['flatgeobuf_output'])
 
-    end_time = datetime.now()
-    print(f'\nScript completed : {end_time}')
-    print(f'Run time         : {end_time-start_time}\n')
+    # S3 Metadata is chosen based on the upload file extension
+    s3_uploads = [
+        (upload_file, os.path.basename(upload_file), None) for upload_file in s3_upload_files
+    ]
+    if options['by_date']:
+        from date_partitions import date_partition_files
+        s3_uploads += [
+            (os.path.join(paths['by_date_dir'], by_date_file), f'{constants.peese_by_date_prefix}/{by_date_file}', None)
+            for by_date_file in date_partition_files(paths['by_date_dir'])
+        ]
+    from cloud_functions import publish_files_to_s3
+    upload_results = publish_files_to_s3(
+        s3_uploads,
+        constants.s3_bucket,
+        manifest_json=paths['publish_manifest_json'],
+        sources={peese_source.url: peese_source.sha256}
+    )
+    print(f'S3 Upload success? {all(result.success for result in upload_results)}')
+    return upload_results
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,175 @@
+import math
+
+import numpy as np
+
+import constants
+from transforms import plain_dtypes
+
+
+class KLLSketch:
+    """A KLL quantile sketch (Karnin, Lang & Liberty, "Optimal Quantile Approximation in Streams", 2016).
+
+    The sketch summarizes a stream of numbers in a few hundred items, however many values it
+    has seen, so that the quantiles of a whole history can be estimated without holding the
+    history in memory. Values are added in batches (e.g. one per chunk or partition of the
+    data), sketches of different batches can be merged, and a sketch can be saved to JSON and
+    loaded again to continue it in the next (incremental) run.
+
+    The items are kept in levels. An item on level `h` stands for 2**h values. When a level
+    holds more items than its capacity, it is sorted and every other item (starting at a random
+    offset) is promoted to the next level, and the rest are dropped. The capacity of the top
+    level is `k`, and shrinks by a factor 2/3 for each level below, down to a minimum of 8.
+
+    Error bound: with probability 99%, the rank of a quantile returned by the sketch is within
+    `rank_error` (as a fraction of the count of values) of the rank that was asked for. It is
+    about 2.296 / k**0.9723, i.e. 1.33% for the default k of 200 (the empirical bound of the
+    Apache DataSketches KLL sketch, which uses the same capacities). The min, the max and the
+    count of values are exact.
+    """
+    capacity_ratio = 2 / 3
+    min_capacity = 8
+
+    def __init__(self, k=None, seed=0):
+        """
+        :param k: Defaults None. The capacity of the top level, which sets the accuracy and the size
+            of the sketch. Falls back to `constants.quantile_sketch_k`
+        :param seed: Defaults 0. Seed of the random offsets of the compactions. Sketches built from
+            the same values with the same seed are the same.
+        """
+        self.k = k or constants.quantile_sketch_k
+        self.seed = seed
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.compactions = 0
+        self.levels = [np.empty(0)]
+
+    @property
+    def rank_error(self):
+        return 2.296 / self.k**0.9723
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(self.min_capacity, int(math.ceil(self.k * self.capacity_ratio**depth)))
+
+    def update(self, values):
+        """Add a batch of values (a list or NumPy array) to the sketch. Missing values (NaN) are ignored.
+
+        :returns self:
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+        self.count += int(values.size)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        return self
+
+    def merge(self, other):
+        """Merge another sketch into this one, e.g. the sketch of another partition of the data
+
+        :returns self:
+        """
+        if other.count == 0:
+            return self
+        self.k = min(self.k, other.k)
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.compress()
+        return self
+
+    def compress(self):
+        """Compact the levels that are over capacity, from the bottom up, until none are"""
+        compacted = True
+        while compacted:
+            compacted = False
+            for level in range(len(self.levels)):
+                items = self.levels[level]
+                if items.size <= self.capacity(level):
+                    continue
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                # The offset of each compaction is drawn from the seed and the number of compactions so far,
+                # so a sketch that is saved and loaded continues exactly as if it had not been
+                offset = int(np.random.default_rng([self.seed, self.compactions]).integers(2))
+                items = np.sort(items)
+                kept = items[items.size % 2:]
+                self.levels[level] = items[:items.size % 2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], kept[offset::2]])
+                self.compactions += 1
+                compacted = True
+
+    def weighted_values(self):
+        """The distinct values of the sketch and the number of values that each stands for.
+        The exact min and max are included (with a weight of 1), so that they are always the
+        first and last values.
+
+        :returns distinct, weights: Two NumPy arrays, with the values sorted
+        """
+        if self.count == 0:
+            return np.empty(0), np.empty(0, dtype=np.int64)
+        items = np.concatenate(self.levels + [np.array([self.min, self.max])])
+        weights = np.concatenate(
+            [np.full(level_items.size, 2**level, dtype=np.int64) for level, level_items in enumerate(self.levels)]
+            + [np.ones(2, dtype=np.int64)]
+        )
+        distinct, inverse = np.unique(items, return_inverse=True)
+        return distinct, np.bincount(inverse, weights).astype(np.int64)
+
+    def quantiles(self, fractions):
+        """Estimate the quantiles of the values added to the sketch (see the error bound above)
+
+        :param fractions: A list of fractions between 0 and 1, e.g. [0.25, 0.5, 0.75]
+
+        :returns quantiles: A NumPy array with the value at each fraction
+        """
+        distinct, weights = self.weighted_values()
+        if distinct.size == 0:
+            return np.full(len(fractions), np.nan)
+        cumulative = np.cumsum(weights)
+        positions = np.searchsorted(cumulative, np.asarray(fractions, dtype=float) * cumulative[-1])
+        return distinct[np.minimum(positions, distinct.size - 1)]
+
+    def to_dict(self):
+        """The sketch as a dictionary that can be dumped as JSON (see `from_dict`)"""
+        return {
+            'k': self.k,
+            'seed': self.seed,
+            'count': self.count,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'compactions': self.compactions,
+            'levels': [items.tolist() for items in self.levels],
+        }
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        """Load a sketch saved with `to_dict`"""
+        sketch = cls(k=sketch_dict['k'], seed=sketch_dict['seed'])
+        sketch.count = sketch_dict['count']
+        if sketch.count:
+            sketch.min = sketch_dict['min']
+            sketch.max = sketch_dict['max']
+        sketch.compactions = sketch_dict['compactions']
+        sketch.levels = [np.array(items, dtype=float) for items in sketch_dict['levels']]
+        return sketch
+
+def update_sketches(sketches, data_frame, fields):
+    """Add the values of `fields` of a frame (e.g. one batch of rows) to a dictionary of sketches,
+    one per field. Sketches are created for the fields that do not have one yet. The values are
+    taken as they are written to the outputs (see `transforms.plain_dtypes`).
+
+    :returns sketches: The updated dictionary of field name to `KLLSketch`
+    """
+    values = plain_dtypes(data_frame[list(fields)])
+    for field in fields:
+        sketches.setdefault(field, KLLSketch()).update(values[field].to_numpy(dtype=float, na_value=np.nan))
+    return sketches
@@ -0,0 +1,150 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from timeseries_geojson import json_value, timeseries_features
+
+
+def write_state_partitions(county_cases, output_dir, url_prefix, static_fields, series_fields, state_field='state',
+                           id_field='fips', date_field='date', dates=None):
+    """Write the long formatted (one row per county per day) cases data as one artifact per state
+    and one compact time series per county, for the state and county views of the apps, along with
+    an `index.json` that lists the states and counties, and the URLs and sizes of their files.
+
+    The state artifacts are time series GeoJSON (see `write_timeseries_geojson`), written to
+    `<output_dir>/states/<state>.geojson`, with the state name in lower case and hyphens for spaces.
+    The county files are written to `<output_dir>/counties/<fips>.json`, without the geometry,
+    and start at the first day that the county has a value:
+
+        {"fips": "36001", "county": "Albany", ..., "dates": [1584014400000, ...], "cases": [1, ...], ...}
+
+    :param county_cases: A GeoDataFrame in long format, with the dates in epoch milliseconds.
+        Or an iterable of GeoDataFrames (batches of rows), in which all of the rows of a county are
+        in the same batch. The rows of a state can be in several batches.
+    :param output_dir: Directory on disk where the files are written, e.g. `dist/nyt/partitions`
+    :param url_prefix: The public URL of `output_dir`, used for the URLs in the index
+    :param static_fields: List of fields that do not change over time, written once per county
+    :param series_fields: List of fields that are written as daily arrays
+    :param state_field: Defaults 'state'. The field holding the state name of each row
+    :param id_field: Defaults 'fips'. The field that identifies a county
+    :param date_field: Defaults 'date'. The field holding the date of each row (epoch milliseconds)
+    :param dates: Defaults None. The sorted dates of the whole collection. Taken from
+        `county_cases` if None, which is required when `county_cases` is an iterable of batches.
+
+    :returns output_files: A list of the files that were written, with the index last
+    """
+    print(f'\nWriting one file per state and per county:\n {output_dir}')
+    print(f' Static Fields:\n  {static_fields}\n Series Fields:\n  {series_fields}')
+    if isinstance(county_cases, pd.DataFrame):
+        if dates is None:
+            dates = np.sort(county_cases.loc[~county_cases[id_field].isnull(), date_field].unique())
+        batches = [county_cases]
+    else:
+        batches = county_cases
+    dates = [json_value(date) for date in dates]
+    static_fields = list(dict.fromkeys([id_field] + list(static_fields)))
+
+    states_dir = os.path.join(output_dir, 'states')
+    counties_dir = os.path.join(output_dir, 'counties')
+    for partition_dir in [states_dir, counties_dir]:
+        if not os.path.isdir(partition_dir):
+            os.makedirs(partition_dir)
+
+    # The state files stay open, as the counties of a state can come in several batches
+    state_files = {}
+    index = {}
+    county_files = []
+    try:
+        for batch in batches:
+            batch = batch.loc[~batch[id_field].isnull() & ~batch[state_field].isnull()]
+            if batch.shape[0] == 0:
+                continue
+            for state, state_cases in batch.groupby(state_field, sort=False, observed=True):
+                features = timeseries_features(
+                    state_cases,
+                    dates,
+                    list(dict.fromkeys(static_fields + [state_field])),
+                    series_fields,
+                    id_field,
+                    date_field
+                )
+                if not features:
+                    continue
+                state_name = os.path.basename(state_filepath(states_dir, state))
+                if state not in state_files:
+                    state_files[state] = open(os.path.join(states_dir, state_name), 'w')
+                    state_files[state].write('{"type":"FeatureCollection","dates":')
+                    json.dump(dates, state_files[state], separators=(',', ':'))
+                    state_files[state].write(',"features":[')
+                    index[state] = {
+                        'state': state,
+                        'url': f'{url_prefix}/states/{state_name}',
+                        'bytes': None,
+                        'counties': [],
+                    }
+                else:
+                    state_files[state].write(',')
+                state_files[state].write(','.join(json.dumps(feature, separators=(',', ':')) for feature in features))
+
+                for feature in features:
+                    county_file = write_county_series(
+                        feature['properties'],
+                        dates,
+                        counties_dir,
+                        static_fields,
+                        series_fields,
+                        id_field
+                    )
+                    county_files.append(county_file)
+                    index[state]['counties'].append({
+                        id_field: feature['properties'][id_field],
+                        'url': f'{url_prefix}/counties/{os.path.basename(county_file)}',
+                        'bytes': os.path.getsize(county_file),
+                    })
+    finally:
+        for state_file in state_files.values():
+            state_file.write(']}')
+            state_file.close()
+
+    state_paths = []
+    for state in sorted(index):
+        state_paths.append(state_filepath(states_dir, state))
+        index[state]['bytes'] = os.path.getsize(state_paths[-1])
+        index[state]['counties'].sort(key=lambda county: county[id_field])
+
+    index_json = os.path.join(output_dir, 'index.json')
+    with open(index_json, 'w') as index_file:
+        json.dump({
+            'first_date': dates[0] if dates else None,
+            'last_date': dates[-1] if dates else None,
+            'states': [index[state] for state in sorted(index)],
+        }, index_file, indent=2)
+    print(f' {len(state_paths)} state files and {len(county_files)} county files written')
+
+    return state_paths + county_files + [index_json]
+
+def state_filepath(states_dir, state):
+    """The file of a state, named after the state in lower case with hyphens for spaces"""
+    return os.path.join(states_dir, f'{str(state).lower().replace(" ", "-")}.geojson')
+
+def write_county_series(properties, dates, counties_dir, static_fields, series_fields, id_field='fips'):
+    """Write the time series properties of one county (a feature of `timeseries_features`)
+    to `<counties_dir>/<fips>.json`, without the days before the first value of the county
+
+    :returns county_file: The county file location as a string
+    """
+    first = next(
+        (i for i in range(len(dates)) if any(properties[field][i] is not None for field in series_fields)),
+        len(dates)
+    )
+    county = {field: properties[field] for field in static_fields}
+    county['dates'] = dates[first:]
+    for field in series_fields:
+        county[field] = properties[field][first:]
+
+    county_file = os.path.join(counties_dir, f'{properties[id_field]}.json')
+    with open(county_file, 'w') as county_out:
+        json.dump(county, county_out, separators=(',', ':'))
+    return county_file
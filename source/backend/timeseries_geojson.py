@@ -0,0 +1,123 @@
+import json
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import mapping
+
+from transforms import make_output_dir, plain_dtypes
+
+
+def write_timeseries_geojson(county_cases, output_geojson, static_fields, series_fields, id_field='fips', date_field='date',
+                             dates=None):
+    """Write the long formatted (one row per county per day) cases data as a GeoJSON
+    FeatureCollection with one feature per county. The geometry and the `static_fields`
+    of each county are written once, and the `series_fields` are written as arrays that
+    are indexed against a `dates` array shared by the whole collection, e.g.
+    `feature['properties']['cases'][i]` is the case count on `collection['dates'][i]`.
+    Days without a value for a county are written as null.
+
+    :param county_cases: A GeoDataFrame in long format, such as the one returned by
+        `merge_nyt_with_census` or `merge_peese_with_census`. Or an iterable of GeoDataFrames
+        (batches of rows), in which all of the rows of a county are in the same batch.
+    :param output_geojson: A filepath on disk where the GeoJSON will be saved
+    :param static_fields: List of fields that do not change over time (census attributes).
+        The value from the first row of each county is written.
+    :param series_fields: List of fields that are written as daily arrays
+    :param id_field: Defaults 'fips'. The field that identifies a county
+    :param date_field: Defaults 'date'. The field holding the date of each row. The date
+        values are written to the `dates` array as they are (epoch milliseconds in this project)
+    :param dates: Defaults None. The sorted dates of the whole collection. Taken from
+        `county_cases` if None, which is required when `county_cases` is an iterable of batches.
+
+    :returns output_geojson: Returns the output geojson file location as a string
+    """
+    print(f'\nWriting time series GeoJSON with one feature per county:\n {output_geojson}')
+    print(f' Static Fields:\n  {static_fields}\n Series Fields:\n  {series_fields}')
+    if isinstance(county_cases, pd.DataFrame):
+        if dates is None:
+            dates = np.sort(county_cases.loc[~county_cases[id_field].isnull(), date_field].unique())
+        batches = [county_cases]
+    else:
+        batches = county_cases
+
+    # The collection is written as it would be by `json.dump`, with the features streamed batch by batch
+    make_output_dir(output_geojson)
+    feature_count = 0
+    with open(output_geojson, 'w') as geojson_file:
+        geojson_file.write('{"type":"FeatureCollection","dates":')
+        json.dump([json_value(date) for date in dates], geojson_file, separators=(',', ':'))
+        geojson_file.write(',"features":[')
+        for batch in batches:
+            features = timeseries_features(batch, dates, static_fields, series_fields, id_field, date_field)
+            if not features:
+                continue
+            if feature_count:
+                geojson_file.write(',')
+            geojson_file.write(','.join(json.dumps(feature, separators=(',', ':')) for feature in features))
+            feature_count += len(features)
+        geojson_file.write(']}')
+    print(f' {feature_count} features with {len(dates)} dates')
+
+    return output_geojson
+
+def timeseries_features(county_cases, dates, static_fields, series_fields, id_field='fips', date_field='date'):
+    """Build the time series features of the counties in a long formatted GeoDataFrame,
+    with the daily values indexed against `dates` (see `write_timeseries_geojson`)
+
+    :returns features: A list of GeoJSON feature dictionaries, one per county
+    """
+    columns = list(dict.fromkeys([id_field, date_field] + list(static_fields) + list(series_fields) + ['geometry']))
+    county_cases = plain_dtypes(county_cases.loc[~county_cases[id_field].isnull(), columns])
+    counties = county_cases.drop_duplicates(id_field).set_index(id_field, drop=False)
+
+    series = {}
+    for field in series_fields:
+        table = county_cases.pivot_table(
+            index=id_field,
+            columns=date_field,
+            values=field,
+            aggfunc='first'
+        ).reindex(index=counties.index, columns=dates)
+        series[field] = series_to_lists(table.values)
+
+    columns = list(dict.fromkeys([id_field] + list(static_fields) + ['geometry']))
+    features = []
+    for i, county in enumerate(counties[columns].to_dict('records')):
+        properties = {
+            field: json_value(county[field]) for field in static_fields
+        }
+        for field in series_fields:
+            properties[field] = series[field][i]
+        features.append({
+            'type': 'Feature',
+            'id': str(county[id_field]),
+            'properties': properties,
+            'geometry': mapping(county['geometry']),
+        })
+    return features
+
+def series_to_lists(values):
+    """Convert a 2D array of (county, date) values to nested lists that can be dumped
+    as JSON. NaN becomes None, and fields that only hold whole numbers are written as ints.
+
+    :param values: A 2D NumPy array of floats
+
+    :returns list: A list of lists, one per county
+    """
+    values = values.astype(float)
+    missing = np.isnan(values)
+    valid = values[~missing]
+    if np.all(np.mod(valid, 1) == 0):
+        out = np.where(missing, 0, values).astype(np.int64).astype(object)
+    else:
+        out = values.astype(object)
+    out[missing] = None
+    return out.tolist()
+
+def json_value(value):
+    """Coerce NumPy scalars (and NaN) to types that the json module can encode"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
@@ -0,0 +1,220 @@
+import json
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import MultiPolygon, Polygon
+
+from geojson_writer import property_records
+from transforms import make_output_dir
+
+
+def write_topojson(geo_data_frame, output_topojson, fields, object_name='counties', id_field='fips',
+                   quantization=1e5, shapes=None):
+    """Write a GeoDataFrame of (Multi)Polygons as TopoJSON (https://github.com/topojson/topojson-specification).
+
+    The coordinates are quantized to a `quantization` x `quantization` integer grid. The boundary
+    that two adjacent counties share is stored once as an arc, which both geometries reference
+    (in opposite directions), and the arcs are delta-encoded. Rows that share the same `id_field`
+    value (one row per county per day in the long formatted cases data) share the same arcs, so
+    each county geometry is only encoded once.
+
+    :param geo_data_frame: The GeoDataFrame to write, or an iterable of GeoDataFrames (batches of rows)
+    :param output_topojson: A filepath on disk where the TopoJSON will be saved
+    :param fields: List of fields to write as the properties of each geometry
+    :param object_name: Defaults 'counties'. Name of the GeometryCollection in the topology's objects
+    :param id_field: Defaults 'fips'. Field that identifies rows with the same geometry
+    :param quantization: Defaults 1e5. The number of distinct x and y values after quantizing
+    :param shapes: Defaults None. A GeoDataFrame with one row per `id_field` value, holding the
+        geometries that are encoded as arcs. Taken from `geo_data_frame` if None, which is
+        required when `geo_data_frame` is an iterable of batches.
+
+    :returns output_topojson: Returns the output topojson file location as a string
+    """
+    print(f'\nWriting TopoJSON:\n {output_topojson}\n Fields:\n  {fields}')
+    if isinstance(geo_data_frame, pd.DataFrame):
+        geo_data_frame = geo_data_frame.loc[~geo_data_frame.geometry.isnull()]
+        if shapes is None:
+            shapes = geo_data_frame.drop_duplicates(id_field)
+        batches = [geo_data_frame]
+    else:
+        batches = geo_data_frame
+    shapes = shapes.loc[~shapes.geometry.isnull()]
+
+    minx, miny, maxx, maxy = shapes.geometry.total_bounds
+    scale = [
+        (maxx - minx) / (quantization - 1) if maxx > minx else 1,
+        (maxy - miny) / (quantization - 1) if maxy > miny else 1,
+    ]
+    translate = [minx, miny]
+
+    # Quantize every ring of every shape as a list of (x, y) integer tuples
+    shape_rings = {}
+    for shape_id, geometry in zip(shapes[id_field], shapes.geometry):
+        shape_rings[shape_id] = [
+            [quantize_ring(ring, translate, scale) for ring in polygon]
+            for polygon in polygon_rings(geometry)
+        ]
+
+    junctions = find_junctions(
+        ring for polygons in shape_rings.values() for rings in polygons for ring in rings
+    )
+
+    arcs = []
+    arc_indexes = {}
+    shape_arcs = {}
+    for shape_id, polygons in shape_rings.items():
+        polygon_arcs = []
+        for rings in polygons:
+            ring_arcs = []
+            for ring in rings:
+                if len(ring) < 4:
+                    continue
+                ring_arcs.append([
+                    arc_index(arc, arcs, arc_indexes) for arc in cut_ring(ring, junctions)
+                ])
+            if ring_arcs:
+                polygon_arcs.append(ring_arcs)
+        shape_arcs[shape_id] = polygon_arcs
+
+    # The topology is written as it would be by `json.dump`, with the geometries streamed batch by batch
+    header = json.dumps({
+        'type': 'Topology',
+        'bbox': [minx, miny, maxx, maxy],
+        'transform': {
+            'scale': scale,
+            'translate': translate,
+        },
+    }, separators=(',', ':'), default=json_default)
+    make_output_dir(output_topojson)
+    geometry_count = 0
+    with open(output_topojson, 'w') as topojson_file:
+        topojson_file.write(
+            header[:-1] + ',"objects":{' + json.dumps(object_name) + ':{"type":"GeometryCollection","geometries":['
+        )
+        for batch in batches:
+            batch = batch.loc[~batch.geometry.isnull()]
+            geometries = topojson_geometries(batch, fields, shape_arcs, id_field)
+            if not geometries:
+                continue
+            if geometry_count:
+                topojson_file.write(',')
+            topojson_file.write(','.join(
+                json.dumps(geometry, separators=(',', ':'), default=json_default) for geometry in geometries
+            ))
+            geometry_count += len(geometries)
+        topojson_file.write(']}},"arcs":')
+        json.dump([delta_encode(arc) for arc in arcs], topojson_file, separators=(',', ':'))
+        topojson_file.write('}')
+    print(f' {len(shape_arcs)} shapes encoded as {len(arcs)} arcs')
+
+    return output_topojson
+
+def topojson_geometries(geo_data_frame, fields, shape_arcs, id_field):
+    """Build the TopoJSON geometry objects of the rows of a GeoDataFrame, referencing the arcs of their shape"""
+    properties = property_records(geo_data_frame, fields)
+    geometries = []
+    for shape_id, feature_properties in zip(geo_data_frame[id_field], properties):
+        polygon_arcs = shape_arcs.get(shape_id)
+        if not polygon_arcs:
+            geometries.append({'type': None, 'properties': feature_properties})
+        elif len(polygon_arcs) == 1:
+            geometries.append({'type': 'Polygon', 'arcs': polygon_arcs[0], 'properties': feature_properties})
+        else:
+            geometries.append({'type': 'MultiPolygon', 'arcs': polygon_arcs, 'properties': feature_properties})
+    return geometries
+
+def polygon_rings(geometry):
+    """Return the rings of a (Multi)Polygon as a list of [exterior, *interiors] per polygon"""
+    if isinstance(geometry, Polygon):
+        polygons = [geometry]
+    elif isinstance(geometry, MultiPolygon):
+        polygons = list(geometry.geoms)
+    else:
+        polygons = []
+    return [[polygon.exterior] + list(polygon.interiors) for polygon in polygons if not polygon.is_empty]
+
+def quantize_ring(ring, translate, scale):
+    """Quantize a closed ring to integer grid coordinates, dropping repeated points"""
+    coords = np.asarray(ring.coords)
+    points = np.empty((len(coords), 2), dtype=np.int64)
+    points[:, 0] = np.round((coords[:, 0] - translate[0]) / scale[0])
+    points[:, 1] = np.round((coords[:, 1] - translate[1]) / scale[1])
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    return [tuple(point) for point in points[keep].tolist()]
+
+def find_junctions(rings):
+    """Find the points where the rings stop sharing a boundary. A point is a junction if it
+    is visited with different neighbors, e.g. where three counties meet, or where a shared
+    border reaches the coastline.
+
+    :param rings: An iterable of closed rings of integer (x, y) tuples
+
+    :returns junctions: A set of the junction points
+    """
+    neighbors = {}
+    junctions = set()
+    for ring in rings:
+        # The first and last point of a closed ring are the same point
+        count = len(ring) - 1
+        for i in range(count):
+            point = ring[i]
+            pair = frozenset((ring[i-1] if i else ring[count-1], ring[i+1]))
+            seen = neighbors.get(point)
+            if seen is None:
+                neighbors[point] = pair
+            elif seen != pair:
+                junctions.add(point)
+    return junctions
+
+def cut_ring(ring, junctions):
+    """Split a closed ring into arcs that start and end at junctions. A ring without
+    junctions is returned as one arc that starts at its smallest point, so that identical
+    rings (such as an enclave and the hole around it) produce identical arcs.
+    """
+    points = ring[:-1]
+    starts = [i for i, point in enumerate(points) if point in junctions]
+    if not starts:
+        start = points.index(min(points))
+        rotated = points[start:] + points[:start]
+        return [rotated + [rotated[0]]]
+
+    rotated = points[starts[0]:] + points[:starts[0]]
+    rotated.append(rotated[0])
+    arcs = []
+    arc = [rotated[0]]
+    for point in rotated[1:]:
+        arc.append(point)
+        if point in junctions:
+            arcs.append(arc)
+            arc = [point]
+    return arcs
+
+def arc_index(arc, arcs, arc_indexes):
+    """Return the index of `arc` in `arcs`, adding it if neither it nor its reverse is
+    there yet. A reversed arc is referenced by the one's complement of its index.
+    """
+    key = tuple(arc)
+    index = arc_indexes.get(key)
+    if index is not None:
+        return index
+    index = arc_indexes.get(key[::-1])
+    if index is not None:
+        return ~index
+    arc_indexes[key] = len(arcs)
+    arcs.append(arc)
+    return len(arcs) - 1
+
+def delta_encode(arc):
+    """Delta-encode a quantized arc: the first position is absolute, every following
+    position is relative to the previous one.
+    """
+    points = np.asarray(arc, dtype=np.int64)
+    points[1:] = np.diff(points, axis=0)
+    return points.tolist()
+
+def json_default(value):
+    """Coerce the NumPy scalars left in the properties to types the json module can encode"""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
@@ -0,0 +1,158 @@
+from datetime import timedelta
+import os
+
+import numpy as np
+import pandas as pd
+
+import constants
+from compression import compress_files, gzip_file
+from instrumentation import peak_rss_mb
+
+
+def parse_dates(dates, hours=12):
+    """Parse a Series of dates and shift them by `hours` (12 by default) to account for local
+    time adjustments in JS (esri in particular)
+
+    :param dates: A Series of date strings or datetimes
+    :param hours: Defaults 12. Number of hours to add to every date
+
+    :returns dates: A Series of pandas datetimes
+    """
+    return pd.to_datetime(dates) + timedelta(hours=hours)
+
+def epoch_milliseconds(dates):
+    """Convert a Series of datetimes to integer milliseconds since 1970-01-01, the date format
+    of the outputs, as one NumPy cast of the whole column
+
+    :param dates: A Series of pandas datetimes without missing values
+
+    :returns milliseconds: A Series of int64 with the same index
+    """
+    return pd.Series(
+        dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[ms]').astype(np.int64),
+        index=dates.index,
+        name=dates.name
+    )
+
+def per_100k(counts, population, decimals=3):
+    """Normalize a Series of counts by the population, per 100 000 people, rounded to `decimals`.
+
+    The values are rounded with Python's `round`, which rounds the exact decimal value of each float,
+    rather than with `Series.round`, which scales by a power of ten first and can round the other way.
+    """
+    rates = counts.astype(float) / population.astype(float) * 100000
+    return pd.Series(
+        [round(rate, decimals) for rate in rates.tolist()],
+        index=rates.index,
+        name=rates.name,
+        dtype=float
+    )
+
+def add_per_100k(data_frame, fields, population_field='population', decimals=3):
+    """Add a `<field>_per_100k` column for each field in `fields` (see `per_100k`)"""
+    return data_frame.assign(**{
+        f'{field}_per_100k': per_100k(data_frame[field], data_frame[population_field], decimals)
+        for field in fields
+    })
+
+def apply_schema(data_frame, schema=None):
+    """Cast the columns of a long formatted frame (one row per county per day) to compact dtypes:
+    categoricals for the names and FIPS codes, nullable Int32 for the counts, float32 for the
+    rates and datetime64 for the dates. Columns that are not in the schema, or not in the frame,
+    are left as they are.
+
+    A merge or concat of frames with different dtypes falls back to the wide NumPy dtypes,
+    so the schema is applied again after each of them.
+
+    :param data_frame: A DataFrame or GeoDataFrame
+    :param schema: Defaults None. Dictionary of column name to dtype. Falls back to `constants.case_frame_schema`
+
+    :returns data_frame: The frame with the compact dtypes
+    """
+    schema = constants.case_frame_schema if schema is None else schema
+    dtypes = {
+        column: dtype for column, dtype in schema.items()
+        if column in data_frame.columns and str(data_frame[column].dtype) != dtype
+    }
+    return data_frame.astype(dtypes) if dtypes else data_frame
+
+def plain_dtypes(data_frame, json_values=False):
+    """Convert the compact dtypes of `apply_schema` back to the NumPy dtypes that the writers
+    (and Fiona) handle: categoricals to object, nullable integers to int64 (float64 if there
+    are missing values) and float32 to float64. Float32 values are converted through their
+    shortest representation, so 12.345 is written as 12.345 rather than 12.345000267028809.
+
+    :param data_frame: A DataFrame or GeoDataFrame
+    :param json_values: Bool, defaults False. If True, nullable integers with missing values are converted
+        to objects (ints, and NA for the missing values) rather than float64, so that the JSON writers
+        write the counts as integers whichever rows are in the frame (e.g. in a batch of a chunked run)
+    """
+    columns = {}
+    for column, dtype in data_frame.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            columns[column] = data_frame[column].astype(object)
+        elif pd.api.types.is_extension_array_dtype(dtype) and pd.api.types.is_integer_dtype(dtype):
+            values = data_frame[column]
+            if not values.isnull().any():
+                columns[column] = values.astype(np.int64)
+            else:
+                columns[column] = values.astype(object) if json_values else values.astype(float)
+        elif dtype == np.float32:
+            columns[column] = pd.Series(
+                data_frame[column].to_numpy().astype(str).astype(np.float64),
+                index=data_frame.index
+            )
+    return data_frame.assign(**columns) if columns else data_frame
+
+def report_memory(label, data_frame):
+    """Print the memory used by a frame, and the peak memory of the process so far"""
+    frame_mb = data_frame.memory_usage(deep=True).sum() / 1024**2
+    peak_mb = peak_rss_mb()
+    if peak_mb is not None:
+        print(f'  Memory of {label}: {frame_mb:.1f} MB (process peak {peak_mb:.1f} MB)')
+    else:
+        print(f'  Memory of {label}: {frame_mb:.1f} MB')
+    return frame_mb
+
+def make_output_dir(output_filepath):
+    """Create the directory of an output file, if it does not exist yet"""
+    output_dir = os.path.dirname(output_filepath)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+        print(f'  Created output dir: {output_dir}')
+
+def gzip_geojson(input_filepath, output_filepath):
+    """Compress a file using gzip algorithm, in parallel blocks (see `compression.gzip_file`).
+    The level is chosen per artifact in `constants.compression_levels`
+
+    :param input_filepath: The file to be compressed
+    :param output_filepath: The file location to create a compressed copy of the input file
+
+    :returns bool: True on success.
+    """
+    levels = constants.compression_levels.get(os.path.basename(input_filepath), {})
+    gzip_file(input_filepath, output_filepath, level=levels.get('gzip'))
+    return True
+
+def compress_outputs(outputs, gzip=False, brotli=False, gzipped=()):
+    """Write the '.gz' and/or '.br' variants of the outputs of a pipeline
+
+    :param outputs: List of output files. None values (outputs that were not requested) are skipped.
+    :param gzip: Bool, defaults False. If True, a '.gz' variant is written for each output
+    :param brotli: Bool, defaults False. If True, a '.br' variant is written for each output
+    :param gzipped: Defaults empty. Outputs that already have a '.gz' variant, e.g. those that
+        were g-zipped as they were written, which are only Brotli compressed
+
+    :returns compressed_files: A list of the compressed files
+    """
+    outputs = [output for output in outputs if output]
+    compressed_files = []
+    if gzip:
+        compressed_files += compress_files(
+            [output for output in outputs if output not in gzipped],
+            gzip=True,
+            brotli=False
+        )
+    if brotli:
+        compressed_files += compress_files(outputs, gzip=False, brotli=True)
+    return compressed_files
@@ -0,0 +1,330 @@
+import json
+import math
+import os
+import struct
+
+import geopandas
+import numpy as np
+import pandas as pd
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.ops import clip_by_rect, transform
+
+from transforms import plain_dtypes
+
+
+EARTH_RADIUS = 6378137.0
+WORLD_HALF_SIZE = math.pi * EARTH_RADIUS  # Half the width of the Web Mercator world in meters
+MAX_LATITUDE = 85.0511287798              # Web Mercator is undefined at the poles
+
+
+def make_vector_tiles(county_cases, output_dir, tile_url, latest_fields, date_fields=None, min_zoom=0,
+                      max_zoom=7, layer_name='counties', id_field='fips', extent=4096, buffer=64,
+                      simplify_tolerance=4):
+    """Build a z/x/y pyramid of Mapbox Vector Tiles (https://github.com/mapbox/vector-tile-spec)
+    from the long formatted (one row per county per day) cases data, and a TileJSON manifest
+    that describes it (https://github.com/mapbox/tilejson-spec). Each county is encoded once
+    per tile with the attributes of its latest day, and optionally one property per date for
+    each of the `date_fields`, named `<field>_<YYYYMMDD>`.
+
+    Geometries are projected to Web Mercator, simplified for each zoom level, clipped to a
+    buffered tile boundary and quantized to the tile extent.
+
+    :param county_cases: A GeoDataFrame in long format, such as the one returned by `merge_nyt_with_census`,
+        or an iterable of GeoDataFrames (batches of rows), with all of the rows of a county in the same batch.
+        The `date` field is expected to hold epoch milliseconds.
+    :param output_dir: Directory on disk where the tiles are written as `{z}/{x}/{y}.pbf`,
+        along with `tiles.json`
+    :param tile_url: The public URL template of the tiles, e.g. `https://host/tiles/{z}/{x}/{y}.pbf`.
+        It is written to the TileJSON manifest.
+    :param latest_fields: List of fields whose value on the latest day of each county is encoded
+    :param date_fields: Defaults None. List of fields that are encoded for every date
+    :param min_zoom: Defaults 0. The smallest zoom level of the pyramid
+    :param max_zoom: Defaults 7. The largest zoom level of the pyramid
+    :param layer_name: Defaults 'counties'. Name of the vector tile layer
+    :param id_field: Defaults 'fips'. Numeric field that is used as the feature id when it is positive
+    :param extent: Defaults 4096. The number of integer units across a tile
+    :param buffer: Defaults 64. Number of tile units by which features extend past the tile edge,
+        so that polygon outlines do not show seams between tiles
+    :param simplify_tolerance: Defaults 4. Simplification tolerance in tile units
+
+    :returns tile_files: A list of the files that were written, with the TileJSON manifest last
+    """
+    print(f'\nBuilding vector tiles for zoom levels {min_zoom}-{max_zoom}:\n {output_dir}')
+    if isinstance(county_cases, pd.DataFrame):
+        county_cases = [county_cases]
+    # Only one row per county is kept of each batch, and the counties are ordered by id whatever the batches
+    counties = pd.concat(
+        [vector_tile_attributes(batch, latest_fields, date_fields or [], id_field) for batch in county_cases],
+        ignore_index=True
+    )
+    counties = counties.loc[~counties.geometry.isnull()].sort_values(id_field, kind='mergesort')
+    mercator = geopandas.GeoSeries(counties.geometry.apply(lambda geom: transform(lonlat_to_mercator, geom)))
+
+    tile_files = []
+    for zoom in range(min_zoom, max_zoom+1):
+        tile_size = 2 * WORLD_HALF_SIZE / 2**zoom
+        tolerance = tile_size / extent * simplify_tolerance
+        simplified = mercator.simplify(tolerance, preserve_topology=True)
+
+        # Find the tiles covered by each feature, then group the features by tile
+        tiles = {}
+        for i, geom in enumerate(simplified):
+            if geom is None or geom.is_empty:
+                continue
+            minx, miny, maxx, maxy = geom.bounds
+            min_col, max_row = mercator_to_tile(minx, miny, zoom)
+            max_col, min_row = mercator_to_tile(maxx, maxy, zoom)
+            for col in range(min_col, max_col+1):
+                for row in range(min_row, max_row+1):
+                    tiles.setdefault((col, row), []).append(i)
+
+        for (col, row), feature_indexes in sorted(tiles.items()):
+            layer = TileLayer(layer_name, extent)
+            bounds = tile_bounds(zoom, col, row)
+            clip_margin = tile_size / extent * buffer
+            clip_bounds = (
+                bounds[0] - clip_margin,
+                bounds[1] - clip_margin,
+                bounds[2] + clip_margin,
+                bounds[3] + clip_margin,
+            )
+            for i in feature_indexes:
+                clipped = clip_by_rect(simplified.iloc[i], *clip_bounds)
+                if clipped.is_empty:
+                    continue
+                geometry = encode_polygons(clipped, bounds, extent)
+                if not geometry:
+                    continue
+                layer.add_feature(geometry, counties.properties.iloc[i], counties.feature_id.iloc[i])
+            if not layer.features:
+                continue
+
+            tile_file = os.path.join(output_dir, str(zoom), str(col), f'{row}.pbf')
+            if not os.path.isdir(os.path.dirname(tile_file)):
+                os.makedirs(os.path.dirname(tile_file))
+            with open(tile_file, 'wb') as tile:
+                tile.write(encode_message_field(3, layer.encode()))
+            tile_files.append(tile_file)
+        print(f' Zoom {zoom}: {len(tiles)} tiles')
+
+    tilejson_file = os.path.join(output_dir, 'tiles.json')
+    west, south, east, north = geopandas.GeoSeries(counties.geometry).total_bounds
+    fields = {}
+    for properties in counties.properties:
+        for key, value in properties.items():
+            fields[key] = 'String' if isinstance(value, str) else 'Number'
+    tilejson = {
+        'tilejson': '2.2.0',
+        'name': layer_name,
+        'scheme': 'xyz',
+        'tiles': [tile_url],
+        'minzoom': min_zoom,
+        'maxzoom': max_zoom,
+        'bounds': [west, max(south, -MAX_LATITUDE), east, min(north, MAX_LATITUDE)],
+        'center': [(west + east) / 2, (south + north) / 2, min_zoom],
+        'vector_layers': [{
+            'id': layer_name,
+            'fields': fields,
+            'minzoom': min_zoom,
+            'maxzoom': max_zoom,
+        }],
+    }
+    print(f'\nWriting TileJSON manifest:\n {tilejson_file}')
+    with open(tilejson_file, 'w') as tilejson_out:
+        json.dump(tilejson, tilejson_out)
+    tile_files.append(tilejson_file)
+
+    return tile_files
+
+def vector_tile_attributes(county_cases, latest_fields, date_fields, id_field):
+    """Reduce the long formatted cases data to one row per county, holding the geometry,
+    a `properties` dictionary and a `feature_id` for the vector tiles.
+
+    :returns counties: A DataFrame with `id_field`, `geometry`, `properties` and `feature_id` columns
+    """
+    columns = list(dict.fromkeys([id_field, 'date'] + list(latest_fields) + list(date_fields) + ['geometry']))
+    county_cases = plain_dtypes(county_cases.loc[~county_cases[id_field].isnull(), columns], json_values=True)
+    latest = county_cases.sort_values('date', kind='mergesort').drop_duplicates(id_field, keep='last').set_index(id_field, drop=False)
+    properties = latest[latest_fields].copy()
+
+    if date_fields:
+        dates = pd.to_datetime(county_cases.date, unit='ms').dt.strftime('%Y%m%d')
+        for field in date_fields:
+            by_date = county_cases.assign(tile_date=dates).pivot_table(
+                index=id_field,
+                columns='tile_date',
+                values=field,
+                aggfunc='first'
+            )
+            by_date.columns = [f'{field}_{date}' for date in by_date.columns]
+            properties = properties.join(by_date)
+
+    records = [
+        {key: value for key, value in record.items() if not pd.isnull(value)}
+        for record in properties.to_dict('records')
+    ]
+    feature_ids = [
+        int(fips) if str(fips).isdigit() else None for fips in latest.index
+    ]
+    return pd.DataFrame({
+        id_field: latest.index.values,
+        'geometry': latest.geometry.values,
+        'properties': records,
+        'feature_id': pd.Series(feature_ids, dtype=object),
+    })
+
+def lonlat_to_mercator(x, y, z=None):
+    """Project longitude/latitude degrees to Web Mercator (EPSG:3857) meters"""
+    x = np.asarray(x, dtype=float)
+    y = np.clip(np.asarray(y, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    mercator_x = x * WORLD_HALF_SIZE / 180.0
+    mercator_y = np.log(np.tan((90.0 + y) * math.pi / 360.0)) * EARTH_RADIUS
+    return mercator_x, mercator_y
+
+def mercator_to_tile(x, y, zoom):
+    """Return the (column, row) of the XYZ tile at `zoom` that contains a Web Mercator point"""
+    tile_count = 2**zoom
+    tile_size = 2 * WORLD_HALF_SIZE / tile_count
+    col = int((x + WORLD_HALF_SIZE) // tile_size)
+    row = int((WORLD_HALF_SIZE - y) // tile_size)
+    return (
+        min(max(col, 0), tile_count - 1),
+        min(max(row, 0), tile_count - 1),
+    )
+
+def tile_bounds(zoom, col, row):
+    """Return the Web Mercator (minx, miny, maxx, maxy) of an XYZ tile"""
+    tile_size = 2 * WORLD_HALF_SIZE / 2**zoom
+    minx = col * tile_size - WORLD_HALF_SIZE
+    maxy = WORLD_HALF_SIZE - row * tile_size
+    return (minx, maxy - tile_size, minx + tile_size, maxy)
+
+def encode_polygons(geometry, bounds, extent):
+    """Encode a (Multi)Polygon in Web Mercator as vector tile geometry commands.
+
+    The coordinates are scaled to integer tile units with the y axis pointing down. Exterior
+    rings are wound clockwise and interior rings counter-clockwise, as required by the spec.
+    Rings that collapse to less than three points after quantizing are dropped.
+
+    :returns commands: A list of unsigned integers. Empty if nothing is left to draw.
+    """
+    if isinstance(geometry, Polygon):
+        polygons = [geometry]
+    elif isinstance(geometry, MultiPolygon):
+        polygons = list(geometry.geoms)
+    else:
+        # Clipping can produce collections with lines or points along the tile edge
+        polygons = [geom for geom in getattr(geometry, 'geoms', []) if isinstance(geom, Polygon)]
+
+    minx, miny, maxx, maxy = bounds
+    scale_x = extent / (maxx - minx)
+    scale_y = extent / (maxy - miny)
+
+    commands = []
+    cursor = [0, 0]
+    for polygon in polygons:
+        rings = [polygon.exterior] + list(polygon.interiors)
+        for ring_number, ring in enumerate(rings):
+            coords = np.asarray(ring.coords)
+            points = np.empty((len(coords), 2), dtype=np.int64)
+            points[:, 0] = np.round((coords[:, 0] - minx) * scale_x)
+            points[:, 1] = np.round((maxy - coords[:, 1]) * scale_y)
+            # Drop repeated points, and the closing point which is implied by ClosePath
+            keep = np.ones(len(points), dtype=bool)
+            keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+            points = points[keep]
+            if len(points) > 1 and np.all(points[0] == points[-1]):
+                points = points[:-1]
+            if len(points) < 3:
+                if ring_number == 0:
+                    break  # Skip the holes of a collapsed exterior ring
+                continue
+
+            area = np.sum(points[:, 0] * np.roll(points[:, 1], -1) - np.roll(points[:, 0], -1) * points[:, 1])
+            if area == 0:
+                if ring_number == 0:
+                    break
+                continue
+            if (ring_number == 0) != (area > 0):
+                points = points[::-1]
+
+            deltas = np.diff(np.vstack([cursor, points]), axis=0)
+            cursor = points[-1].tolist()
+            commands.append(command_integer(1, 1))
+            commands.extend(zigzag(int(value)) for value in deltas[0])
+            commands.append(command_integer(2, len(points) - 1))
+            commands.extend(zigzag(int(value)) for value in deltas[1:].ravel())
+            commands.append(command_integer(7, 1))
+    return commands
+
+def command_integer(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+class TileLayer:
+    """Accumulates the features of one vector tile layer, sharing the key and value
+    tables between the features as the spec intends.
+    """
+    def __init__(self, name, extent):
+        self.name = name
+        self.extent = extent
+        self.features = []
+        self.keys = {}
+        self.values = {}
+
+    def add_feature(self, geometry, properties, feature_id=None):
+        tags = []
+        for key, value in properties.items():
+            if isinstance(value, np.generic):
+                value = value.item()
+            tags.append(self.keys.setdefault(key, len(self.keys)))
+            tags.append(self.values.setdefault((type(value), value), len(self.values)))
+
+        feature = b''
+        if feature_id is not None:
+            feature += encode_varint_field(1, feature_id)
+        feature += encode_message_field(2, b''.join(encode_varint(tag) for tag in tags))
+        feature += encode_varint_field(3, 3)  # GeomType POLYGON
+        feature += encode_message_field(4, b''.join(encode_varint(command) for command in geometry))
+        self.features.append(feature)
+
+    def encode(self):
+        layer = encode_varint_field(15, 2)  # Version 2 of the spec
+        layer += encode_message_field(1, self.name.encode('utf-8'))
+        layer += b''.join(encode_message_field(2, feature) for feature in self.features)
+        layer += b''.join(
+            encode_message_field(3, key.encode('utf-8')) for key in self.keys
+        )
+        layer += b''.join(
+            encode_message_field(4, encode_value(value)) for _, value in self.values
+        )
+        layer += encode_varint_field(5, self.extent)
+        return layer
+
+def encode_value(value):
+    """Encode a property value as a vector tile `Value` message"""
+    if isinstance(value, bool):
+        return encode_varint_field(7, int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return encode_varint_field(5, value)
+        return encode_varint_field(6, zigzag(value))
+    if isinstance(value, float):
+        return encode_varint(3 << 3 | 1) + struct.pack('<d', value)
+    return encode_message_field(1, str(value).encode('utf-8'))
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def encode_varint_field(field_number, value):
+    return encode_varint(field_number << 3) + encode_varint(value)
+
+def encode_message_field(field_number, message):
+    return encode_varint(field_number << 3 | 2) + encode_varint(len(message)) + message
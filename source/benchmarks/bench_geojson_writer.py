@@ -0,0 +1,97 @@
+from datetime import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'backend'
+)))
+
+import constants
+from geojson_writer import write_geojson
+from make_nyt_geojson import merge_nyt_with_census
+
+
+def benchmark_geojson_writers(county_cases, output_dir, fields=None, repeat=3):
+    """Time `GeoDataFrame.to_file` (Fiona/OGR) against the streaming `write_geojson`
+    on the same frame, and print the best time of each, the output size and the speedup.
+
+    :param county_cases: The GeoDataFrame to write
+    :param output_dir: Directory where the benchmark outputs are written
+    :param fields: Defaults None. List of fields to write, including 'geometry'. All fields if None.
+    :param repeat: Defaults 3. Number of times each writer is run
+
+    :returns results: A dictionary of writer name to `{'seconds': ..., 'bytes': ...}`
+    """
+    if fields:
+        county_cases = county_cases[fields]
+    writers = {
+        'fiona': lambda path: county_cases.to_file(path, driver='GeoJSON'),
+        'stream': lambda path: write_geojson(county_cases, path),
+        'stream (precision 6)': lambda path: write_geojson(county_cases, path, precision=6),
+    }
+
+    print(f'\nBenchmarking GeoJSON writers on {county_cases.shape[0]} rows, best of {repeat}')
+    results = {}
+    for i, (writer_name, writer) in enumerate(writers.items()):
+        output_geojson = os.path.join(output_dir, f'bench_{i}.geojson')
+        timings = []
+        for _ in range(repeat):
+            if os.path.isfile(output_geojson):
+                os.remove(output_geojson)
+            start = time.perf_counter()
+            writer(output_geojson)
+            timings.append(time.perf_counter() - start)
+        results[writer_name] = {
+            'seconds': min(timings),
+            'bytes': os.path.getsize(output_geojson),
+        }
+
+    baseline = results['fiona']['seconds']
+    print(f'\n{"Writer":<22}{"Seconds":>10}{"MB":>10}{"Speedup":>10}')
+    for writer_name, result in results.items():
+        print(
+            f'{writer_name:<22}{result["seconds"]:>10.2f}{result["bytes"] / 1e6:>10.1f}'
+            f'{baseline / result["seconds"]:>9.1f}x'
+        )
+    return results
+
+def main():
+    """Benchmark the GeoJSON writers on the merged NYT data. The NYT CSV and the counties
+    GeoJSON can be given on the command line, e.g. to run offline on local copies:
+
+        python source/benchmarks/bench_geojson_writer.py us-counties.csv data/usa_counties.geojson
+    """
+    start_time = datetime.now()
+    print(f'\nRunning script : {os.path.abspath(__file__)}')
+    print(f'Start time     : {start_time}')
+
+    csv_url = sys.argv[1] if len(sys.argv) > 1 else constants.nyt_csv_url
+    counties_geojson = sys.argv[2] if len(sys.argv) > 2 else os.path.abspath(os.path.join(
+        os.path.dirname(__file__),
+        '..',
+        '..',
+        'data',
+        'usa_counties.geojson'
+    ))
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        county_cases = merge_nyt_with_census(
+            csv_url,
+            counties_geojson,
+            os.path.join(output_dir, 'nyt-latest.geojson'),
+            geojson_writer='stream'
+        )
+        benchmark_geojson_writers(county_cases, output_dir)
+        benchmark_geojson_writers(county_cases, output_dir, fields=constants.nyt_slim_fields)
+
+    end_time = datetime.now()
+    print(f'\nScript completed : {end_time}')
+    print(f'Run time         : {end_time-start_time}\n')
+
+
+if __name__ == '__main__':
+    main()
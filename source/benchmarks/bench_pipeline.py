@@ -0,0 +1,241 @@
+import argparse
+from datetime import datetime
+from functools import partial
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'backend'
+)))
+
+import constants
+import instrumentation
+from synthetic_data import make_synthetic_data, scaled_sizes
+
+
+def benchmark_pipeline(files, work_dir, repeat=3, trace_memory=True):
+    """Time the pipeline stages on synthetic data, offline: the PEESE CSV prep and merge, the NYT merge,
+    the class breaks of the colormap and the gzip compression. Each stage is run `repeat` times and the
+    best run is kept, then once more with tracemalloc on for the peak of the Python allocations
+    (which slows the run down, so it is not timed).
+
+    Each stage is a function of the record of its measurements, on which it sets the rows it processed
+    and the bytes it wrote.
+
+    :param files: The synthetic data files (see `synthetic_data.make_synthetic_data`)
+    :param work_dir: Directory where the outputs and the caches are written
+    :param repeat: Defaults 3. Number of timed runs of each stage
+    :param trace_memory: Defaults True. If False, the tracemalloc run is skipped
+
+    :returns results: A dictionary of stage name to the measurements of its best run
+        (see `instrumentation.measure`), with its 'tracemalloc_peak_mb' and the best run of each of
+        the steps measured within the stage under 'steps'
+    """
+    # Keep the counties caches of the benchmark out of the cache of the real data
+    constants.cache_dir = os.path.join(work_dir, 'cache')
+    from colormap import get_rgbs
+    import counties_cache
+    from make_nyt_geojson import merge_nyt_with_census
+    from make_peese_geojson import merge_peese_with_census, prep_peese_csv
+    from transforms import gzip_geojson
+
+    peese_dir = os.path.join(work_dir, 'peese')
+    nyt_dir = os.path.join(work_dir, 'nyt')
+    frames = {}
+
+    def load_counties_cold(record):
+        counties_cache.loaded_counties.clear()
+        for kind in ['counties', 'derived']:
+            cache_file = counties_cache.cache_filepath(files['counties_geojson'], kind)
+            if os.path.isfile(cache_file):
+                os.remove(cache_file)
+        record['rows'] = len(counties_cache.load_derived_counties(files['counties_geojson'])['counties'])
+
+    def prep_peese(record):
+        frames['peese'] = prep_peese_csv(files['peese_csv'], constants.county_fips)
+        record['rows'] = frames['peese'].shape[0]
+
+    def merge_peese(record):
+        record['rows'] = merge_peese_with_census(
+            frames['peese'],
+            files['counties_geojson'],
+            os.path.join(peese_dir, 'peese-latest.geojson'),
+            slim_output=os.path.join(peese_dir, 'peese-latest-slim.geojson'),
+            geojson_writer='stream',
+            timeseries_output=os.path.join(peese_dir, 'peese-latest-timeseries.geojson'),
+            topojson_output=os.path.join(peese_dir, 'peese-latest-slim.topojson')
+        ).shape[0]
+
+    def merge_nyt(record):
+        frames['nyt'] = merge_nyt_with_census(
+            files['nyt_csv'],
+            files['counties_geojson'],
+            os.path.join(nyt_dir, 'nyt-latest.geojson'),
+            slim_output=os.path.join(nyt_dir, 'nyt-latest-slim.geojson'),
+            geojson_writer='stream',
+            timeseries_output=os.path.join(nyt_dir, 'nyt-latest-timeseries.geojson'),
+            topojson_output=os.path.join(nyt_dir, 'nyt-latest-slim.topojson')
+        )
+        record['rows'] = frames['nyt'].shape[0]
+
+    def classify(record, mode):
+        values = frames['nyt'].cases_per_100k.to_numpy(dtype=float, na_value=float('nan'))
+        get_rgbs(values, 7, colormap='plasma', mode=mode)
+        record['rows'] = values.size
+
+    def gzip_slim(record):
+        slim_output = os.path.join(nyt_dir, 'nyt-latest-slim.geojson')
+        gzip_geojson(slim_output, slim_output + '.gz')
+        instrumentation.add_bytes_written(record, [slim_output + '.gz'])
+
+    stages = {
+        'load_derived_counties (cold)': load_counties_cold,
+        'prep_peese_csv': prep_peese,
+        'merge_peese_with_census': merge_peese,
+        'merge_nyt_with_census': merge_nyt,
+        'get_rgbs (equalcount)': partial(classify, mode='equalcount'),
+        'get_rgbs (jenks)': partial(classify, mode='jenks'),
+        'gzip slim geojson': gzip_slim,
+    }
+
+    print(f'\nBenchmarking {len(stages)} stages, best of {repeat}')
+    results = {}
+    for stage_name, stage in stages.items():
+        runs = []
+        for _ in range(repeat):
+            first_record = len(instrumentation.run_records)
+            with instrumentation.measure(stage_name) as record:
+                stage(record)
+            runs.append(instrumentation.run_records[first_record:])
+        # The stage is measured last, after the steps within it
+        best = min(runs, key=lambda run: run[-1]['wall_seconds'])
+        results[stage_name] = dict(best[-1], steps={
+            step['stage'][len(stage_name) + 1:]: step for step in best[:-1]
+        })
+
+        if trace_memory:
+            # Tracing starts with the stage, so its peak is the stage's, even on Python 3.8 (see `instrumentation.measure`)
+            tracemalloc.start()
+            with instrumentation.measure(stage_name) as record:
+                stage(record)
+            tracemalloc.stop()
+            results[stage_name]['tracemalloc_peak_mb'] = record['tracemalloc_peak_mb']
+    return results
+
+def print_results(results, baseline=None, threshold=0.2, min_seconds=0.05):
+    """Print a table of the benchmark results. With a baseline (the results of another commit),
+    the change of the time and memory of each stage is printed, and the stages that are slower
+    or use more memory than the baseline by more than `threshold` (a fraction) are flagged.
+    A stage must also be slower by `min_seconds` to be flagged, as the timings of the shortest
+    stages are mostly noise.
+
+    :returns regressions: A list of the names of the stages that regressed
+    """
+    baseline = baseline or {}
+    print(f'\n{"Stage":<34}{"Seconds":>9}{"CPU s":>9}{"Alloc MB":>10}{"Rows":>10}{"Written MB":>12}'
+          + (f'{"vs base":>10}{"Alloc vs":>10}' if baseline else ''))
+    regressions = []
+    for stage_name, result in results.items():
+        for name, record in [(stage_name, result)] + [(f'  {step}', step_record) for step, step_record in result['steps'].items()]:
+            line = (
+                f'{name[:32]:<34}{record["wall_seconds"]:>9.3f}{record["cpu_seconds"]:>9.3f}'
+                f'{record["tracemalloc_peak_mb"] if record["tracemalloc_peak_mb"] is not None else "":>10}{record["rows"] if record["rows"] is not None else "":>10}'
+                f'{record["bytes_written"] / 1e6:>12.2f}'
+            )
+            base = baseline.get(stage_name) if record is result else None
+            if base:
+                seconds_change = record['wall_seconds'] / max(base['wall_seconds'], 1e-6) - 1
+                memory_change = (record.get('tracemalloc_peak_mb') or 0) / max(base.get('tracemalloc_peak_mb') or 0, 1e-6) - 1 \
+                    if base.get('tracemalloc_peak_mb') else 0
+                line += f'{seconds_change:>+10.0%}{memory_change:>+10.0%}'
+                slower = record['wall_seconds'] - base['wall_seconds'] > min_seconds
+                if (seconds_change > threshold and slower) or memory_change > threshold:
+                    regressions.append(stage_name)
+                    line += '  REGRESSION'
+            print(line)
+    return regressions
+
+def git_commit():
+    """The commit of the working tree, or None outside of a git checkout"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """Benchmark the pipelines offline, on synthetic data at a scale of the 1x dataset (see `synthetic_data`),
+    and write the results to JSON, so that they can be compared between commits:
+
+        python source/benchmarks/bench_pipeline.py --scale 10 --axis days --output before.json
+        git checkout my-branch
+        python source/benchmarks/bench_pipeline.py --scale 10 --axis days --compare before.json
+
+    With `--compare`, exits with status 1 if a stage is slower, or allocates more, than in the
+    baseline by more than `--threshold`.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the pipelines on synthetic data')
+    parser.add_argument('--scale', type=int, default=1, help='Size of the data, as a multiple of the 1x dataset')
+    parser.add_argument('--axis', choices=['days', 'counties', 'both'], default='days', help='What grows with the scale')
+    parser.add_argument('--vertices', type=int, default=16, help='Vertices of each side of a county polygon')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each stage')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc run of each stage')
+    parser.add_argument('--data-dir', default=None, help='Directory of the synthetic data, kept between runs')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='Compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Change that counts as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='Slowdown in seconds that counts as a regression')
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    print(f'\nRunning script : {os.path.abspath(__file__)}')
+    print(f'Start time     : {start_time}')
+
+    county_count, day_count = scaled_sizes(args.scale, args.axis)
+    data_dir = args.data_dir or os.path.join(constants.cache_dir, 'benchmarks')
+    files = make_synthetic_data(data_dir, county_count, day_count, vertices_per_edge=args.vertices)
+    with tempfile.TemporaryDirectory(prefix='bench-pipeline-') as work_dir:
+        results = benchmark_pipeline(files, work_dir, repeat=args.repeat, trace_memory=not args.no_memory)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f'\nCompared with {args.compare} (commit {baseline.get("commit")})')
+        baseline = baseline['results']
+    regressions = print_results(results, baseline, args.threshold, args.min_seconds)
+
+    if args.output:
+        print(f'\nWriting the results:\n {args.output}')
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'commit': git_commit(),
+                'date': start_time.isoformat(),
+                'scale': args.scale,
+                'axis': args.axis,
+                'county_count': county_count,
+                'day_count': day_count,
+                'vertices_per_edge': args.vertices,
+                'results': results,
+            }, output_file, indent=2)
+
+    end_time = datetime.now()
+    print(f'\nScript completed : {end_time}')
+    print(f'Run time         : {end_time-start_time}\n')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
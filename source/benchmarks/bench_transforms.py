@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'backend'
+)))
+
+from transforms import epoch_milliseconds, parse_dates, per_100k
+
+
+def synthetic_cases(county_count=3200, day_count=250, seed=0):
+    """Build a long formatted frame the size of the NYT history: one row per county per day,
+    with cumulative cases and the county population
+
+    :param county_count: Defaults 3200. Number of counties
+    :param day_count: Defaults 250. Number of days
+    :param seed: Defaults 0. Seed of the random counts
+
+    :returns cases_df: A DataFrame with `fips`, `date` (ISO strings), `cases` and `population`
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-01-21', periods=day_count).strftime('%Y-%m-%d')
+    return pd.DataFrame({
+        'fips': np.repeat([f'{fips:05d}' for fips in range(county_count)], day_count),
+        'date': np.tile(dates, county_count),
+        'cases': rng.integers(0, 50, county_count * day_count).cumsum(),
+        'population': np.repeat(rng.integers(1000, 1000000, county_count), day_count),
+    })
+
+def benchmark_transforms(cases_df, repeat=3):
+    """Time each stage of the shared transform core against the row-wise code it replaced,
+    and print the best time of each and the speedup.
+
+    :param cases_df: A frame like the one of `synthetic_cases`
+    :param repeat: Defaults 3. Number of times each stage is run
+
+    :returns results: A dictionary of stage name to `{'before': seconds, 'after': seconds}`
+    """
+    dates = parse_dates(cases_df.date)
+    stages = {
+        'parse dates': (
+            lambda: pd.to_datetime(cases_df.date) + timedelta(hours=12),
+            lambda: parse_dates(cases_df.date),
+        ),
+        'epoch milliseconds': (
+            lambda: ((dates - datetime(1970, 1, 1)).dt.total_seconds() * 1000).apply(int),
+            lambda: epoch_milliseconds(dates),
+        ),
+        'per 100k': (
+            lambda: ((cases_df.cases / cases_df.population) * 100000).apply(lambda x: round(x, 3)),
+            lambda: per_100k(cases_df.cases, cases_df.population),
+        ),
+    }
+
+    print(f'\nBenchmarking transforms on {cases_df.shape[0]} rows, best of {repeat}')
+    results = {}
+    for stage_name, (before, after) in stages.items():
+        results[stage_name] = {}
+        for version, stage in [('before', before), ('after', after)]:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                stage()
+                timings.append(time.perf_counter() - start)
+            results[stage_name][version] = min(timings)
+
+    print(f'\n{"Stage":<22}{"Before":>10}{"After":>10}{"Speedup":>10}')
+    for stage_name, result in results.items():
+        print(
+            f'{stage_name:<22}{result["before"]:>10.3f}{result["after"]:>10.3f}'
+            f'{result["before"] / result["after"]:>9.1f}x'
+        )
+    return results
+
+def main():
+    """Benchmark the shared transform core on a synthetic frame the size of the NYT data.
+    The number of counties and days can be given on the command line:
+
+        python source/benchmarks/bench_transforms.py 3200 250
+    """
+    start_time = datetime.now()
+    print(f'\nRunning script : {os.path.abspath(__file__)}')
+    print(f'Start time     : {start_time}')
+
+    county_count = int(sys.argv[1]) if len(sys.argv) > 1 else 3200
+    day_count = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    benchmark_transforms(synthetic_cases(county_count, day_count))
+
+    end_time = datetime.now()
+    print(f'\nScript completed : {end_time}')
+    print(f'Run time         : {end_time-start_time}\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'backend'
+)))
+
+import constants
+
+
+base_county_count = 100  # Counties of a 1x dataset. The New York counties are always included.
+base_day_count = 30      # Days of a 1x dataset
+
+
+def scaled_sizes(scale=1, axis='days'):
+    """The number of counties and days of a dataset at a scale of the 1x dataset
+
+    :param scale: Defaults 1. e.g. 1, 10 or 100
+    :param axis: Defaults 'days'. What grows with the scale: 'days', 'counties' or 'both'
+
+    :returns county_count, day_count:
+    """
+    county_count = base_county_count * (scale if axis in ('counties', 'both') else 1)
+    day_count = base_day_count * (scale if axis in ('days', 'both') else 1)
+    return county_count, day_count
+
+def make_synthetic_data(data_dir, county_count=None, day_count=None, vertices_per_edge=16, seed=0):
+    """Write a synthetic counties GeoJSON, NYT CSV and PEESE CSV to `data_dir`, in the formats of
+    `data/usa_counties.geojson`, the NYT `us-counties.csv` and the PEESE CSV, so that the pipelines
+    can be run offline at any size. The files are only written if they do not exist yet.
+
+    :param data_dir: Directory where the files are written
+    :param county_count: Defaults None. Number of counties. Falls back to `base_county_count`
+    :param day_count: Defaults None. Number of days. Falls back to `base_day_count`
+    :param vertices_per_edge: Defaults 16. Vertices of each side of a county polygon (see `synthetic_counties`)
+    :param seed: Defaults 0. Seed of the random values
+
+    :returns files: A dictionary with the 'counties_geojson', 'nyt_csv' and 'peese_csv' file locations
+    """
+    county_count = county_count or base_county_count
+    day_count = day_count or base_day_count
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    files = {
+        'counties_geojson': os.path.join(data_dir, f'counties_{county_count}_{vertices_per_edge}.geojson'),
+        'nyt_csv': os.path.join(data_dir, f'nyt_{county_count}_{day_count}.csv'),
+        'peese_csv': os.path.join(data_dir, f'peese_{day_count}.csv'),
+    }
+
+    counties = None
+    if not os.path.isfile(files['counties_geojson']):
+        counties = synthetic_counties(county_count, vertices_per_edge, seed)
+        print(f'\nWriting {county_count} synthetic counties:\n {files["counties_geojson"]}')
+        with open(files['counties_geojson'], 'w') as counties_file:
+            json.dump(counties, counties_file)
+    if not os.path.isfile(files['nyt_csv']):
+        if counties is None:
+            with open(files['counties_geojson'], 'r') as counties_file:
+                counties = json.load(counties_file)
+        nyt_cases = synthetic_nyt_cases(counties, day_count, seed)
+        print(f'Writing {nyt_cases.shape[0]} synthetic NYT rows:\n {files["nyt_csv"]}')
+        nyt_cases.to_csv(files['nyt_csv'], index=False)
+    if not os.path.isfile(files['peese_csv']):
+        peese_cases = synthetic_peese_cases(day_count, seed)
+        print(f'Writing {peese_cases.shape[0]} synthetic PEESE regions:\n {files["peese_csv"]}')
+        peese_cases.to_csv(files['peese_csv'], index=False)
+    return files
+
+def synthetic_counties(county_count, vertices_per_edge=16, seed=0):
+    """Build a GeoJSON FeatureCollection of county polygons with the census fields of the counties layer.
+
+    The counties are the cells of a grid over the lower 48 states. Each side of a cell is a wiggly line
+    of `vertices_per_edge` vertices, and neighboring cells share the same sides, as real counties share
+    their borders (which matters to the TopoJSON and vector tile outputs). The New York counties of
+    `constants.county_fips` come first, followed by counties in made up states.
+
+    :returns feature_collection: A dictionary in the GeoJSON format
+    """
+    rng = np.random.default_rng(seed)
+    county_count = max(county_count, len(constants.county_fips))
+    fips_codes = sorted(set(constants.county_fips.values()))
+    names = {fips: region.title() for region, fips in constants.county_fips.items()}
+    state_fips = 1
+    while len(fips_codes) < county_count:
+        if state_fips != 36:
+            fips_codes += [f'{state_fips:02d}{county:03d}' for county in range(1, 200, 2)]
+        state_fips += 1
+    fips_codes = fips_codes[:county_count]
+
+    columns = int(np.ceil(np.sqrt(county_count * 2)))
+    cell = min(58 / columns, 1.0)
+    populations = rng.lognormal(10.5, 1.3, county_count).astype(int) + 100
+
+    def edge(x0, y0, x1, y1):
+        # The same wiggle for a side, whichever of the two cells draws it
+        t = np.linspace(0, 1, vertices_per_edge + 1)
+        xs, ys = x0 + (x1 - x0) * t, y0 + (y1 - y0) * t
+        wiggle = np.sin(xs * 7.3 + ys * 11.1) * np.sin(np.pi * t) * cell * 0.08
+        return np.column_stack([xs + wiggle * (y1 - y0) / cell, ys + wiggle * (x1 - x0) / cell])
+
+    features = []
+    for i, fips in enumerate(fips_codes):
+        x0 = -125 + (i % columns) * cell
+        y0 = 25 + (i // columns) * cell
+        x1, y1 = x0 + cell, y0 + cell
+        ring = np.concatenate([
+            edge(x0, y0, x1, y0)[:-1],
+            edge(x1, y0, x1, y1)[:-1],
+            edge(x0, y1, x1, y1)[::-1][:-1],
+            edge(x0, y0, x0, y1)[::-1],
+        ])
+        population = int(populations[i])
+        features.append({
+            'type': 'Feature',
+            'properties': {
+                'FIPS': fips,
+                'NAME': names.get(fips, f'County {fips}'),
+                'STATE_NAME': 'New York' if fips.startswith('36') else f'State {fips[:2]}',
+                'POPULATION': population,
+                'MALES': population // 2,
+                'FEMALES': population - population // 2,
+                'POP2010': int(population * 0.95),
+                'SQMI': round(cell**2 * 3000, 1),
+                'MED_AGE': round(float(rng.uniform(25, 55)), 1),
+                'HOUSEHOLDS': population // 3,
+            },
+            'geometry': {
+                'type': 'MultiPolygon',
+                'coordinates': [[np.round(ring, 6).tolist()]],
+            },
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+def synthetic_nyt_cases(counties, day_count, seed=0):
+    """Build rows in the format of the NYT `us-counties.csv` for the counties of `synthetic_counties`:
+    one row per county per day from the day of its first case, with cumulative cases and deaths.
+    As in the NYT data, the five NYC counties are reported as one 'New York City' region without
+    a FIPS code, every state has an 'Unknown' county, and some rows have no deaths reported.
+
+    :returns nyt_cases: A DataFrame with the `date`, `county`, `state`, `fips`, `cases` and `deaths` columns
+    """
+    rng = np.random.default_rng(seed + 1)
+    regions = [
+        (feature['properties']['NAME'], feature['properties']['STATE_NAME'], feature['properties']['FIPS'])
+        for feature in counties['features'] if feature['properties']['FIPS'] not in constants.nyc_counties_fips
+    ]
+    regions.append(('New York City', 'New York', ''))
+    regions += [('Unknown', state, '') for state in sorted({state for _, state, _ in regions})]
+
+    dates = pd.date_range('2020-01-21', periods=day_count).strftime('%Y-%m-%d').to_numpy()
+    first_days = rng.integers(0, max(1, day_count // 2), len(regions))
+    day_counts = day_count - first_days
+    region_index = np.repeat(np.arange(len(regions)), day_counts)
+    day_index = np.concatenate([np.arange(first_day, day_count) for first_day in first_days])
+
+    # Growth that slows down, with some noise, and the occasional correction that lowers the cumulative count
+    daily_cases = rng.poisson(rng.lognormal(1.5, 1.2, len(regions))[region_index] * (1 + day_index / 10))
+    daily_cases = np.where(rng.random(region_index.size) < 0.01, -daily_cases, daily_cases)
+    starts = np.concatenate([[0], np.cumsum(day_counts)[:-1]])
+    cases = np.cumsum(daily_cases) - np.repeat(np.cumsum(daily_cases)[starts] - daily_cases[starts], day_counts)
+    deaths = (cases * rng.uniform(0.01, 0.05, len(regions))[region_index]).astype(int)
+    # As in the NYT data, some rows have no deaths reported (an empty value in the CSV)
+    deaths = pd.array(np.maximum(deaths, 0), dtype='Int64')
+    deaths[(rng.random(region_index.size) < 0.005) | (np.arange(region_index.size) == region_index.size - 1)] = pd.NA
+
+    names, states, fips = (np.array(column, dtype=object) for column in zip(*regions))
+    return pd.DataFrame({
+        'date': dates[day_index],
+        'county': names[region_index],
+        'state': states[region_index],
+        'fips': fips[region_index],
+        'cases': np.maximum(cases, 0),
+        'deaths': deaths,
+    }).sort_values(['date', 'state', 'county'], kind='mergesort')
+
+def synthetic_peese_cases(day_count, seed=0):
+    """Build a table in the format of the PEESE CSV: one row per New York region (the keys of
+    `constants.county_fips`) and one column of cumulative cases per day, named like '3/1/2020'
+
+    :returns peese_cases: A DataFrame with the `region` column and one column per day
+    """
+    rng = np.random.default_rng(seed + 2)
+    regions = list(constants.county_fips)
+    dates = pd.date_range('2020-03-01', periods=day_count)
+    daily_cases = rng.poisson(rng.lognormal(2, 1.2, (len(regions), 1)) * (1 + np.arange(day_count) / 10))
+    peese_cases = pd.DataFrame(
+        np.cumsum(daily_cases, axis=1),
+        columns=[f'{date.month}/{date.day}/{date.year}' for date in dates]
+    )
+    peese_cases.insert(0, 'region', regions)
+    return peese_cases
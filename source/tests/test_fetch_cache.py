@@ -0,0 +1,106 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+backend_dir = os.path.abspath(os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'backend'
+))
+sys.path.insert(0, backend_dir)
+
+import constants
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve `server.body` like raw.githubusercontent.com does: with an ETag, and 304 Not Modified
+    when the request sends the current ETag back as If-None-Match"""
+    def do_GET(self):
+        etag = f'"{hashlib.sha1(self.server.body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.server.statuses.append(304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.server.statuses.append(200)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FetchNYTTest(unittest.TestCase):
+    """Run the NYT fetch stage against a local stand-in of the GitHub server, through the scenarios
+    of a nightly run, and check the HTTP status of each fetch and whether the run publishes"""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.body = b'date,county,state,fips,cases,deaths\n2020-04-01,Albany,New York,36001,10,0\n'
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.work_dir = tempfile.mkdtemp()
+
+        nyt_csv_url = f'http://127.0.0.1:{self.server.server_address[1]}/us-counties.csv'
+        self.constants = mock.patch.multiple(
+            constants,
+            nyt_csv_url=nyt_csv_url,
+            cache_dir=os.path.join(self.work_dir, 'cache')
+        )
+        self.constants.start()
+        self.paths = {'publish_manifest_json': os.path.join(self.work_dir, 'publish-manifest.json')}
+
+    def tearDown(self):
+        self.constants.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def fetch(self, expected_status, expected_publish):
+        from publish_nyt_geojson import fetch_nyt
+
+        nyt_source = fetch_nyt(self.paths, {'skip_unchanged_source': True})
+        self.assertEqual(self.server.statuses[-1], expected_status)
+        self.assertEqual(nyt_source is not None, expected_publish)
+        return nyt_source
+
+    def publish(self, nyt_source, success):
+        """Record what `publish_files_to_s3` records after uploading the outputs (here, the CSV stands in for them)"""
+        from cloud_functions import UploadResult, read_publish_manifest, write_publish_manifest
+
+        results = [UploadResult(nyt_source.filepath, 'nyt-latest.csv', success, 1, 0.1, 1, None, False, 'digest')]
+        manifest_json = self.paths['publish_manifest_json']
+        write_publish_manifest(read_publish_manifest(manifest_json), results, 'bucket', manifest_json,
+                               sources={nyt_source.url: nyt_source.sha256})
+
+    def test_unchanged_source_is_skipped_once_published(self):
+        nyt_source = self.fetch(200, True)
+        self.publish(nyt_source, success=True)
+        self.fetch(304, False)
+
+        self.server.body += b'2020-04-02,Albany,New York,36001,12,1\n'
+        nyt_source = self.fetch(200, True)
+        self.publish(nyt_source, success=True)
+        self.fetch(304, False)
+
+    def test_unchanged_source_is_published_again_after_a_failed_publish(self):
+        nyt_source = self.fetch(200, True)
+        self.publish(nyt_source, success=False)
+        nyt_source = self.fetch(304, True)
+        self.publish(nyt_source, success=True)
+        self.fetch(304, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
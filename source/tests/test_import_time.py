@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+backend_dir = os.path.abspath(os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'backend'
+))
+
+import_budgets = {  # Statement run in a fresh interpreter: (seconds it may take, modules it must not load)
+    'import publish_nyt_geojson': (0.25, ['pandas', 'geopandas', 'shapely', 'matplotlib', 'boto3']),
+    'import publish_peese_geojson': (0.25, ['pandas', 'geopandas', 'shapely', 'matplotlib', 'boto3']),
+    'import publish_all': (0.25, ['pandas', 'geopandas', 'shapely', 'matplotlib', 'boto3']),
+    'import fetch_cache': (0.25, ['pandas', 'geopandas', 'shapely', 'matplotlib', 'boto3']),
+    'import colormap; colormap.get_rgbs(list(range(100)), 10, "plasma")': (1.0, ['geopandas', 'matplotlib', 'boto3']),
+}
+
+
+def time_statement(statement, repeat=3):
+    """Run a statement in a fresh Python interpreter (so that nothing is imported yet), `repeat` times
+
+    :returns seconds, loaded: The best time of the runs, and the list of the top level modules
+        that were loaded by the statement
+    """
+    code = (
+        'import json, sys, time\n'
+        'before = set(sys.modules)\n'
+        'start = time.perf_counter()\n'
+        f'{statement}\n'
+        'seconds = time.perf_counter() - start\n'
+        'loaded = sorted({name.split(".")[0] for name in set(sys.modules) - before})\n'
+        'print(json.dumps({"seconds": seconds, "loaded": loaded}))\n'
+    )
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, '-c', code],
+            cwd=backend_dir,
+            env=dict(os.environ, PYTHONPATH=backend_dir),
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        timing = json.loads(result.stdout.strip().splitlines()[-1])
+        timings.append(timing['seconds'])
+    return min(timings), timing['loaded']
+
+
+class ImportTimeTest(unittest.TestCase):
+    """The entry points of the backend start within their budget (`import_budgets`), without loading
+    the heavy dependencies that only later stages need"""
+
+    def test_import_budgets(self):
+        for statement, (budget, forbidden_modules) in import_budgets.items():
+            with self.subTest(statement=statement):
+                seconds, loaded = time_statement(statement)
+                self.assertLessEqual(seconds, budget, f'{seconds:.3f} s is over the budget of {budget:.3f} s')
+                self.assertEqual([module for module in forbidden_modules if module in loaded], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
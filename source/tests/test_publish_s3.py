@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+backend_dir = os.path.abspath(os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'backend'
+))
+sys.path.insert(0, backend_dir)
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+part_size = 5 * 1024 * 1024  # the smallest part of a multipart upload S3 accepts
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@unittest.skipIf(ThreadedMotoServer is None, 'moto[server] is not installed')
+class PublishFilesToS3Test(unittest.TestCase):
+    """Publish files to a local S3 stand-in (`moto_server`) through the `S3_ENDPOINT_URL` hook"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.environ = mock.patch.dict(os.environ, {
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+        })
+        cls.environ.start()
+        port = free_port()
+        cls.server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        cls.server.start()
+        cls.endpoint_url = f'http://127.0.0.1:{port}'
+
+        import cloud_functions
+        cls.cloud_functions = cloud_functions
+        cls.s3_client = cloud_functions.get_s3_client(cls.endpoint_url)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.cloud_functions.s3_clients.pop(cls.endpoint_url, None)
+        cls.environ.stop()
+
+    def setUp(self):
+        # A bucket per test, so that the objects published by one test are not skipped by the next
+        self.bucket = self.id().split('.')[-1].replace('_', '-')
+        self.s3_client.create_bucket(Bucket=self.bucket)
+        self.work_dir = tempfile.mkdtemp()
+        self.manifest_json = os.path.join(self.work_dir, 'publish-manifest.json')
+        self.uploads = []
+        for index in range(6):
+            self.uploads.append((self.write_file(f'file-{index}.json', b'{"index": %d}' % index), f'file-{index}.json', None))
+        # Larger than a part, so that it is uploaded in parts
+        self.uploads.append((self.write_file('large.geojson.gz', os.urandom(part_size + 1024)), 'large.geojson.gz', None))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_file(self, name, content):
+        file_name = os.path.join(self.work_dir, name)
+        with open(file_name, 'wb') as out_file:
+            out_file.write(content)
+        return file_name
+
+    def publish(self, uploads, **kwargs):
+        kwargs.setdefault('max_workers', 4)
+        kwargs.setdefault('multipart_chunksize', part_size)
+        kwargs.setdefault('backoff_seconds', 0)
+        return self.cloud_functions.publish_files_to_s3(
+            uploads,
+            self.bucket,
+            endpoint_url=self.endpoint_url,
+            manifest_json=self.manifest_json,
+            **kwargs
+        )
+
+    def read_object(self, object_name):
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=object_name)
+        return response['Body'].read(), response['Metadata'], response['ContentType']
+
+    def test_concurrent_uploads(self):
+        upload_file = self.s3_client.upload_file
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def count_running(*args, **kwargs):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            try:
+                time.sleep(0.05)
+                return upload_file(*args, **kwargs)
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        with mock.patch.object(self.s3_client, 'upload_file', side_effect=count_running):
+            results = self.publish(self.uploads, skip_unchanged=False)
+
+        self.assertGreater(peak[0], 1)
+        self.assertEqual([result.object_name for result in results], [upload[1] for upload in self.uploads])
+        for file_name, object_name, _ in self.uploads:
+            with open(file_name, 'rb') as in_file:
+                content = in_file.read()
+            body, metadata, _ = self.read_object(object_name)
+            self.assertEqual(body, content)
+            self.assertEqual(metadata['sha256'], self.cloud_functions.file_sha256(file_name))
+        self.assertEqual(self.read_object('large.geojson.gz')[2], 'application/json')
+
+    def test_unchanged_files_are_skipped(self):
+        self.publish(self.uploads)
+        changed_file = self.uploads[0][0]
+        with open(changed_file, 'wb') as out_file:
+            out_file.write(b'{"index": "changed"}')
+
+        # Without the manifest, the digests in the object metadata are compared
+        os.remove(self.manifest_json)
+        results = self.publish(self.uploads)
+        self.assertEqual([result.skipped for result in results], [False] + [True] * (len(self.uploads) - 1))
+        self.assertEqual(self.read_object('file-0.json')[0], b'{"index": "changed"}')
+
+        # With the manifest, no object is requested from S3
+        with mock.patch.object(self.cloud_functions, 'remote_sha256') as remote_sha256:
+            results = self.publish(self.uploads)
+        self.assertTrue(all(result.skipped for result in results))
+        remote_sha256.assert_not_called()
+
+    def test_failed_uploads_are_retried(self):
+        upload_file = self.s3_client.upload_file
+        failures = {'file-1.json': 1, 'file-2.json': 3}
+
+        def fail_first_attempts(file_name, bucket_name, object_name, **kwargs):
+            if failures.get(object_name):
+                failures[object_name] -= 1
+                raise self.cloud_functions.S3UploadFailedError(f'Failed to upload {object_name}')
+            return upload_file(file_name, bucket_name, object_name, **kwargs)
+
+        with mock.patch.object(self.s3_client, 'upload_file', side_effect=fail_first_attempts):
+            results = self.publish(self.uploads, max_attempts=3)
+        results = {result.object_name: result for result in results}
+
+        self.assertTrue(results['file-1.json'].success)
+        self.assertEqual(results['file-1.json'].attempts, 2)
+        self.assertFalse(results['file-2.json'].success)
+        self.assertEqual(results['file-2.json'].attempts, 3)
+        self.assertIn('Failed to upload file-2.json', results['file-2.json'].error)
+        self.assertTrue(results['file-3.json'].success)
+        self.assertEqual(results['file-3.json'].attempts, 1)
+
+    def test_manifest(self):
+        missing_file = os.path.join(self.work_dir, 'missing.json')
+        uploads = self.uploads + [(missing_file, 'missing.json', None)]
+        results = self.publish(uploads, sources={'https://example.com/source.csv': 'source-digest'})
+
+        missing = results[-1]
+        self.assertFalse(missing.success)
+        self.assertIsNone(missing.sha256)
+        self.assertTrue(all(result.success for result in results[:-1]))
+
+        with open(self.manifest_json) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest['bucket'], self.bucket)
+        self.assertEqual(sorted(manifest['objects']), sorted(upload[1] for upload in self.uploads))
+        for file_name, object_name, _ in self.uploads:
+            self.assertEqual(manifest['objects'][object_name]['sha256'], self.cloud_functions.file_sha256(file_name))
+            self.assertEqual(manifest['objects'][object_name]['bytes'], os.path.getsize(file_name))
+        self.assertEqual(
+            [(run['object_name'], run['status']) for run in manifest['run']],
+            [(upload[1], 'uploaded') for upload in self.uploads] + [('missing.json', 'failed')]
+        )
+        # A source is only recorded once every file built from it is published
+        self.assertEqual(manifest['sources'], {})
+
+        self.publish(self.uploads, sources={'https://example.com/source.csv': 'source-digest'})
+        with open(self.manifest_json) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest['sources'], {'https://example.com/source.csv': 'source-digest'})
+        self.assertTrue(all(run['status'] == 'unchanged' for run in manifest['run']))
+
+
+if __name__ == '__main__':
+    unittest.main()